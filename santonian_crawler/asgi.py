@@ -0,0 +1,216 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Copyright 2021 by BurnoutDV, <development@burnoutdv.com>
+#
+# This file is part of SantonianCrawler.
+#
+# SantonianCrawler is free software: you can redistribute
+# it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, either
+# version 3 of the License, or (at your option) any later version.
+#
+# SantonianCrawler is distributed in the hope that it will
+# be useful, but WITHOUT ANY WARRANTY; without even the implied warranty
+# of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# @license GPL-3.0-only <https://www.gnu.org/licenses/gpl-3.0.en.html>
+
+
+# ? The mirror as a plain ASGI application, same routes and byte for byte the same bodies as the flask app in wsgi.py
+# ? but without a thread per client, run it with any ASGI server, eg. 'uvicorn asgi:app' from inside this folder.
+# ? Cached bodies are answered directly on the event loop, only rendering touches sqlite and that happens in a small
+# ? pool of worker threads that each keep their own connection (see LiveSource), so thousands of waiting clients
+# ? cost some coroutines and not thousands of connections
+
+import asyncio
+import logging
+import re
+from urllib.parse import parse_qsl
+from concurrent.futures import ThreadPoolExecutor
+from config import db_cache_size, mirror_max_age, mirror_mode, mirror_snapshot_interval, mirror_db_workers, \
+    mirror_listing_cache_max
+from mirror import RenderCache, LiveSource, SnapshotSource, etag_matches, select_variant, render_json, parse_since, \
+    export_ndjson, page_params, stream_json_array, payload_hdd, payload_hdd_details, payload_file, payload_read_file
+from metrics import Metrics, asgi_metrics
+
+logger = logging.getLogger(__name__)
+
+db_name = "santonian.db"
+metrics = Metrics()
+if mirror_mode == "snapshot":
+    source = SnapshotSource(db_name, mirror_snapshot_interval)
+else:
+    source = LiveSource(db_name, cache_size=db_cache_size, trace=metrics.count_query)
+_renders = RenderCache(lambda: source.generation())
+_pool = ThreadPoolExecutor(max_workers=mirror_db_workers, thread_name_prefix="mirror-db")
+
+# ? the optional trailing slash is the double route of the flask app, groups are the same as its converters, key and
+# ? payload get the query parameters first and the groups after that, labels are the flask route templates
+_routes = (
+    (re.compile(r"/backend/hdd/?"), "/backend/hdd", lambda query: ("hdd", ), lambda query: payload_hdd(source)),
+    (re.compile(r"/backend/hdd_details/([^/]+)/?"), "/backend/hdd_details/<disk>",
+     lambda query, disk: ("hdd_details", disk), lambda query, disk: payload_hdd_details(source, disk)),
+    (re.compile(r"/backend/file/(\d+)/?"), "/backend/file/<int:disk_id>",
+     lambda query, disk_id: ("file", int(disk_id), *_paging(query)),
+     lambda query, disk_id: payload_file(source, int(disk_id), *_paging(query))),
+    (re.compile(r"/backend/readFile/([^/]+)/?"), "/backend/readFile/<file_name>",
+     lambda query, file_name: ("readFile", file_name), lambda query, file_name: payload_read_file(source, file_name)),
+)
+
+_export_route = re.compile(r"/backend/export/?")
+_max_form_size = 64 * 1024  # * bytes of a form body that are looked at, a page number needs a lot less
+
+
+def _paging(query: dict) -> tuple:
+    return page_params(query.get("page"), query.get("per_page")) or ()
+
+
+def _match(path: str, query: dict):
+    """
+    :return: route label, cache key and payload producer of the route or None
+    """
+    for pattern, label, key, payload in _routes:
+        if found := pattern.fullmatch(path):
+            args = found.groups()
+            return label, key(query, *args), metrics.timed(label, lambda: payload(query, *args))
+    return None
+
+
+async def _parameters(scope, receive) -> dict:
+    """
+    The request parameters like flask's request.values sees them: the query string and, for a form POST, the
+    fields of the body, the query string wins if both have the same one
+    """
+    parameters = {}
+    content_type = dict(scope['headers']).get(b"content-type", b"").split(b";")[0].strip().lower()
+    if scope['method'] == "POST" and content_type == b"application/x-www-form-urlencoded":
+        body, more = b"", True
+        while more and len(body) <= _max_form_size:
+            message = await receive()
+            if message['type'] != "http.request":
+                break  # * client is gone
+            body += message.get('body', b"")
+            more = message.get('more_body', False)
+        parameters.update(parse_qsl(body[:_max_form_size].decode("latin-1")))
+    parameters.update(parse_qsl(scope.get('query_string', b"").decode("latin-1")))
+    return parameters
+
+
+async def _send_simple(send, status: int, body: bytes, headers=()):
+    await send({'type': "http.response.start", 'status': status,
+                'headers': [(b"content-type", b"text/plain; charset=utf-8"),
+                            (b"content-length", str(len(body)).encode("ascii")), *headers]})
+    await send({'type': "http.response.body", 'body': body})
+
+
+async def _stream(scope, send, chunks, content_type: bytes):
+    """
+    Sends a generator of bytes, every chunk is read by one of the pool threads only after the previous one was
+    sent, a slow client therefore slows the generator down instead of piling up chunks in memory
+    """
+    await send({'type': "http.response.start", 'status': 200, 'headers': [(b"content-type", content_type)]})
+    loop = asyncio.get_running_loop()
+    try:
+        if scope['method'] != "HEAD":
+            while (chunk := await loop.run_in_executor(_pool, next, chunks, None)) is not None:
+                await send({'type': "http.response.body", 'body': chunk, 'more_body': True})
+        await send({'type': "http.response.body", 'body': b""})
+    finally:
+        await loop.run_in_executor(_pool, chunks.close)
+
+
+async def _export(scope, send, query: dict):
+    """
+    The ndjson export of wsgi.export
+    """
+    since = query.get("since")
+    if since:
+        try:
+            since = parse_since(since)
+        except ValueError:
+            body = render_json({'type': "ERR", 'message': f"{since} is not an iso date."})
+            await send({'type': "http.response.start", 'status': 400,
+                        'headers': [(b"content-type", b"application/json"),
+                                    (b"content-length", str(len(body)).encode("ascii"))]})
+            await send({'type': "http.response.body", 'body': body})
+            return
+    # * one thread at a time advances the generator, but not always the same
+    chunks = export_ndjson(source.db_file, since, check_same_thread=False, trace=metrics.count_query)
+    await _stream(scope, send, metrics.timed_iter("/backend/export", chunks), b"application/x-ndjson")
+
+
+async def _lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == "lifespan.startup":
+            await send({'type': "lifespan.startup.complete"})
+        elif message['type'] == "lifespan.shutdown":
+            _pool.shutdown(wait=True)
+            if isinstance(source, SnapshotSource):
+                source.stop()
+            await send({'type': "lifespan.shutdown.complete"})
+            return
+
+
+async def _metrics_endpoint(send):
+    caches = (("render", _renders.hits, _renders.misses, len(_renders)), ("query", *source.cache_info()))
+    body = metrics.render(caches).encode("utf-8")
+    await send({'type': "http.response.start", 'status': 200,
+                'headers': [(b"content-type", b"text/plain; version=0.0.4; charset=utf-8"),
+                            (b"content-length", str(len(body)).encode("ascii"))]})
+    await send({'type': "http.response.body", 'body': body})
+
+
+async def _app(scope, receive, send):
+    if scope['type'] == "lifespan":
+        return await _lifespan(receive, send)
+    if scope['type'] != "http":
+        return  # * no websockets here
+    query = await _parameters(scope, receive)
+    if scope['path'] == "/metrics":
+        scope['santonian.route'] = "/metrics"
+        return await _metrics_endpoint(send)
+    if _export_route.fullmatch(scope['path']) and scope['method'] in ("GET", "POST", "HEAD"):
+        scope['santonian.route'] = "/backend/export"
+        return await _export(scope, send, query)
+    route = _match(scope['path'], query)
+    if route is None:
+        return await _send_simple(send, 404, b"Not Found")
+    if scope['method'] not in ("GET", "POST", "HEAD"):
+        return await _send_simple(send, 405, b"Method Not Allowed", [(b"allow", b"GET, HEAD, POST")])
+    label, key, producer = route
+    scope['santonian.route'] = label  # * for asgi_metrics
+    if (rendered := _renders.peek(key)) is None:
+        loop = asyncio.get_running_loop()
+        if key[0] == "file" and len(key) == 2:  # * full listing, too big ones are not rendered as a whole
+            if (await loop.run_in_executor(_pool, source.listing_size, key[1]) or 0) > mirror_listing_cache_max:
+                chunks = metrics.timed_iter(label, stream_json_array(source.iter_listing(key[1])))
+                return await _stream(scope, send, chunks, b"application/json")
+        rendered = await loop.run_in_executor(_pool, _renders.get, key, producer)
+    request_headers = {}
+    for name, value in scope['headers']:
+        request_headers[name.lower()] = value.decode("latin-1")
+    body, etag, coding = select_variant(rendered, request_headers.get(b"accept-encoding", ""))
+    headers = [(b"etag", f'"{etag}"'.encode("ascii")),
+               (b"cache-control", f"public, max-age={mirror_max_age}".encode("ascii"))]
+    if rendered.encoded:
+        headers.append((b"vary", b"Accept-Encoding"))
+    conditional = scope['method'] in ("GET", "HEAD")  # * like werkzeug's make_conditional
+    if conditional and etag_matches(request_headers.get(b"if-none-match", ""), etag):
+        await send({'type': "http.response.start", 'status': 304, 'headers': headers})
+        await send({'type': "http.response.body", 'body': b""})
+        return
+    headers += [(b"content-type", b"application/json"),
+                (b"content-length", str(len(body)).encode("ascii"))]
+    if coding:
+        headers.append((b"content-encoding", coding.encode("ascii")))
+    await send({'type': "http.response.start", 'status': 200, 'headers': headers})
+    await send({'type': "http.response.body", 'body': b"" if scope['method'] == "HEAD" else body})
+
+
+app = asgi_metrics(_app, metrics)
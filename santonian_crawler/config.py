@@ -13,8 +13,25 @@ req_retries = 5
 req_wait = 2.5
 _PREFIX = ""
 
+# sqlite tuning, applied by 'proc maintain' (page size) and on every connection (mmap)
+db_page_size = 4096
+db_mmap_size = 64 * 1024 * 1024  # bytes, 0 deactivates memory mapped I/O
+db_cache_size = 1024  # lookups kept by the query cache of the shell and the flask mirror
+mirror_max_age = 60  # seconds a client of the flask mirror may use a response before asking again (with its etag)
+mirror_mode = "live"  # "snapshot" serves everything from memory and reloads it when the database changes
+mirror_snapshot_interval = 5.0  # seconds between two looks at the database in snapshot mode
+mirror_compress_min = 256  # bytes, smaller bodies of the mirror are never compressed
+mirror_per_page = 200  # default page size of /backend/file/<id>?page=<n>, the full listing has no limit at all
+mirror_per_page_max = 1000  # largest per_page a client may ask for
+mirror_listing_cache_max = 5000  # folders with more logs are streamed from the cursor instead of rendered and cached
+mirror_db_workers = 8  # threads (and with them sqlite connections) of the asgi mirror, cache hits need none
+blob_folder = "blobs"  # downloaded audio files, relative to the folder the database file is in
+sparkline_chars = 64  # resolution of the stored audio sparklines, changing it makes all of them stale
+
 # database definition, don't change if you don't know what you are doing
 
+SCHEMA_VERSION = "1.0.16"
+ISO_DATE_GLOB = "[0-9][0-9][0-9][0-9]-[0-1][0-9]-[0-3][0-9]"  # date tags that can be used as in-universe date
 SHM = {}
 SHM['folders'] = f"""
                     CREATE TABLE IF NOT EXISTS {_PREFIX}folders (
@@ -33,10 +50,13 @@ SHM['log'] = f"""
                     content TEXT,
                     audio INT NOT NULL CHECK (audio in (0, 1)) DEFAULT 0,
                     aud_fl BLOB,
+                    aud_hash TEXT,
                     hash TEXT NOT NULL,
                     revision INT NOT NULL,
                     last_check TIMESTAMP NOT NULL,
-                    first_entry TIMESTAMP NOT NULL
+                    first_entry TIMESTAMP NOT NULL,
+                    stem TEXT COLLATE NOCASE,
+                    extension TEXT COLLATE NOCASE
                 );"""
 SHM['stats'] = f"""
                 CREATE TABLE IF NOT EXISTS {_PREFIX}stats (
@@ -57,9 +77,162 @@ SHM['tag_link'] = f"""
                     tag INTEGER REFERENCES {_PREFIX}tag(uid),
                     changed TIMESTAMP NOT NULL
                 );"""
+SHM['tag_link_unique'] = f"""
+                CREATE UNIQUE INDEX IF NOT EXISTS {_PREFIX}tag_link_unique
+                ON {_PREFIX}tag_link (log, tag);"""
+SHM['log_name_nocase'] = f"""
+                CREATE INDEX IF NOT EXISTS {_PREFIX}log_name_nocase
+                ON {_PREFIX}log (name COLLATE NOCASE, revision);"""
+SHM['log_stem'] = f"""
+                CREATE INDEX IF NOT EXISTS {_PREFIX}log_stem
+                ON {_PREFIX}log (stem, revision);"""
+SHM['log_date'] = f"""
+                CREATE TABLE IF NOT EXISTS {_PREFIX}log_date (
+                    log TEXT PRIMARY KEY REFERENCES {_PREFIX}log(name),
+                    day DATE NOT NULL,
+                    changed TIMESTAMP NOT NULL
+                );"""
+SHM['log_date_day'] = f"""
+                CREATE INDEX IF NOT EXISTS {_PREFIX}log_date_day
+                ON {_PREFIX}log_date (day, log);"""
+SHM['tag_term'] = f"""
+                CREATE TABLE IF NOT EXISTS {_PREFIX}tag_term (
+                    uid INTEGER PRIMARY KEY AUTOINCREMENT,
+                    term TEXT UNIQUE NOT NULL COLLATE NOCASE,
+                    tag INTEGER NOT NULL REFERENCES {_PREFIX}tag(uid),
+                    changed TIMESTAMP NOT NULL
+                );"""
+SHM['log_minhash'] = f"""
+                CREATE TABLE IF NOT EXISTS {_PREFIX}log_minhash (
+                    log TEXT PRIMARY KEY REFERENCES {_PREFIX}log(name),
+                    uid INTEGER REFERENCES {_PREFIX}log(uid),
+                    signature BLOB NOT NULL
+                );"""
+SHM['log_lsh'] = f"""
+                CREATE TABLE IF NOT EXISTS {_PREFIX}log_lsh (
+                    band INTEGER NOT NULL,
+                    bucket INTEGER NOT NULL,
+                    log TEXT NOT NULL REFERENCES {_PREFIX}log(name),
+                    PRIMARY KEY (band, bucket, log)
+                ) WITHOUT ROWID;"""
+SHM['log_lsh_log'] = f"""
+                CREATE INDEX IF NOT EXISTS {_PREFIX}log_lsh_log
+                ON {_PREFIX}log_lsh (log);"""
+SHM['artifact'] = f"""
+                CREATE TABLE IF NOT EXISTS {_PREFIX}artifact (
+                    name TEXT PRIMARY KEY,
+                    data BLOB NOT NULL,
+                    changed TIMESTAMP NOT NULL
+                );"""
+SHM['tag_link_tag'] = f"""
+                CREATE INDEX IF NOT EXISTS {_PREFIX}tag_link_tag
+                ON {_PREFIX}tag_link (tag, log);"""
+SHM['tag_cooccurrence'] = f"""
+                CREATE TABLE IF NOT EXISTS {_PREFIX}tag_cooccurrence (
+                    tag_a INTEGER NOT NULL REFERENCES {_PREFIX}tag(uid),
+                    tag_b INTEGER NOT NULL REFERENCES {_PREFIX}tag(uid),
+                    weight INTEGER NOT NULL,
+                    PRIMARY KEY (tag_a, tag_b)
+                ) WITHOUT ROWID;"""
+SHM['log_trigram'] = f"""
+                CREATE TABLE IF NOT EXISTS {_PREFIX}log_trigram (
+                    gram TEXT NOT NULL,
+                    log INTEGER NOT NULL REFERENCES {_PREFIX}log(uid),
+                    PRIMARY KEY (gram, log)
+                ) WITHOUT ROWID;"""
+SHM['audio_blob'] = f"""
+                CREATE TABLE IF NOT EXISTS {_PREFIX}audio_blob (
+                    hash TEXT PRIMARY KEY,
+                    size INTEGER NOT NULL,
+                    source TEXT,
+                    first_entry TIMESTAMP NOT NULL
+                );"""
+SHM['log_aud_hash'] = f"""
+                CREATE INDEX IF NOT EXISTS {_PREFIX}log_aud_hash
+                ON {_PREFIX}log (aud_hash);"""
+SHM['audio_sparkline'] = f"""
+                CREATE TABLE IF NOT EXISTS {_PREFIX}audio_sparkline (
+                    hash TEXT PRIMARY KEY REFERENCES {_PREFIX}audio_blob(hash),
+                    line TEXT NOT NULL,
+                    chars INTEGER NOT NULL,
+                    changed TIMESTAMP NOT NULL
+                );"""
+SHM['log_folder'] = f"""
+                CREATE INDEX IF NOT EXISTS {_PREFIX}log_folder
+                ON {_PREFIX}log (folder, uid);"""
+SHM['log_name_uid'] = f"""
+                CREATE INDEX IF NOT EXISTS {_PREFIX}log_name_uid
+                ON {_PREFIX}log (name, uid);"""
 SHM['insert1'] = f"""
                 INSERT INTO {_PREFIX}stats
                 (property, value)
-                VALUES ('schema_version', '1.0.4')
+                VALUES ('schema_version', '{SCHEMA_VERSION}')
                 """
 
+# upgrade path for databases created by older versions, executed in order for every version newer than the one
+# found in the stats table, each list has to bring the database to the state a fresh SHM would create
+SHM_UPGRADE = {}
+SHM_UPGRADE['1.0.5'] = [
+    f"""DELETE FROM {_PREFIX}tag_link
+        WHERE uid NOT IN (SELECT MIN(uid) FROM {_PREFIX}tag_link GROUP BY log, tag);""",
+    SHM['tag_link_unique']
+]
+SHM_UPGRADE['1.0.6'] = [
+    f"ALTER TABLE {_PREFIX}log ADD COLUMN stem TEXT COLLATE NOCASE;",
+    f"ALTER TABLE {_PREFIX}log ADD COLUMN extension TEXT COLLATE NOCASE;",
+    # same split as santonian.split_log_name, everything before the first dot is the stem
+    f"""UPDATE {_PREFIX}log
+        SET stem = CASE WHEN instr(name, '.') > 0 THEN substr(name, 1, instr(name, '.') - 1) ELSE name END,
+            extension = CASE WHEN instr(name, '.') > 0 THEN substr(name, instr(name, '.') + 1) ELSE '' END;""",
+    SHM['log_name_nocase'],
+    SHM['log_stem']
+]
+SHM_UPGRADE['1.0.7'] = [
+    SHM['log_date'],
+    SHM['log_date_day'],
+    # the earliest date tag of every log, as long as it actually looks like an iso date
+    f"""INSERT OR IGNORE INTO {_PREFIX}log_date (log, day, changed)
+        SELECT {_PREFIX}tag_link.log, MIN({_PREFIX}tag.name), datetime('now')
+        FROM {_PREFIX}tag_link
+        INNER JOIN {_PREFIX}tag ON {_PREFIX}tag_link.tag = {_PREFIX}tag.uid
+        WHERE {_PREFIX}tag.type = 'date' AND {_PREFIX}tag.name GLOB '{ISO_DATE_GLOB}'
+        GROUP BY {_PREFIX}tag_link.log;"""
+]
+SHM_UPGRADE['1.0.8'] = [
+    SHM['tag_term']
+]
+SHM_UPGRADE['1.0.9'] = [
+    SHM['log_minhash'],
+    SHM['log_lsh'],
+    SHM['log_lsh_log']
+]
+SHM_UPGRADE['1.0.10'] = [
+    SHM['artifact']
+]
+SHM_UPGRADE['1.0.11'] = [
+    SHM['tag_link_tag'],
+    SHM['tag_cooccurrence'],
+    # every pair of tags sharing a log, stored in both directions
+    f"""INSERT OR IGNORE INTO {_PREFIX}tag_cooccurrence (tag_a, tag_b, weight)
+        SELECT a.tag, b.tag, COUNT(*)
+        FROM {_PREFIX}tag_link AS a
+        INNER JOIN {_PREFIX}tag_link AS b ON a.log = b.log AND a.tag != b.tag
+        GROUP BY a.tag, b.tag;"""
+]
+SHM_UPGRADE['1.0.12'] = [
+    SHM['log_trigram']
+]
+SHM_UPGRADE['1.0.13'] = [
+    f"ALTER TABLE {_PREFIX}log ADD COLUMN aud_hash TEXT;",
+    SHM['audio_blob'],
+    SHM['log_aud_hash']
+]
+SHM_UPGRADE['1.0.14'] = [
+    SHM['audio_sparkline']
+]
+SHM_UPGRADE['1.0.15'] = [
+    SHM['log_folder']
+]
+SHM_UPGRADE['1.0.16'] = [
+    SHM['log_name_uid']
+]
@@ -20,19 +20,195 @@
 #
 # @license GPL-3.0-only <https://www.gnu.org/licenses/gpl-3.0.en.html>
 
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
-from time import sleep
+from functools import wraps, lru_cache
+import io
+from time import sleep, perf_counter
 import logging
 import os
+import re
 import sqlite3
+import numpy
 # * this package
-from santonian_crawler.util import sha256_string, find_date
-from santonian_crawler.config import _PREFIX, SHM, api_calls, req_retries, req_wait
+from santonian_crawler.util import sha256_string, find_date, AhoCorasick, minhash_signature, lsh_buckets, \
+    estimated_similarity, tfidf_matrix, cosine_top_k, trigrams, regex_literals, check_for_mp3_link, \
+    audio_file_sparkline, LSH_THRESHOLD
+from santonian_crawler.config import _PREFIX, SHM, SHM_UPGRADE, SCHEMA_VERSION, ISO_DATE_GLOB, api_calls, \
+    req_retries, req_wait, db_page_size, db_mmap_size, blob_folder, sparkline_chars
 import santonian_crawler.santonian as santonian
 
 logger = logging.getLogger(__name__)
 
 
+class QueryCache:
+    """
+    Bounded least recently used cache for the read only lookups of SantonianDB. Every entry is only valid for one
+    database state, a state is whatever SantonianDB._cache_state returns, as soon as it differs the whole cache is
+    dropped. Keeps count of hits and misses for anyone who wants to know if all of this is worth it
+    """
+    def __init__(self, max_size=1024):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._state = None
+
+    def validate(self, state):
+        """
+        Drops every entry if the given database state differs from the one the entries were created with
+
+        :param state: any comparable value that changes whenever the database does
+        """
+        if state != self._state:
+            self._entries.clear()
+            self._state = state
+
+    def get(self, key):
+        """
+        :return: tuple of (found, value), a cached None is a perfectly valid value
+        """
+        if key in self._entries:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return True, self._entries[key]
+        self.misses += 1
+        return False, None
+
+    def put(self, key, value):
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        self._entries.clear()
+        self._state = None
+
+    def info(self) -> dict:
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self._entries), 'max_size': self.max_size}
+
+
+def _cached(method):
+    """
+    Decorator for SantonianDB lookups that should go through the query cache if there is one, dictionaries (or lists
+    of them) and LogHandles are handed out as shallow copies so a caller cannot accidentally change the cached value
+    """
+    def detach(value):
+        if isinstance(value, LogHandle):
+            return value.copy()
+        if isinstance(value, dict):
+            return dict(value)
+        if isinstance(value, list):
+            return [dict(x) if isinstance(x, dict) else x for x in value]
+        return value
+
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if self.cache is None:
+            return method(self, *args, **kwargs)
+        key = (method.__name__, args, tuple(sorted(kwargs.items())))
+        self.cache.validate(self._cache_state())
+        found, value = self.cache.get(key)
+        if not found:
+            value = method(self, *args, **kwargs)
+            self.cache.validate(self._cache_state())  # the lookup itself might have written (get_folder_uid)
+            self.cache.put(key, value)
+        return detach(value)
+    return wrapper
+
+
+class LogHandle:
+    """
+    Lazy view on a single log, the newest revision is loaded right away, older ones only exist as a bit of metadata
+    until somebody actually asks for them via revision(), which then loads and keeps that one body
+    """
+    __slots__ = ("_backend", "name", "newest", "_revisions", "_bodies")
+
+    def __init__(self, backend, newest: dict, revisions: list):
+        """
+        :param SantonianDB backend: database the older revisions are loaded from
+        :param dict newest: full newest revision, same keys as the old get_log_content dictionary
+        :param list revisions: list of (uid, revision) tuples, newest first
+        """
+        self._backend = backend
+        self.name = newest['name']
+        self.newest = newest
+        self._revisions = revisions
+        self._bodies = {revisions[0][0]: newest} if revisions else {}
+
+    def __repr__(self):
+        return f"<LogHandle {self.name} rev:{self.newest['revision']} of {self.revision_count}>"
+
+    def copy(self):
+        """
+        Independent handle for the same log, revisions loaded so far come along, later ones are only loaded into
+        the handle that asked for them
+        """
+        handle = LogHandle(self._backend, dict(self.newest), list(self._revisions))
+        for uid, body in self._bodies.items():
+            if uid not in handle._bodies:
+                handle._bodies[uid] = dict(body) if body is not None else None
+        return handle
+
+    @property
+    def revision_count(self) -> int:
+        return len(self._revisions)
+
+    @property
+    def revisions(self) -> list:
+        """
+        :return: all revision numbers, newest first
+        """
+        return [rev for _, rev in self._revisions]
+
+    def revision(self, number: int) -> dict or None:
+        """
+        :param int number: revision number as stored in the database
+        :return: full dictionary of that revision, loaded on first access, None if there is no such revision
+        """
+        for uid, rev in self._revisions:
+            if rev == number:
+                if uid not in self._bodies:
+                    self._bodies[uid] = self._backend._load_log_revision(uid)
+                return self._bodies[uid]
+        return None
+
+
+@lru_cache(maxsize=None)
+def _row_type(columns: tuple):
+    """
+    One tuple backed record type per projection, created once and reused for every row of every later query
+    """
+    return namedtuple("LogRow", columns)
+
+
+ProcedureSpec = namedtuple("ProcedureSpec", ("name", "func", "columns", "description", "prepare"),
+                           defaults=(None, ))
+_PROCEDURES = {}
+
+
+def register_procedure(name: str, columns=("uid", "name", "content"), description="", prepare=None):
+    """
+    Decorator that puts a function into the procedure registry of SantonianDB. SantonianDB.run_procedure calls it
+    as func(db, rows) with batches of LogRows (see iter_logs) that only contain logs added since the last run, the
+    function returns a dictionary of whatever it changed. Works for methods of SantonianDB as well as for any plain
+    function defined elsewhere
+
+    :param str name: unique name of the procedure, also used for its stats entries
+    :param tuple columns: log columns the procedure needs, 'uid' is always added
+    :param str description: one line for the shell
+    :param prepare: optional prepare(db, watermark) that runs before the batches, for procedures whose own input
+                    (a dictionary for example) changed for logs below the watermark, returns a dict of changes too
+    """
+    def register(func):
+        needed = tuple(columns) if "uid" in columns else ("uid", ) + tuple(columns)
+        _PROCEDURES[name] = ProcedureSpec(name, func, needed, description, prepare)
+        return func
+    return register
+
+
 class SantonianDB:
     """
     Abstraction Layer for the santonian database, provides methods to access data without the need to directly use
@@ -40,22 +216,32 @@ class SantonianDB:
 
     Will create a new database upon start if the provided file path does not exist
     """
-    def __init__(self, db_file="santonian.db", check_same_thread=True):
+    procedures = _PROCEDURES  # * every analysis pass that run_procedure knows about, see register_procedure
+
+    def __init__(self, db_file="santonian.db", check_same_thread=True, cache_size=0):
         """
 
         :param str db_file: path to the sqlite3 database file, if not existing, a new one will be created
         :param bool check_same_thread: POTENTIALLY DANGEROUS, deactivates thread safety, is PIL our friend?
+        :param int cache_size: number of lookups kept by the query cache, 0 deactivates it
         """
         self.__pre = _PREFIX
+        self.db_file = db_file
+        self.cache = QueryCache(cache_size) if cache_size > 0 else None
+        self._matchers = {}  # * term state -> AhoCorasick, the automaton outlives the batches of one run
+        self._artifacts = {}  # * name -> (changed, arrays), see _load_artifact
+        self.blob_dir = os.path.join(os.path.dirname(os.path.abspath(db_file)), blob_folder)
         if not os.path.exists(db_file):
             self.db = sqlite3.connect(db_file, check_same_thread=check_same_thread)
             self.cur = self.db.cursor()
             self._create_scheme()
             self.db.close()
         try:
-            self.db = sqlite3.connect(f"file:{db_file}?mode=rw", uri=True)
+            self.db = sqlite3.connect(f"file:{db_file}?mode=rw", uri=True, check_same_thread=check_same_thread)
             self.db.row_factory = sqlite3.Row  # ! changes behaviour of all future cursors
             self.cur = self.db.cursor()
+            self.cur.execute(f"PRAGMA mmap_size = {int(db_mmap_size)};")
+            self._upgrade_scheme()
         except sqlite3.OperationalError as err:
             logger.error(f"Error while opening database file: {err}")
 
@@ -66,19 +252,56 @@ class SantonianDB:
         """
         self.db.close()
 
+    def _cache_state(self) -> tuple:
+        """
+        data_version changes whenever another connection commits something, total_changes covers our own writes
+
+        :return: tuple that changes whenever the database content might have
+        """
+        return self.db.execute("PRAGMA data_version;").fetchone()[0], self.db.total_changes
+
+    def cache_info(self) -> dict:
+        """
+        :return: hits, misses, size and max_size of the query cache, None if there is no cache
+        :rtype: dict or None
+        """
+        return self.cache.info() if self.cache else None
+
     def _create_scheme(self):
+        # * both only take effect before the first table exists, later on only a VACUUM can change them
+        self.cur.execute(f"PRAGMA page_size = {int(db_page_size)};")
+        self.cur.execute("PRAGMA auto_vacuum = INCREMENTAL;")
         for value in SHM.values():
             self.cur.execute(value)
         self.db.commit()
 
+    def _upgrade_scheme(self):
+        """
+        Brings databases of older versions up to the current scheme by executing every step in SHM_UPGRADE that is
+        newer than the 'schema_version' stat, does nothing for an up to date database
+        """
+        def as_tuple(version: str) -> tuple:
+            return tuple(int(x) for x in version.split("."))
+        row = self.cur.execute(f"SELECT value FROM {self.__pre}stats WHERE property = 'schema_version';").fetchone()
+        current = as_tuple(row['value']) if row else (0, )
+        if current >= as_tuple(SCHEMA_VERSION):
+            return
+        for version, statements in SHM_UPGRADE.items():
+            if as_tuple(version) <= current:
+                continue
+            logger.info(f"DB>upgrade: migrating scheme to {version}")
+            for statement in statements:
+                self.cur.execute(statement)
+            self.update_stat("schema_version", version)  # commits every version on its own
+
     def insert_text_log(self, content: str, name: str, folder_name: str):
         temp_hash = sha256_string(content)
         query = f"""SELECT 
                         uid, name, hash, revision
                     FROM {self.__pre}log
-                    WHERE name = '{name}'
+                    WHERE name = ?
                     ORDER BY revision DESC;"""
-        rows = self.cur.execute(query).fetchall()
+        rows = self.cur.execute(query, [name]).fetchall()
         if len(rows) > 0:
             if rows[0]['hash'] == temp_hash:
                 self._touch_log(rows[0]['uid'])
@@ -86,23 +309,182 @@ class SantonianDB:
         else:
             if (folder_id := self.get_folder_uid(folder_name)) is None:
                 return False
+            stem, _, extension = name.partition(".")  # * same split as the 1.0.6 upgrade does in sql
             data = (name,
                     folder_id,
                     content,
                     temp_hash,
                     0,
                     datetime.now(),
-                    datetime.now())
+                    datetime.now(),
+                    stem,
+                    extension)
             query = f"""INSERT INTO {self.__pre}log
-                        (name, folder, content, hash, revision, last_check, first_entry)
-                        VALUES (?, ?, ?, ?, ?, ?, ?);"""
+                        (name, folder, content, hash, revision, last_check, first_entry, stem, extension)
+                        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?);"""
             self.cur.execute(query, data)
+            self._index_trigrams(self.cur.lastrowid, content)
             self.db.commit()
 
+    def insert_audio_log(self, url: str, name: str, folder_name: str) -> str or bool:
+        """
+        Audio counterpart of insert_text_log, the body of an audio log is the link to its mp3. The file is streamed
+        into the blob store next to the database and the log only references it by its sha256, a log whose link
+        did not change is only touched and not downloaded again, a changed link becomes a new revision
+
+        :param str url: link to the mp3, the body of the log
+        :param str name: full name of the log
+        :param str folder_name: folder the log belongs to
+        :return: sha256 of the audio file, False if the folder is unknown or the download failed
+        :rtype: str or bool
+        """
+        _ = self.__pre
+        query = f"""SELECT uid, hash, aud_hash, revision
+                    FROM {_}log
+                    WHERE name = ?
+                    ORDER BY revision DESC;"""
+        rows = self.cur.execute(query, [name]).fetchall()
+        if len(rows) > 0 and rows[0]['hash'] == sha256_string(url) and rows[0]['aud_hash']:
+            self._touch_log(rows[0]['uid'])
+            return rows[0]['aud_hash']
+        if (folder_id := self.get_folder_uid(folder_name)) is None:
+            return False
+        status, blob = santonian.download_audio(url, self.blob_dir)
+        if not status:
+            logger.warning(f"DB>insert_audio_log: download of '{url}' failed: {blob}")
+            return False
+        self.cur.execute(f"""INSERT OR IGNORE INTO {_}audio_blob (hash, size, source, first_entry)
+                             VALUES (?, ?, ?, ?);""", (blob['hash'], blob['size'], url, datetime.now()))
+        if len(rows) > 0 and rows[0]['hash'] == sha256_string(url):  # * same link, only the file was missing
+            self.cur.execute(f"UPDATE {_}log SET aud_hash = ?, last_check = ? WHERE uid = ?;",
+                             (blob['hash'], datetime.now(), rows[0]['uid']))
+        else:  # * a new log or a changed link, the old revision keeps its link and its file
+            stem, _sep, extension = name.partition(".")
+            query = f"""INSERT INTO {_}log
+                        (name, folder, content, audio, aud_hash, hash, revision, last_check, first_entry, stem,
+                         extension)
+                        VALUES (?, ?, ?, 1, ?, ?, ?, ?, ?, ?, ?);"""
+            revision = rows[0]['revision'] + 1 if rows else 0
+            self.cur.execute(query, (name, folder_id, url, blob['hash'], sha256_string(url), revision, datetime.now(),
+                                     datetime.now(), stem, extension))
+            self._index_trigrams(self.cur.lastrowid, url)
+        self.db.commit()
+        return blob['hash']
+
+    def get_audio(self, log_name: str) -> dict or None:
+        """
+        The stored audio file of a log
+
+        :param str log_name: name of the log, case insensitive
+        :return: {'hash': str, 'size': int, 'path': str, 'sparkline': str or None} or None if the log has no
+                 downloaded audio, the sparkline is the stored high resolution form
+        :rtype: dict or None
+        """
+        _ = self.__pre
+        query = f"""SELECT {_}audio_blob.hash as hash, size, line
+                    FROM {_}log
+                    INNER JOIN {_}audio_blob ON {_}audio_blob.hash = {_}log.aud_hash
+                    LEFT JOIN {_}audio_sparkline ON {_}audio_sparkline.hash = {_}audio_blob.hash
+                    WHERE name = ? COLLATE NOCASE
+                    ORDER BY revision DESC
+                    LIMIT 1;"""
+        if not (row := self.cur.execute(query, [log_name]).fetchone()):
+            return None
+        return {'hash': row['hash'], 'size': row['size'], 'path': santonian.blob_path(self.blob_dir, row['hash']),
+                'sparkline': row['line']}
+
+    def procedure_sparklines(self, full=False, workers=None) -> dict:
+        """
+        Computes the sparkline of every stored audio file that has none yet or one of another resolution than
+        config.sparkline_chars. Keyed by the sha256 of the audio, logs sharing a file share the sparkline. The
+        decoding and ffts run in a process pool, only the storing happens here
+
+        :param bool full: computes all of them again
+        :param int workers: size of the process pool, None for one per cpu, 1 does everything in this process
+        :return: {'processed': int, 'failed': int, 'duration': seconds}, failed files are tried again next time
+        :rtype: dict
+        """
+        _ = self.__pre
+        time_zero = perf_counter()
+        query = f"""SELECT {_}audio_blob.hash as hash
+                    FROM {_}audio_blob
+                    LEFT JOIN {_}audio_sparkline ON {_}audio_sparkline.hash = {_}audio_blob.hash
+                    WHERE ? OR {_}audio_sparkline.chars IS NULL OR {_}audio_sparkline.chars != ?;"""
+        hashes = [row['hash'] for row in self.cur.execute(query, (full, sparkline_chars)).fetchall()]
+        paths = [santonian.blob_path(self.blob_dir, x) for x in hashes]
+        if workers == 1 or len(paths) <= 1:
+            lines = [audio_file_sparkline(x, sparkline_chars) for x in paths]
+        else:
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                lines = list(pool.map(audio_file_sparkline, paths, [sparkline_chars] * len(paths)))
+        done = [(digest, line, sparkline_chars, datetime.now()) for digest, line in zip(hashes, lines) if line]
+        self.cur.executemany(f"""INSERT OR REPLACE INTO {_}audio_sparkline (hash, line, chars, changed)
+                                 VALUES (?, ?, ?, ?);""", done)
+        self.db.commit()
+        if done or not self.cur.execute(f"SELECT 1 FROM {_}artifact WHERE name = 'audio_fingerprint';").fetchone():
+            self.procedure_fingerprints()
+        report = {'processed': len(done), 'failed': len(hashes) - len(done), 'duration': perf_counter() - time_zero}
+        self.update_stat("proc_sparklines_last_run", datetime.now())
+        self.update_stat("proc_sparklines_duration", f"{report['duration']:.4f}")
+        return report
+
+    def procedure_fingerprints(self) -> int:
+        """
+        Turns every stored sparkline into a fingerprint vector for similar_audio, the loudness levels of the
+        sparkline minus their mean and divided by their spread, so only the shape counts and not the volume. All
+        vectors go into one matrix stored as artifact, called by procedure_sparklines whenever something changed
+
+        :return: number of fingerprints
+        :rtype: int
+        """
+        rows = self.cur.execute(f"SELECT hash, line FROM {self.__pre}audio_sparkline WHERE chars = ? ORDER BY hash;",
+                                [sparkline_chars]).fetchall()
+        vectors = numpy.array([[ord(c) - 31 for c in row['line']] for row in rows], dtype=numpy.float32)
+        vectors = vectors.reshape(len(rows), sparkline_chars - 1)
+        vectors -= vectors.mean(axis=1, keepdims=True)
+        spread = numpy.linalg.norm(vectors, axis=1, keepdims=True)
+        vectors /= numpy.where(spread > 0, spread, 1)
+        self._store_artifact("audio_fingerprint", {'hashes': numpy.array([row['hash'] for row in rows], dtype=str),
+                                                   'vectors': vectors})
+        return len(rows)
+
+    def similar_audio(self, log_name: str, limit=5) -> list:
+        """
+        The audio logs that sound most alike, euclidean distance between the fingerprints of their sparklines, all
+        distances in one go over the whole fingerprint matrix. Logs that share the very same file have distance 0
+
+        :param str log_name: name of the log, case insensitive
+        :param int limit: number of results
+        :return: list of dictionaries, eg: [{'name': 'PLD-101-K.AUD', 'distance': 0.21}], closest first, empty
+                 if the log has no fingerprint
+        :rtype: list
+        """
+        _ = self.__pre
+        if not (audio := self.get_audio(log_name)) or not (index := self._load_artifact("audio_fingerprint")):
+            return []
+        if "rows" not in index:  # * hash lookup table, built once per loaded index
+            index['rows'] = {str(digest): i for i, digest in enumerate(index['hashes'])}
+        if (row := index['rows'].get(audio['hash'])) is None:
+            return []
+        distance = numpy.linalg.norm(index['vectors'] - index['vectors'][row], axis=1)
+        k = min(limit + 1, len(distance))  # * the log itself is among them
+        closest = numpy.argpartition(distance, k - 1)[:k]
+        closest = closest[numpy.argsort(distance[closest])]
+        query = f"""SELECT name, aud_hash
+                    FROM {_}log
+                    WHERE aud_hash IN ({', '.join('?' * len(closest))}) AND name != ? COLLATE NOCASE
+                    GROUP BY name;"""
+        by_hash = {}
+        for found in self.cur.execute(query, [str(index['hashes'][i]) for i in closest] + [log_name]).fetchall():
+            by_hash.setdefault(found['aud_hash'], []).append(found['name'])
+        result = [{'name': name, 'distance': round(float(distance[i]), 3)}
+                  for i in closest for name in sorted(by_hash.get(str(index['hashes'][i]), []))]
+        return result[:limit]
+
     def _touch_log(self, uid: int):
         query = f"""UPDATE {self.__pre}log
                    SET last_check = ?
-                   WHERE id = ?;"""
+                   WHERE uid = ?;"""
         self.cur.execute(query, (datetime.now(), uid))
         self.db.commit()
 
@@ -145,6 +527,7 @@ class SantonianDB:
         except sqlite3.IntegrityError:
             logger.warning(f"DB>InsFolder: unique constraints violated (despite checks?)")
 
+    @_cached
     def get_folder_uid(self, input_str: str or int, no_create=False):
         # ! change this to return UID instead of id
         """
@@ -219,6 +602,7 @@ class SantonianDB:
                 logger.info(f"DB>getFileId: {line['uid']} - {line['file_id']} / {line['name']}")
             return None
 
+    @_cached
     def get_folder_santa_id(self, name: str) -> None or int:
         """
         Returns the internal, original santonian database id of a given name..if it exists
@@ -234,6 +618,7 @@ class SantonianDB:
         else:
             return None
 
+    @_cached
     def get_folder_by_santa_id(self, santa_id: int) -> None or str:
         """
         Another of those functions that only exist to mimic the real API
@@ -250,6 +635,7 @@ class SantonianDB:
         else:
             return None
 
+    @_cached
     def get_log_content(self, logname: str):
         _ = self.__pre
         query = f"""SELECT {_}log.name as name, 
@@ -263,10 +649,10 @@ class SantonianDB:
                     INNER JOIN {_}folders on {_}log.folder = {_}folders.uid
                     LEFT JOIN {_}tag_link on {_}log.name = {_}tag_link.log
                     LEFT JOIN {_}tag on {_}tag_link.tag = {_}tag.uid
-                    WHERE {_}log.name LIKE '{logname}'
+                    WHERE {_}log.name = ? COLLATE NOCASE
                     GROUP BY {_}log.name, {_}log.revision
                     ORDER BY revision DESC;"""
-        rows = self.cur.execute(query).fetchall()
+        rows = self.cur.execute(query, [logname]).fetchall()
         len_rows = len(rows)
         if len_rows <= 0:
             return None
@@ -278,6 +664,53 @@ class SantonianDB:
         else:
             return {key: rows[0][key] for key in rows[0].keys()}
 
+    @_cached
+    def get_log(self, logname: str) -> LogHandle or None:
+        """
+        Cheaper alternative to get_log_content, only the newest revision is read in full, older revisions are
+        loaded by the returned handle once they are accessed
+
+        :param str logname: name of the log, case insensitive
+        :return: a LogHandle or None if there is no such log
+        :rtype: LogHandle or None
+        """
+        newest = self.cur.execute(self._log_revision_query(f"{self.__pre}log.name = ? COLLATE NOCASE", "LIMIT 1"),
+                                  [logname]).fetchone()
+        if not newest:
+            return None
+        query = f"""SELECT uid, revision
+                    FROM {self.__pre}log
+                    WHERE name = ?
+                    ORDER BY revision DESC, uid DESC;"""
+        revisions = [(x['uid'], x['revision']) for x in self.cur.execute(query, [newest['name']]).fetchall()]
+        return LogHandle(self, {key: newest[key] for key in newest.keys() if key != "uid"}, revisions)
+
+    def _load_log_revision(self, uid: int) -> dict or None:
+        row = self.cur.execute(self._log_revision_query(f"{self.__pre}log.uid = ?"), [uid]).fetchone()
+        return {key: row[key] for key in row.keys() if key != "uid"} if row else None
+
+    def _log_revision_query(self, condition: str, limit="") -> str:
+        _ = self.__pre
+        return f"""SELECT {_}log.uid as uid,
+                          {_}log.name as name,
+                          {_}folders.name as folder,
+                          content,
+                          audio,
+                          aud_hash,
+                          (SELECT line FROM {_}audio_sparkline WHERE hash = {_}log.aud_hash) as sparkline,
+                          {_}log.last_check as last_check,
+                          revision,
+                          (SELECT COALESCE(group_concat({_}tag.name, ', '), '')
+                           FROM {_}tag_link
+                           INNER JOIN {_}tag ON {_}tag_link.tag = {_}tag.uid
+                           WHERE {_}tag_link.log = {_}log.name) as tags
+                   FROM {_}log
+                   INNER JOIN {_}folders on {_}log.folder = {_}folders.uid
+                   WHERE {condition}
+                   ORDER BY revision DESC, {_}log.uid DESC
+                   {limit};"""
+
+    @_cached
     def get_log_name_extension_blind(self, log_name: str) -> str:
         """
         middleware function that gets the name of a log regardless of extension, used to mimic santonian website
@@ -286,13 +719,25 @@ class SantonianDB:
         :return: Name of the log or an empty string
         :rtype: str
         """
-        query = f"SELECT name FROM {self.__pre}log WHERE name LIKE ? ORDER BY revision DESC LIMIT 1"
-        result = self.cur.execute(query, [f"{log_name}____"]).fetchone()
+        query = f"SELECT name FROM {self.__pre}log WHERE stem = ? ORDER BY revision DESC LIMIT 1"
+        result = self.cur.execute(query, [log_name]).fetchone()
         if result:
             return result['name']
         else:
             return ""
 
+    def get_stat(self, key: str, default=None) -> str or None:
+        """
+        Reads a singular named stat from the database
+
+        :param key: unique key
+        :param default: returned if there is no such stat
+        :return: the value as string or the default
+        """
+        query = f"""SELECT value FROM {self.__pre}stats WHERE property = ?;"""
+        row = self.cur.execute(query, [key]).fetchone()
+        return row['value'] if row else default
+
     def update_stat(self, key: str, value: str) -> False:
         """
         Updates a singular named stat in the database (or creates it if it does not exist)
@@ -311,7 +756,7 @@ class SantonianDB:
                         WHERE uid = ?;"""
             self.cur.execute(query, (str(value), check['uid']))
         else:
-            query = f""""INSERT INTO {self.__pre}stats
+            query = f"""INSERT INTO {self.__pre}stats
                          (property, value)
                          VALUES (?, ?);"""
             self.cur.execute(query, (key, str(value)))
@@ -374,59 +819,734 @@ class SantonianDB:
             return False
         query = f"""SELECT name 
                     FROM {self.__pre}log
-                    WHERE name LIKE ?;"""  # like to ignore casesensivity
+                    WHERE name = ? COLLATE NOCASE;"""  # served by the log_name_nocase index
         log = self.cur.execute(query, [file_name]).fetchone()
         if not log:
             logger.warning(f"DB>tag_file: could not locate file with name '{file_name}'")
             return None
-        # * creating of link
-        # ! TODO: check for duplicate
-        query = f"""INSERT INTO {self.__pre}tag_link
+        # * creating of link, the unique index on (log, tag) swallows duplicates
+        self.tag_files([(log['name'], tag_name)])
+        return True
+
+    def tag_files(self, pairs) -> int:
+        """
+        Bulk version of tag_file, resolves all names in one go instead of two selects per link and commits only
+        once at the end. Log names are matched case insensitive, tag names exactly, pairs that already exist are
+        ignored without complaint, pairs with an unknown tag or log are skipped and counted in the log output
+
+        :param pairs: iterable of (file_name, tag_name) tuples
+        :return: number of newly created links
+        :rtype: int
+        """
+        _ = self.__pre
+        self.cur.execute("CREATE TEMP TABLE IF NOT EXISTS tag_pairs (log TEXT, tag TEXT);")
+        self.cur.execute("DELETE FROM temp.tag_pairs;")
+        self.cur.executemany("INSERT INTO temp.tag_pairs (log, tag) VALUES (?, ?);", pairs)
+        query = f"""SELECT COUNT(*) as num
+                    FROM temp.tag_pairs AS pair
+                    WHERE NOT EXISTS (SELECT 1 FROM {_}tag WHERE {_}tag.name = pair.tag)
+                       OR NOT EXISTS (SELECT 1 FROM {_}log WHERE {_}log.name = pair.log COLLATE NOCASE);"""
+        if missing := self.cur.execute(query).fetchone()['num']:
+            logger.warning(f"DB>tag_files: {missing} pairs with unknown log or tag were skipped")
+        # * links that do not exist yet, they are needed once more for the co-occurrence weights
+        self.cur.execute("CREATE TEMP TABLE IF NOT EXISTS new_links (log TEXT, tag INTEGER, PRIMARY KEY (log, tag));")
+        self.cur.execute("DELETE FROM temp.new_links;")
+        query = f"""INSERT OR IGNORE INTO temp.new_links
+                    (log, tag)
+                    SELECT {_}log.name, {_}tag.uid
+                    FROM temp.tag_pairs AS pair
+                    INNER JOIN {_}tag ON {_}tag.name = pair.tag
+                    INNER JOIN {_}log ON {_}log.name = pair.log COLLATE NOCASE
+                    WHERE NOT EXISTS (SELECT 1 FROM {_}tag_link
+                                      WHERE {_}tag_link.log = {_}log.name AND {_}tag_link.tag = {_}tag.uid);"""
+        self.cur.execute(query)
+        before = self.db.total_changes
+        query = f"""INSERT OR IGNORE INTO {_}tag_link
                     (log, tag, changed)
-                    VALUES (?, ?, ?);"""
-        self.cur.execute(query, (log['name'], tag['uid'], datetime.now()))
+                    SELECT log, tag, ? FROM temp.new_links;"""
+        self.cur.execute(query, [datetime.now()])
+        created = self.db.total_changes - before
+        if created:
+            self._update_cooccurrence()
+        # * the first date tag of a log also becomes its in-universe date
+        query = f"""INSERT OR IGNORE INTO {_}log_date
+                    (log, day, changed)
+                    SELECT {_}log.name, MIN({_}tag.name), ?
+                    FROM temp.tag_pairs AS pair
+                    INNER JOIN {_}tag ON {_}tag.name = pair.tag
+                    INNER JOIN {_}log ON {_}log.name = pair.log COLLATE NOCASE
+                    WHERE {_}tag.type = 'date' AND {_}tag.name GLOB ?
+                    GROUP BY {_}log.name;"""
+        self.cur.execute(query, (datetime.now(), ISO_DATE_GLOB))
+        self.cur.execute("DELETE FROM temp.tag_pairs;")
+        self.cur.execute("DELETE FROM temp.new_links;")
         self.db.commit()
-        return True
+        return created
+
+    def _update_cooccurrence(self):
+        """
+        Adds the links in temp.new_links to the co-occurrence weights, only touches the rows of the tags that are
+        involved instead of counting everything again. A new link pairs with every other tag of its log, the old
+        tags of that log need the reverse direction as well, pairs of two new links already come up twice
+        """
+        _ = self.__pre
+        # * the WHERE TRUE is needed, sqlite cannot tell an upsert ON CONFLICT apart from a join ON otherwise
+        query = f"""INSERT INTO {_}tag_cooccurrence
+                    (tag_a, tag_b, weight)
+                    SELECT fresh.tag, link.tag, COUNT(*)
+                    FROM temp.new_links AS fresh
+                    INNER JOIN {_}tag_link AS link ON link.log = fresh.log AND link.tag != fresh.tag
+                    WHERE TRUE
+                    GROUP BY fresh.tag, link.tag
+                    ON CONFLICT (tag_a, tag_b) DO UPDATE SET weight = weight + excluded.weight;"""
+        self.cur.execute(query)
+        query = f"""INSERT INTO {_}tag_cooccurrence
+                    (tag_a, tag_b, weight)
+                    SELECT link.tag, fresh.tag, COUNT(*)
+                    FROM temp.new_links AS fresh
+                    INNER JOIN {_}tag_link AS link ON link.log = fresh.log AND link.tag != fresh.tag
+                    WHERE NOT EXISTS (SELECT 1 FROM temp.new_links AS other
+                                      WHERE other.log = link.log AND other.tag = link.tag)
+                    GROUP BY link.tag, fresh.tag
+                    ON CONFLICT (tag_a, tag_b) DO UPDATE SET weight = weight + excluded.weight;"""
+        self.cur.execute(query)
 
     # ? complex procedures that do things
     def procedure_tag_date(self) -> dict:
         """
         Goes over all logs that do not have a date tag already assigned to them and tags them with a date
-        extracted from the text, uses first occurence of a match, only is date precise, not by the hour
+        extracted from the text, uses first occurence of a match, only is date precise, not by the hour. Only
+        looks at logs added since the last run, see run_procedure
 
         :return: a dictionary of newly tagged entries with dates, format {log_name: date_tag}
         :rtype: dict
         """
-        # * retrieving all logs that do not posses a tag of type date, i would appreciate help here, as i lag the
-        # * sql skill to actually extract all entries i want, which would be "do not have date tag or no tag at all"
-        filter_tag_type = "date"
+        return self.run_procedure("date_tag")['changes']
+
+    @register_procedure("date_tag", ("uid", "name", "content"),
+                        "puts a date tag on each log that does not posess a date tag yet, uses first date it finds")
+    def _procedure_date_tag(self, rows) -> dict:
         _ = self.__pre
-        # select tags that DO have a date tag
-        query = f"""SELECT DISTINCT {_}log.name as name FROM {_}log
-                    INNER JOIN {_}tag_link ON log.name = {_}tag_link.log
+        names = list({row.name for row in rows})
+        # * only the logs of this batch that DO have a date tag, instead of all of them every time
+        query = f"""SELECT DISTINCT {_}tag_link.log as name
+                    FROM {_}tag_link
                     INNER JOIN {_}tag ON {_}tag_link.tag = {_}tag.uid
-                    WHERE {_}tag.type == ?;
-                """
-        res = self.cur.execute(query, [filter_tag_type]).fetchall()
-        ignore_list = set([x['name'] for x in res])  # sets are faster upon lookup (should not matter but good practice)
-        # select all logs
-        query = "SELECT name, content FROM log"
-        res = self.cur.execute(query).fetchall()  # just querying everything is usually faster than asking every single
-                                                  # thing, this might not scale to all eternity
-        contents = {x['name']: x['content'] for x in res}
+                    WHERE {_}tag.type = 'date' AND {_}tag_link.log IN ({', '.join('?' * len(names))});"""
+        ignore_list = {x['name'] for x in self.cur.execute(query, names).fetchall()}
         changes = {}
-        for name in contents:
-            if name in ignore_list:
+        for row in rows:  # * oldest first, a newer revision of the same log has the last word
+            if row.name in ignore_list or not row.content:
                 continue
-            tag = find_date(contents[name])
-            if tag:
-                self.create_modify_tag(str(tag), "date")
-                self.tag_file(name, str(tag))
-                changes[name] = str(tag)
+            if tag := find_date(row.content):
+                changes[row.name] = str(tag)
+        for tag in set(changes.values()):
+            self.create_modify_tag(tag, "date")
+        self.tag_files(changes.items())
         if len(changes) > 0:
             logger.info(f"Created {len(changes)} tag_links, rough date: {datetime.now().isoformat()}")
         return changes
 
+    def add_dictionary_terms(self, entries) -> int:
+        """
+        Fills the dictionary the entity_tag procedure works with, every term points to a tag that gets created if
+        it does not exist yet, already known terms are ignored (case insensitive)
+
+        :param entries: iterable of (term, tag_name, tag_type) tuples, tag_type is one of name, date and entity
+        :return: number of new terms
+        :rtype: int
+        """
+        _ = self.__pre
+        entries = [(term.strip(), tag.strip(), tag_type if tag_type in ("name", "date", "entity") else "name")
+                   for term, tag, tag_type in entries if term.strip() and tag.strip()]
+        self.cur.executemany(f"INSERT OR IGNORE INTO {_}tag (name, type) VALUES (?, ?);",
+                             [(tag, tag_type) for _term, tag, tag_type in entries])
+        before = self.db.total_changes
+        query = f"""INSERT OR IGNORE INTO {_}tag_term
+                    (term, tag, changed)
+                    SELECT ?, uid, ? FROM {_}tag WHERE name = ?;"""
+        now = datetime.now()
+        self.cur.executemany(query, [(term, now, tag) for term, tag, _type in entries])
+        created = self.db.total_changes - before
+        self.db.commit()
+        return created
+
+    def count_dictionary_terms(self) -> int:
+        return self.cur.execute(f"SELECT COUNT(*) as num FROM {self.__pre}tag_term;").fetchone()['num']
+
+    def procedure_tag_entities(self, full=False) -> dict:
+        """
+        Tags every log with the name and entity tags whose dictionary terms appear in its text, see
+        add_dictionary_terms and the 'entity_tag' procedure
+
+        :param bool full: scan every log with the whole dictionary instead of only what changed
+        :return: {log_name: [tag_name, ...]} of newly found matches
+        :rtype: dict
+        """
+        return self.run_procedure("entity_tag", full=full)['changes']
+
+    def _entity_matcher(self, since_term=0) -> AhoCorasick:
+        """
+        :param int since_term: only dictionary terms with a higher uid end up in the automaton
+        :return: an automaton of lower cased terms that reports the tag name for every match
+        """
+        query = f"""SELECT MAX({self.__pre}tag_term.uid) as last, COUNT(*) as num FROM {self.__pre}tag_term;"""
+        state = (since_term, ) + tuple(self.cur.execute(query).fetchone())
+        if state not in self._matchers:
+            query = f"""SELECT {self.__pre}tag_term.term as term, {self.__pre}tag.name as tag
+                        FROM {self.__pre}tag_term
+                        INNER JOIN {self.__pre}tag ON {self.__pre}tag_term.tag = {self.__pre}tag.uid
+                        WHERE {self.__pre}tag_term.uid > ?;"""
+            matcher = AhoCorasick()
+            for row in self.cur.execute(query, [since_term]).fetchall():
+                matcher.add(row['term'].lower(), row['tag'])
+            self._matchers = {state: matcher}  # * only ever one, an old dictionary is of no use anymore
+        return self._matchers[state]
+
+    def _apply_entity_matcher(self, rows, matcher: AhoCorasick) -> dict:
+        """
+        Runs the automaton over every log body, only whole words count, and writes the links in one go
+        """
+        changes = {}
+        for row in rows:
+            if not row.content:
+                continue
+            text = row.content.lower()
+            for start, end, tag in matcher.finditer(text):
+                if (start > 0 and text[start-1].isalnum()) or (end < len(text) and text[end].isalnum()):
+                    continue  # * 'Kim' should not match inside of 'Kimberly'
+                changes.setdefault(row.name, set()).add(tag)
+        self.tag_files((name, tag) for name, tags in changes.items() for tag in tags)
+        return {name: sorted(tags) for name, tags in changes.items()}
+
+    @register_procedure("entity_tag", ("uid", "name", "content"),
+                        "tags logs with the name/entity tags whose dictionary terms they mention",
+                        prepare=lambda db, watermark: db._prepare_entity_tag(watermark))
+    def _procedure_entity_tag(self, rows) -> dict:
+        return self._apply_entity_matcher(rows, self._entity_matcher())
+
+    def _prepare_entity_tag(self, watermark: int) -> dict:
+        """
+        Logs up to the watermark have only seen the dictionary as it was back then, if there are new terms those
+        logs get another pass, but only with an automaton of the new terms
+        """
+        term_mark = int(self.get_stat("proc_entity_tag_terms", 0))
+        last_term = self.cur.execute(f"SELECT MAX(uid) as last FROM {self.__pre}tag_term;").fetchone()['last']
+        if not last_term or last_term <= term_mark:
+            return {}
+        changes = {}
+        if watermark > 0:
+            matcher = self._entity_matcher(since_term=term_mark)
+            since = 0
+            while rows := [x for x in self.iter_logs(("uid", "name", "content"), since_uid=since, limit=500)
+                           if x.uid <= watermark]:
+                changes.update(self._apply_entity_matcher(rows, matcher))
+                since = rows[-1].uid
+        self.update_stat("proc_entity_tag_terms", last_term)
+        return changes
+
+    @register_procedure("minhash", ("uid", "name", "content"),
+                        "minhash signatures and lsh buckets of every log body, needed for 'duplicates'")
+    def _procedure_minhash(self, rows) -> dict:
+        _ = self.__pre
+        newest = {row.name: row for row in rows}  # * oldest first, the newest revision of a log wins
+        changes = {}
+        for name, row in newest.items():
+            if (signature := minhash_signature(row.content)) is None:
+                continue
+            self.cur.execute(f"INSERT OR REPLACE INTO {_}log_minhash (log, uid, signature) VALUES (?, ?, ?);",
+                             (name, row.uid, signature.tobytes()))
+            self.cur.execute(f"DELETE FROM {_}log_lsh WHERE log = ?;", [name])
+            self.cur.executemany(f"INSERT OR IGNORE INTO {_}log_lsh (band, bucket, log) VALUES (?, ?, ?);",
+                                 [(band, bucket, name) for band, bucket in lsh_buckets(signature)])
+            changes[name] = row.uid
+        self.db.commit()
+        return changes
+
+    def _index_trigrams(self, uid: int, content: str):
+        """
+        Puts the trigrams of one log revision into the index, the empty gram marks the revision as indexed even if
+        its text is too short to have any trigram at all. Does not commit
+        """
+        self.cur.executemany(f"INSERT OR IGNORE INTO {self.__pre}log_trigram (gram, log) VALUES (?, ?);",
+                             [(gram, uid) for gram in trigrams(content) | {""}])
+
+    @register_procedure("trigram", ("uid", "content"),
+                        "trigram index of all log bodies that grep uses, new logs are indexed when inserted")
+    def _procedure_trigram(self, rows) -> dict:
+        for row in rows:
+            self._index_trigrams(row.uid, row.content)
+        self.db.commit()
+        return {}
+
+    def grep(self, pattern: str, regex=True, ignore_case=False, limit=-1) -> list or None:
+        """
+        Searches the newest revision of every log for a regular expression or plain substring. The literal parts of
+        the pattern are cut into trigrams and only logs that contain all of them are actually matched, a pattern
+        without any literal of three characters (eg. '[A-Z]{3}-\\d{3}') has to look at every log. Logs that were
+        added without an index entry since the last 'proc trigram' are always looked at
+
+        :param str pattern: regular expression in python syntax or the text to look for
+        :param bool regex: False treats the pattern as plain text
+        :param bool ignore_case: case insensitive matching
+        :param int limit: maximum number of matching lines, -1 for all
+        :return: one dictionary per matching line, eg: [{'name': 'FTR-044-V.LOG', 'line': 3, 'text': '...'}],
+                 None if the pattern is no valid regular expression
+        :rtype: list or None
+        """
+        _ = self.__pre
+        if not regex:
+            pattern = re.escape(pattern)
+        try:
+            expression = re.compile(pattern, re.IGNORECASE if ignore_case else 0)
+        except re.error as err:
+            logger.warning(f"DB>grep: invalid pattern '{pattern}': {err}")
+            return None
+        grams = set()
+        for literal in regex_literals(pattern):
+            grams |= trigrams(literal)
+        # * newest revision by an index probe per candidate (log_name_uid) instead of grouping the whole table
+        newest = f"""NOT EXISTS (SELECT 1 FROM {_}log AS newer
+                                 WHERE newer.name = {_}log.name AND newer.uid > {_}log.uid)"""
+        if grams:
+            # * logs of the index plus the few that were added without it after the last 'proc trigram', everything
+            # * below its watermark is indexed
+            query = f"""WITH candidates(uid) AS (
+                            SELECT log FROM {_}log_trigram
+                            WHERE gram IN ({', '.join('?' * len(grams))})
+                            GROUP BY log HAVING COUNT(*) = ?
+                            UNION
+                            SELECT uid FROM {_}log
+                            WHERE uid > ?
+                              AND NOT EXISTS (SELECT 1 FROM {_}log_trigram WHERE gram = '' AND log = {_}log.uid))
+                        SELECT {_}log.uid AS uid, name, content
+                        FROM candidates
+                        INNER JOIN {_}log ON {_}log.uid = candidates.uid
+                        WHERE {newest}
+                        ORDER BY name ASC;"""
+            params = [*grams, len(grams), int(self.get_stat("proc_trigram_watermark", 0))]
+        else:
+            query = f"""SELECT uid, name, content
+                        FROM {_}log
+                        WHERE {newest}
+                        ORDER BY name ASC;"""
+            params = []
+        found = []
+        cursor = self.db.cursor()  # * streamed, only the candidates are ever matched and never all at once
+        for row in cursor.execute(query, params):
+            if not row['content'] or not expression.search(row['content']):
+                continue
+            for number, line in enumerate(row['content'].splitlines(), start=1):
+                if expression.search(line):
+                    found.append({'name': row['name'], 'line': number, 'text': line})
+                    if 0 <= limit <= len(found):
+                        cursor.close()
+                        return found
+        return found
+
+    def near_duplicates(self, log_name: str, threshold=LSH_THRESHOLD, limit=20) -> list:
+        """
+        Logs whose text is nearly the same as the given one, only looks at logs that share at least one lsh bucket
+        and estimates the similarity from the stored minhash signatures, needs the 'minhash' procedure
+
+        :param str log_name: name of the log, case insensitive
+        :param float threshold: minimal estimated jaccard similarity between 0 and 1, below LSH_THRESHOLD (where the
+                                lsh curve of 16 bands with 8 rows is) most pairs never become candidates at all
+        :param int limit: maximum number of results
+        :return: list of dictionaries, most similar first, eg: [{'name': 'FTR-044-V.LOG', 'similarity': 0.93}]
+        :rtype: list
+        """
+        _ = self.__pre
+        mine = self.cur.execute(f"SELECT log, signature FROM {_}log_minhash WHERE log = ? COLLATE NOCASE;",
+                                [log_name]).fetchone()
+        if not mine:
+            return []
+        query = f"""SELECT DISTINCT {_}log_minhash.log as log, {_}log_minhash.signature as signature
+                    FROM {_}log_lsh AS mine
+                    INNER JOIN {_}log_lsh AS other ON other.band = mine.band AND other.bucket = mine.bucket
+                    INNER JOIN {_}log_minhash ON {_}log_minhash.log = other.log
+                    WHERE mine.log = ? AND other.log != mine.log;"""
+        candidates = self.cur.execute(query, [mine['log']]).fetchall()
+        if not candidates:
+            return []
+        similarity = estimated_similarity(numpy.frombuffer(mine['signature'], dtype=numpy.uint32),
+                                          numpy.vstack([numpy.frombuffer(x['signature'], dtype=numpy.uint32)
+                                                        for x in candidates]))
+        found = [{'name': x['log'], 'similarity': round(float(sim), 3)}
+                 for x, sim in zip(candidates, similarity) if sim >= threshold]
+        return sorted(found, key=lambda x: x['similarity'], reverse=True)[:limit]
+
+    def near_duplicate_clusters(self, threshold=LSH_THRESHOLD) -> list:
+        """
+        Groups all logs that are near copies of each other, every log that shares a bucket with the first log of
+        that bucket and passes the threshold joins its group (union find), roughly linear in the number of logs
+
+        :param float threshold: minimal estimated jaccard similarity, see near_duplicates
+        :return: list of sorted name lists, biggest cluster first
+        :rtype: list
+        """
+        _ = self.__pre
+        signatures = {x['log']: numpy.frombuffer(x['signature'], dtype=numpy.uint32)
+                      for x in self.cur.execute(f"SELECT log, signature FROM {_}log_minhash;").fetchall()}
+        parent = {}
+
+        def find(name):
+            while parent.setdefault(name, name) != name:
+                parent[name] = parent[parent[name]]
+                name = parent[name]
+            return name
+        query = f"""SELECT group_concat(log, char(0)) as logs
+                    FROM {_}log_lsh
+                    GROUP BY band, bucket
+                    HAVING COUNT(*) > 1;"""
+        for row in self.cur.execute(query).fetchall():
+            names = row['logs'].split("\0")
+            similarity = estimated_similarity(signatures[names[0]], numpy.vstack([signatures[x] for x in names]))
+            for name, sim in zip(names[1:], similarity[1:]):
+                if sim >= threshold:
+                    parent[find(name)] = find(names[0])
+        clusters = {}
+        for name in parent:
+            clusters.setdefault(find(name), []).append(name)
+        return sorted((sorted(x) for x in clusters.values() if len(x) > 1), key=len, reverse=True)
+
+    def procedure_tfidf(self, full=False) -> dict:
+        """
+        Builds the TF-IDF matrix over the newest revision of every log that related_logs works with. Unlike the
+        registered procedures this cannot be done piece by piece as every new log changes the weight of every
+        word, it is skipped though if no log was added since the last build
+
+        :param bool full: rebuild even if nothing changed
+        :return: {'logs': int, 'terms': int, 'duration': seconds}, logs and terms are 0 if skipped
+        :rtype: dict
+        """
+        _ = self.__pre
+        time_zero = perf_counter()
+        newest = self.cur.execute(f"SELECT COALESCE(MAX(uid), 0) as last FROM {_}log;").fetchone()['last']
+        if not full and int(self.get_stat("proc_tfidf_watermark", -1)) == newest:
+            return {'logs': 0, 'terms': 0, 'duration': perf_counter() - time_zero}
+        query = f"""SELECT name, content
+                    FROM {_}log
+                    WHERE uid IN (SELECT MAX(uid) FROM {_}log GROUP BY name)
+                    ORDER BY name ASC;"""
+        names = []
+        cursor = self.db.cursor()
+
+        def documents():  # * streamed into the matrix, the bodies are never all in memory at once
+            for row in cursor.execute(query):
+                names.append(row['name'])
+                yield row['content']
+        matrix = tfidf_matrix(documents())
+        matrix['names'] = numpy.array(names, dtype=str)
+        self._store_artifact("tfidf", matrix)
+        report = {'logs': len(names), 'terms': len(matrix['vocabulary']), 'duration': perf_counter() - time_zero}
+        self.update_stat("proc_tfidf_watermark", newest)
+        self.update_stat("proc_tfidf_last_run", datetime.now())
+        self.update_stat("proc_tfidf_duration", f"{report['duration']:.4f}")
+        return report
+
+    def related_logs(self, log_name: str, limit=5) -> list:
+        """
+        The logs that talk about the same things as the given one, cosine similarity of their TF-IDF rows, needs
+        'proc tfidf' to be run first
+
+        :param str log_name: name of the log, case insensitive
+        :param int limit: number of results
+        :return: list of dictionaries, eg: [{'name': 'FTR-044-V.LOG', 'similarity': 0.42}], empty without matrix
+        :rtype: list
+        """
+        if not (matrix := self._load_artifact("tfidf")):
+            return []
+        if "rows" not in matrix:  # * name lookup table, built once per loaded matrix
+            matrix['rows'] = {str(name).lower(): i for i, name in enumerate(matrix['names'])}
+        if (row := matrix['rows'].get(log_name.lower())) is None:
+            return []
+        return [{'name': str(matrix['names'][i]), 'similarity': round(sim, 3)}
+                for i, sim in cosine_top_k(matrix, row, limit)]
+
+    def _store_artifact(self, name: str, arrays: dict):
+        """
+        Persists a bunch of numpy arrays (a precomputed matrix or index) as one compressed blob
+        """
+        buffer = io.BytesIO()
+        numpy.savez_compressed(buffer, **arrays)
+        self.cur.execute(f"INSERT OR REPLACE INTO {self.__pre}artifact (name, data, changed) VALUES (?, ?, ?);",
+                         (name, buffer.getvalue(), datetime.now()))
+        self.db.commit()
+
+    def _load_artifact(self, name: str) -> dict or None:
+        """
+        Loads the arrays of an artifact, they are kept in memory until the stored one changes, checking that is a
+        single tiny select
+
+        :return: dictionary of arrays or None if there is no such artifact
+        """
+        query = f"SELECT changed FROM {self.__pre}artifact WHERE name = ?;"
+        if not (row := self.cur.execute(query, [name]).fetchone()):
+            return None
+        if name not in self._artifacts or self._artifacts[name][0] != row['changed']:
+            blob = self.cur.execute(f"SELECT data FROM {self.__pre}artifact WHERE name = ?;", [name]).fetchone()
+            with numpy.load(io.BytesIO(blob['data'])) as npz:
+                self._artifacts[name] = (row['changed'], {key: npz[key] for key in npz.files})
+        return self._artifacts[name][1]
+
+    def procedure_cooccurrence(self) -> dict:
+        """
+        Counts the co-occurrence of all tags from scratch, tag_files keeps the counts up to date on its own, this is
+        only needed after links were changed by hand or deleted
+
+        :return: {'pairs': int, 'duration': seconds}, pairs counts each direction
+        :rtype: dict
+        """
+        _ = self.__pre
+        time_zero = perf_counter()
+        self.cur.execute(f"DELETE FROM {_}tag_cooccurrence;")
+        query = f"""INSERT INTO {_}tag_cooccurrence
+                    (tag_a, tag_b, weight)
+                    SELECT a.tag, b.tag, COUNT(*)
+                    FROM {_}tag_link AS a
+                    INNER JOIN {_}tag_link AS b ON a.log = b.log AND a.tag != b.tag
+                    GROUP BY a.tag, b.tag;"""
+        self.cur.execute(query)
+        self.db.commit()
+        report = {'pairs': self.cur.execute(f"SELECT COUNT(*) as num FROM {_}tag_cooccurrence;").fetchone()['num'],
+                  'duration': perf_counter() - time_zero}
+        self.update_stat("proc_cooccurrence_last_run", datetime.now())
+        self.update_stat("proc_cooccurrence_duration", f"{report['duration']:.4f}")
+        return report
+
+    def top_cooccurring(self, tag_name: str, limit=10) -> list:
+        """
+        The tags that share the most logs with the given one
+
+        :param str tag_name: exact name of the tag
+        :param int limit: number of results
+        :return: list of dictionaries, eg: [{'name': 'Biocom', 'type': 'entity', 'weight': 4}]
+        :rtype: list
+        """
+        _ = self.__pre
+        query = f"""SELECT {_}tag.name as name, {_}tag.type as type, weight
+                    FROM {_}tag_cooccurrence
+                    INNER JOIN {_}tag ON {_}tag.uid = {_}tag_cooccurrence.tag_b
+                    WHERE tag_a = (SELECT uid FROM {_}tag WHERE name = ?)
+                    ORDER BY weight DESC, {_}tag.name ASC
+                    LIMIT ?;"""
+        rows = self.cur.execute(query, (tag_name, limit)).fetchall()
+        return [{key: row[key] for key in row.keys()} for row in rows]
+
+    def logs_with_tags(self, tag_a: str, tag_b: str, limit=-1) -> list:
+        """
+        Logs that carry both tags, an intersection of the two posting lists of the (tag, log) index
+
+        :param str tag_a: exact name of the first tag
+        :param str tag_b: exact name of the second tag
+        :param int limit: maximum number of names, -1 for all
+        :return: list of log names, sorted
+        :rtype: list
+        """
+        _ = self.__pre
+        query = f"""SELECT a.log as name
+                    FROM {_}tag_link AS a
+                    INNER JOIN {_}tag_link AS b ON b.tag = (SELECT uid FROM {_}tag WHERE name = ?) AND b.log = a.log
+                    WHERE a.tag = (SELECT uid FROM {_}tag WHERE name = ?)
+                    ORDER BY a.log ASC
+                    LIMIT ?;"""
+        return [row['name'] for row in self.cur.execute(query, (tag_b, tag_a, limit)).fetchall()]
+
+    def tag_path(self, tag_a: str, tag_b: str, max_depth=6) -> list:
+        """
+        Shortest chain of tags connecting two tags, two tags are neighbours if they share at least one log. Breadth
+        first search over the co-occurrence table, each visited tag costs one primary key range lookup
+
+        :param str tag_a: exact name of the starting tag
+        :param str tag_b: exact name of the target tag
+        :param int max_depth: gives up after that many hops
+        :return: one dictionary per hop, eg: [{'from': 'May', 'to': 'Biocom', 'logs': ['FTR-044-V.LOG']}], empty
+                 list if there is no connection or one of the tags does not exist
+        :rtype: list
+        """
+        _ = self.__pre
+        uids = {}
+        for name in (tag_a, tag_b):
+            if not (row := self.cur.execute(f"SELECT uid FROM {_}tag WHERE name = ?;", [name]).fetchone()):
+                return []
+            uids[name] = row['uid']
+        start, goal = uids[tag_a], uids[tag_b]
+        if start == goal:
+            return []
+        parent = {start: None}
+        frontier = [start]
+        query = f"SELECT tag_b FROM {_}tag_cooccurrence WHERE tag_a = ?;"
+        for _depth in range(max_depth):
+            if goal in parent or not frontier:
+                break
+            following = []
+            for uid in frontier:
+                for row in self.cur.execute(query, [uid]).fetchall():
+                    if row['tag_b'] not in parent:
+                        parent[row['tag_b']] = uid
+                        following.append(row['tag_b'])
+            frontier = following
+        if goal not in parent:
+            return []
+        chain = [goal]
+        while parent[chain[-1]] is not None:
+            chain.append(parent[chain[-1]])
+        chain.reverse()
+        names = {row['uid']: row['name'] for row in self.cur.execute(
+            f"SELECT uid, name FROM {_}tag WHERE uid IN ({','.join('?' * len(chain))});", chain).fetchall()}
+        return [{'from': names[a], 'to': names[b], 'logs': self.logs_with_tags(names[a], names[b], limit=5)}
+                for a, b in zip(chain, chain[1:])]
+
+    def run_procedure(self, name: str, batch_size=500, full=False) -> dict or None:
+        """
+        Runs a registered procedure over every log that was added since its last run. The uid of the last processed
+        log is kept as watermark in the stats table ('proc_<name>_watermark') after every batch, an interrupted run
+        continues where it stopped. Duration, number of processed logs and time of the run are kept there as well
+
+        :param str name: name the procedure was registered with
+        :param int batch_size: logs handed over per call of the procedure
+        :param bool full: ignores the watermark and starts over from the very first log
+        :return: {'processed': int, 'changes': dict, 'duration': seconds, 'watermark': uid} or None if unknown
+        :rtype: dict or None
+        """
+        if name not in self.procedures:
+            logger.warning(f"DB>run_procedure: unknown procedure '{name}'")
+            return None
+        spec = self.procedures[name]
+        watermark = 0 if full else int(self.get_stat(f"proc_{name}_watermark", 0))
+        report = {'processed': 0, 'changes': {}}
+        time_zero = perf_counter()
+        if spec.prepare:
+            report['changes'].update(spec.prepare(self, watermark) or {})
+        while rows := list(self.iter_logs(spec.columns, since_uid=watermark, limit=batch_size)):
+            report['changes'].update(spec.func(self, rows) or {})
+            report['processed'] += len(rows)
+            watermark = rows[-1].uid
+            self.update_stat(f"proc_{name}_watermark", watermark)
+        report['duration'] = perf_counter() - time_zero
+        report['watermark'] = watermark
+        self.update_stat(f"proc_{name}_last_run", datetime.now())
+        self.update_stat(f"proc_{name}_duration", f"{report['duration']:.4f}")
+        self.update_stat(f"proc_{name}_processed", report['processed'])
+        return report
+
+    def procedure_status(self) -> list:
+        """
+        :return: one dictionary per registered procedure with name, description, watermark, last_run and duration
+        :rtype: list
+        """
+        status = []
+        for name, spec in self.procedures.items():
+            status.append({'name': name,
+                           'description': spec.description,
+                           'watermark': int(self.get_stat(f"proc_{name}_watermark", 0)),
+                           'last_run': self.get_stat(f"proc_{name}_last_run", ""),
+                           'duration': self.get_stat(f"proc_{name}_duration", "")})
+        return status
+
+    def logs_between(self, start, end) -> list:
+        """
+        All logs whose in-universe date lies within the given range, both ends included, oldest first
+
+        :param date or str start: first day of the range, date object or 'YYYY-MM-DD'
+        :param date or str end: last day of the range, date object or 'YYYY-MM-DD'
+        :return: list of dictionaries, eg: [{'name': 'FTR-044-V.LOG', 'day': '2049-05-01'}]
+        :rtype: list
+        """
+        query = f"""SELECT log as name, day
+                    FROM {self.__pre}log_date
+                    WHERE day BETWEEN ? AND ?
+                    ORDER BY day ASC, log ASC;"""
+        rows = self.cur.execute(query, (str(start), str(end))).fetchall()
+        return [{key: row[key] for key in row.keys()} for row in rows]
+
+    def date_histogram(self, resolution="year") -> dict:
+        """
+        Counts the logs per in-universe year or month, straight from the index on the date column
+
+        :param str resolution: 'year' or 'month', defaults to 'year' if anything else is given
+        :return: ordered dictionary like {'2049': 12, '2053': 3} or {'2049-05': 12}
+        :rtype: dict
+        """
+        length = 7 if resolution == "month" else 4
+        query = f"""SELECT substr(day, 1, {length}) as period, COUNT(*) as num
+                    FROM {self.__pre}log_date
+                    GROUP BY period
+                    ORDER BY period ASC;"""
+        return {row['period']: row['num'] for row in self.cur.execute(query).fetchall()}
+
+    def procedure_maintain(self) -> dict:
+        """
+        Housekeeping for long living archives, refreshes the statistics of the query planner (ANALYZE & optimize),
+        gives unused pages back to the file system via incremental vacuum and applies the configured page size and
+        mmap size. A database created before auto_vacuum was set gets converted with a single full VACUUM first.
+
+        A small set of representative queries is timed before and after so the effect is actually visible
+
+        :return: dictionary with 'size_before', 'size_after' (bytes), 'timing_before', 'timing_after'
+                 ({query_label: seconds}) and 'steps', a list of the executed statements
+        :rtype: dict
+        """
+        report = {'size_before': os.path.getsize(self.db_file),
+                  'timing_before': self._benchmark_queries(),
+                  'steps': []}
+        self.db.commit()  # VACUUM refuses to run inside an open transaction
+        auto_vacuum = self.cur.execute("PRAGMA auto_vacuum;").fetchone()[0]
+        page_size = self.cur.execute("PRAGMA page_size;").fetchone()[0]
+        if auto_vacuum != 2 or page_size != db_page_size:  # 2 = INCREMENTAL
+            steps = [f"PRAGMA page_size = {int(db_page_size)};",
+                     "PRAGMA auto_vacuum = INCREMENTAL;",
+                     "VACUUM;"]
+        else:
+            steps = ["PRAGMA incremental_vacuum;"]
+        steps += ["ANALYZE;", "PRAGMA optimize;", f"PRAGMA mmap_size = {int(db_mmap_size)};"]
+        for step in steps:
+            self.cur.execute(step).fetchall()  # incremental_vacuum only does its work when stepped through
+            report['steps'].append(step)
+        self.db.commit()
+        report['timing_after'] = self._benchmark_queries()
+        report['size_after'] = os.path.getsize(self.db_file)
+        self.update_stat("last_maintenance", datetime.now())
+        logger.info(f"DB>maintain: {report['size_before']} -> {report['size_after']} bytes")
+        return report
+
+    def _benchmark_queries(self, repeats=3) -> dict:
+        """
+        Times a few queries that resemble what the shell and the flask mirror do all day, best of a few repeats,
+        always past the query cache
+
+        :param int repeats: number of runs per query, the fastest one counts
+        :return: {query_label: seconds}
+        """
+        newest = self.cur.execute(f"SELECT name FROM {self.__pre}log ORDER BY uid DESC LIMIT 1;").fetchone()
+        newest = newest['name'] if newest else ""
+        probes = {
+            'count_logs': lambda: self.count_logs(),
+            'all_folders': lambda: self.get_all_folders(),
+            'all_logs_100': lambda: self.get_all_logs(limit=100),
+            'all_logs_tag_date': lambda: self.get_all_logs(limit=100, order_field="tag_date"),
+            'list_folder': lambda: self.list_logs_of_folder("%", per_page=200),
+            'extension_blind': lambda: self.get_log_name_extension_blind(newest.split(".")[0]),
+            'log_content': lambda: self.get_log_content(newest),
+            'log_handle': lambda: self.get_log(newest),
+            'date_histogram': lambda: self.date_histogram("month"),
+        }
+        timing = {}
+        cache, self.cache = self.cache, None  # * the query plans are what counts, not dictionary lookups
+        try:
+            for label, probe in probes.items():
+                best = None
+                for _ in range(repeats):
+                    start = perf_counter()
+                    probe()
+                    took = perf_counter() - start
+                    best = took if best is None or took < best else best
+                timing[label] = best
+        finally:
+            self.cache = cache
+        return timing
+
     def remote_fetch_everything(self):
         """
         Full procedure to download the entire database from scratch
@@ -508,7 +1628,12 @@ class SantonianDB:
                     self.insert_text_log(body, log_name, file_id)
                     logger.info(f" - {len(body)}")
                 else:
-                    logger.info("##AUD//NoSUPPORT")
+                    status, body = santonian.read_log(api_calls, santonian.split_log_name(log_name))
+                    if not status or not check_for_mp3_link(body):
+                        logger.info(" ##FAIL")
+                        continue
+                    if digest := self.insert_audio_log(body, log_name, file_id):
+                        logger.info(f" - audio {digest}")
         logger.info("...Process finished")
         return True
 
@@ -526,14 +1651,7 @@ class SantonianDB:
         # ? second get actual data
         _ = self.__pre
         if mode != "complex":
-            query = f"""SELECT {_}log.name 
-                        FROM {_}log
-                        INNER JOIN {_}folders ON {_}folders.uid = {_}log.folder
-                        WHERE {_}folders.name LIKE '{folder}'
-                        ORDER BY {_}log.uid ASC
-                        LIMIT {per_page} OFFSET ?;"""
-            raws = self._general_fetch_query(query, page*per_page)
-            return [x['name'] for x in raws]
+            return [row.name for row in self.iter_logs(("name", ), folder, start=page*per_page, limit=per_page)]
         else:
             query = f"""SELECT {_}log.name as name, content, {_}folders.name as folder, audio, hash, 
                                 revision, {_}log.last_check, {_}log.first_entry
@@ -545,6 +1663,115 @@ class SantonianDB:
             raws = self._general_fetch_query(query, page * per_page)
             return raws
 
+    @_cached
+    def count_logs_of_folder(self, folder: str) -> int:
+        """
+        Number of entries list_logs_of_folder and iter_logs give for that folder, revisions included
+
+        :param str folder: name of the folder, LIKE pattern like in iter_logs
+        :return: the number, 0 for unknown folders
+        :rtype: int
+        """
+        _ = self.__pre
+        query = f"""SELECT COUNT(*) as num
+                    FROM {_}log
+                    INNER JOIN {_}folders ON {_}folders.uid = {_}log.folder
+                    WHERE {_}folders.name LIKE ?;"""
+        return self.cur.execute(query, [folder]).fetchone()['num']
+
+    def iter_logs(self, columns=("name", ), folder=None, start=0, limit=-1, order="ASC", order_field="uid",
+                  since_uid=None):
+        """
+        Streaming counterpart to get_all_logs, only selects the asked for columns and hands out one row after another
+        straight from its own cursor instead of building a list of dictionaries first. Rows are namedtuples, so
+        row.name and row[0] both work and row._asdict() gives the old dictionary if needed
+
+        :param tuple columns: any of 'uid', 'name', 'folder', 'content', 'audio', 'hash', 'revision',
+                              'last_check', 'first_entry', 'sparkline' and 'tags', unknown ones are dropped
+        :param str folder: optional folder name, LIKE pattern, '%' or None for all folders
+        :param int start: Offset Parameter, number of entries to hop over
+        :param int limit: maximum of rows, -1 for no limit at all
+        :param str order: either ASC or DESC, will default to ASC if anything else is choosen
+        :param str order_field: any of the column names except 'tags' and 'sparkline', defaults to 'uid'
+        :param int since_uid: only logs with a higher uid, cheap keyset pagination for batch processing
+        :return: generator of LogRow namedtuples
+        """
+        _ = self.__pre
+        known_columns = {'uid': f"{_}log.uid", 'name': f"{_}log.name", 'folder': f"{_}folders.name",
+                         'content': f"{_}log.content", 'audio': f"{_}log.audio", 'hash': f"{_}log.hash",
+                         'revision': f"{_}log.revision", 'last_check': f"{_}log.last_check",
+                         'first_entry': f"{_}log.first_entry",
+                         'sparkline': f"(SELECT line FROM {_}audio_sparkline WHERE hash = {_}log.aud_hash)",
+                         'tags': f"""(SELECT COALESCE(group_concat({_}tag.name, ', '), '')
+                                      FROM {_}tag_link
+                                      INNER JOIN {_}tag ON {_}tag_link.tag = {_}tag.uid
+                                      WHERE {_}tag_link.log = {_}log.name)"""}
+        columns = tuple(x for x in columns if x in known_columns)
+        if not columns:
+            return
+        if order.upper() != "ASC" and order.upper() != "DESC":
+            order = "ASC"
+        if order_field not in known_columns or order_field in ("tags", "sparkline"):
+            order_field = "uid"
+        selection = ", ".join(f"{known_columns[x]} AS {x}" for x in columns)
+        join, conditions, params = "", [], []
+        if folder is not None or "folder" in columns or order_field == "folder":  # * the join only when needed
+            join = f"INNER JOIN {_}folders ON {_}folders.uid = {_}log.folder"
+        if folder is not None:
+            conditions.append(f"{_}folders.name LIKE ?")
+            params.append(folder)
+        if since_uid is not None:
+            conditions.append(f"{_}log.uid > ?")
+            params.append(since_uid)
+        condition = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        query = f"""SELECT {selection}
+                    FROM {_}log
+                    {join}
+                    {condition}
+                    ORDER BY {known_columns[order_field]} {order}
+                    LIMIT ? OFFSET ?;"""
+        row_type = _row_type(columns)
+        cursor = self.db.cursor()  # * own cursor, self.cur might be used while this one is still streaming
+        cursor.row_factory = lambda _cur, row: row_type._make(row)
+        yield from cursor.execute(query, params + [limit, start])
+
+    def iter_export(self, since=None):
+        """
+        Everything the database knows, one dictionary after another straight from the cursors: folders, then every
+        revision of every log, then the tags and at last the links between tags and logs. Each record has a 'kind'
+        of 'folder', 'log', 'tag' or 'tag_link', the audio blobs themselves are not part of it, only their hashes
+
+        :param str since: optional timestamp as stored ('2049-05-01 00:00:00'), only folders and logs with a
+                          last_check and tag links that changed at or after it, tags only if one of those links
+                          points to them
+        :return: generator of dictionaries
+        """
+        _ = self.__pre
+        condition, params = ("WHERE last_check >= ?", (since, )) if since else ("", ())
+        queries = (
+            ("folder", f"""SELECT name, file_id, temporary, last_check, first_entry
+                           FROM {_}folders {condition} ORDER BY uid ASC;""", params),
+            ("log", f"""SELECT {_}log.name AS name, {_}folders.name AS folder, revision, content, audio, aud_hash,
+                               hash, {_}log.last_check AS last_check, {_}log.first_entry AS first_entry
+                        FROM {_}log
+                        INNER JOIN {_}folders ON {_}folders.uid = {_}log.folder
+                        {condition.replace("last_check", f"{_}log.last_check")}
+                        ORDER BY {_}log.uid ASC;""", params),
+            ("tag", f"""SELECT name, type FROM {_}tag
+                        {f"WHERE uid IN (SELECT tag FROM {_}tag_link WHERE changed >= ?)" if since else ""}
+                        ORDER BY uid ASC;""", params),
+            ("tag_link", f"""SELECT {_}tag_link.log AS log, {_}tag.name AS tag, changed
+                             FROM {_}tag_link
+                             INNER JOIN {_}tag ON {_}tag.uid = {_}tag_link.tag
+                             {"WHERE changed >= ?" if since else ""}
+                             ORDER BY {_}tag_link.uid ASC;""", params),
+        )
+        for kind, query, query_params in queries:
+            cursor = self.db.cursor()  # * own cursor, see iter_logs
+            cursor.row_factory = sqlite3.Row
+            for row in cursor.execute(query, query_params):
+                yield {'kind': kind, **dict(row)}
+
     def get_all_folders(self, start=0, limit=25, order="ASC", order_field="uid"):
         """
         Simple procedure that queries simply all entries and returns their content, in this case for folders
@@ -579,17 +1806,18 @@ class SantonianDB:
             order_field = allowed_order[order_field]
         else:
             order_field = allowed_order['uid']
+        sparkline = f"(SELECT line FROM {_}audio_sparkline WHERE hash = {_}log.aud_hash) as sparkline"
         # * switch for tags
         if not tags:
             query = f"""SELECT {_}log.uid, {_}log.name as name, content, {_}folders.name as folder, audio, hash, 
-                                revision, {_}log.last_check, {_}log.first_entry
+                                revision, {_}log.last_check, {_}log.first_entry, {sparkline}
                         FROM {_}log
                         INNER JOIN {_}folders ON {_}log.folder = {_}folders.uid
                         ORDER BY {order_field} {order}
                         LIMIT {limit} OFFSET ?;"""
         else:
             query = f"""SELECT {_}log.uid, {_}log.name as name, content, {_}folders.name as folder, audio, hash, 
-                                            revision, {_}log.last_check, {_}log.first_entry,
+                                            revision, {_}log.last_check, {_}log.first_entry, {sparkline},
                                             COALESCE(group_concat(tag.name, ', '), '') as tags
                                     FROM {_}log
                                     INNER JOIN {_}folders ON {_}log.folder = {_}folders.uid
@@ -606,8 +1834,8 @@ class SantonianDB:
                                revision,
                                content,
                                audio,
-                               aud_fl,
                                hash,
+                               {sparkline},
                                COALESCE(group_concat({_}tag.name, ', '), '') as tags
                         FROM {_}log
                         INNER JOIN {_}folders on {_}log.folder = {_}folders.uid
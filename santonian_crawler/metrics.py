@@ -0,0 +1,230 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Copyright 2021 by BurnoutDV, <development@burnoutdv.com>
+#
+# This file is part of SantonianCrawler.
+#
+# SantonianCrawler is free software: you can redistribute
+# it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, either
+# version 3 of the License, or (at your option) any later version.
+#
+# SantonianCrawler is distributed in the hope that it will
+# be useful, but WITHOUT ANY WARRANTY; without even the implied warranty
+# of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# @license GPL-3.0-only <https://www.gnu.org/licenses/gpl-3.0.en.html>
+
+
+
+import threading
+import time
+from bisect import bisect_left
+
+# * upper bounds of the histogram buckets, +Inf is added by the exposition
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (64, 256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+
+class Metrics:
+    """
+    Request metrics of the mirror, collected without any lock on the hot path: every thread writes only into its
+    own shard (a plain dict) and the exposition adds the shards up. Shards are found by thread ident, a thread that
+    reuses the ident of a finished one simply continues its counters, so thread per request servers do not make
+    the list grow forever
+    """
+    def __init__(self):
+        self._shards = {}
+
+    def _shard(self) -> dict:
+        ident = threading.get_ident()
+        if (shard := self._shards.get(ident)) is None:
+            shard = self._shards.setdefault(ident, {'queries': 0})  # * setdefault is atomic, no lock needed
+        return shard
+
+    def count_query(self, _statement=None):
+        """
+        Trace callback for sqlite3 connections (Connection.set_trace_callback), counts every statement
+        """
+        self._shard()['queries'] += 1
+
+    def _histogram(self, shard: dict, key: tuple, buckets: tuple, value: float):
+        if (histogram := shard.get(key)) is None:
+            histogram = shard[key] = [0] * (len(buckets) + 1) + [0.0]  # * counts per bucket, +Inf, then the sum
+        histogram[bisect_left(buckets, value)] += 1
+        histogram[-1] += value
+
+    def observe_request(self, route: str, method: str, status: int, seconds: float, size: int):
+        """
+        :param str route: route template, eg. '/backend/file/<int:disk_id>'
+        :param str method: http method
+        :param int status: http status that was sent
+        :param float seconds: time from the start of the request until the last byte of the body
+        :param int size: bytes of the body as sent (compressed if it was)
+        """
+        shard = self._shard()
+        key = ("requests", route, method, status)
+        shard[key] = shard.get(key, 0) + 1
+        self._histogram(shard, ("latency", route), LATENCY_BUCKETS, seconds)
+        self._histogram(shard, ("size", route), SIZE_BUCKETS, size)
+
+    def observe_db(self, route: str, seconds: float, queries: int):
+        shard = self._shard()
+        key = ("db", route)
+        if (db := shard.get(key)) is None:
+            db = shard[key] = [0.0, 0]
+        db[0] += seconds
+        db[1] += queries
+
+    def timed(self, route: str, producer):
+        """
+        Wraps a payload producer, the time it takes and the statements it runs count as database work of the route
+
+        :param str route: route template
+        :param producer: callable without arguments, see RenderCache.get
+        :return: callable with the same result
+        """
+        def run():
+            shard = self._shard()  # * the producer runs in this thread only, its statements land in this shard
+            queries, start = shard['queries'], time.perf_counter()
+            try:
+                return producer()
+            finally:
+                self.observe_db(route, time.perf_counter() - start, shard['queries'] - queries)
+        return run
+
+    def timed_iter(self, route: str, chunks):
+        """
+        timed for generators that read the database while they are streamed, every step may happen in another
+        thread, so every step is measured on its own
+        """
+        try:
+            while True:
+                chunk = self.timed(route, lambda: next(chunks, None))()
+                if chunk is None:
+                    return
+                yield chunk
+        finally:
+            if hasattr(chunks, "close"):
+                chunks.close()
+
+    def _totals(self) -> dict:
+        totals = {}
+        for shard in list(self._shards.values()):
+            for key, value in list(shard.items()):  # * copying is atomic under the GIL, the owner may write meanwhile
+                if key == 'queries':
+                    continue
+                if isinstance(value, list):
+                    if (total := totals.get(key)) is None:
+                        total = totals[key] = [0] * len(value)
+                    for i, part in enumerate(value):
+                        total[i] += part
+                else:
+                    totals[key] = totals.get(key, 0) + value
+        return totals
+
+    def render(self, caches=()) -> str:
+        """
+        Everything in the prometheus text format (version 0.0.4)
+
+        :param caches: (name, hits, misses, entries) of every cache that should be reported
+        :return: the exposition, ends with a newline
+        :rtype: str
+        """
+        totals = self._totals()
+        lines = []
+
+        def family(name, kind, help_text):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+
+        family("santonian_mirror_requests_total", "counter", "Requests by route, method and status.")
+        for key, count in sorted((k, v) for k, v in totals.items() if k[0] == "requests"):
+            _, route, method, status = key
+            lines.append(f'santonian_mirror_requests_total{{route="{route}",method="{method}",status="{status}"}} '
+                         f'{count}')
+        for kind, name, buckets, help_text in (
+                ("latency", "santonian_mirror_request_seconds", LATENCY_BUCKETS, "Time until the last byte was sent."),
+                ("size", "santonian_mirror_response_bytes", SIZE_BUCKETS, "Size of the response body as sent.")):
+            family(name, "histogram", help_text)
+            for key, histogram in sorted((k, v) for k, v in totals.items() if k[0] == kind):
+                route, cumulative = key[1], 0
+                for bound, count in zip(buckets + ("+Inf", ), histogram):
+                    cumulative += count
+                    lines.append(f'{name}_bucket{{route="{route}",le="{bound}"}} {cumulative}')
+                lines.append(f'{name}_sum{{route="{route}"}} {histogram[-1]}')
+                lines.append(f'{name}_count{{route="{route}"}} {cumulative}')
+        family("santonian_mirror_db_seconds_total", "counter", "Time spent reading the database.")
+        db = sorted((k[1], v) for k, v in totals.items() if k[0] == "db")
+        for route, (seconds, _queries) in db:
+            lines.append(f'santonian_mirror_db_seconds_total{{route="{route}"}} {seconds}')
+        family("santonian_mirror_db_queries_total", "counter", "Statements sent to sqlite.")
+        for route, (_seconds, queries) in db:
+            lines.append(f'santonian_mirror_db_queries_total{{route="{route}"}} {queries}')
+        family("santonian_mirror_cache_hits_total", "counter", "Lookups answered by a cache.")
+        lines += [f'santonian_mirror_cache_hits_total{{cache="{x[0]}"}} {x[1]}' for x in caches]
+        family("santonian_mirror_cache_misses_total", "counter", "Lookups a cache could not answer.")
+        lines += [f'santonian_mirror_cache_misses_total{{cache="{x[0]}"}} {x[2]}' for x in caches]
+        family("santonian_mirror_cache_entries", "gauge", "Entries a cache holds right now.")
+        lines += [f'santonian_mirror_cache_entries{{cache="{x[0]}"}} {x[3]}' for x in caches]
+        return "\n".join(lines) + "\n"
+
+
+class MetricsMiddleware:
+    """
+    WSGI middleware that measures every request until the last byte of the body left, streamed ones included.
+    The route template is taken from environ['santonian.route'], the flask app puts it there
+    """
+    def __init__(self, app, metrics: Metrics):
+        self.app = app
+        self.metrics = metrics
+
+    def __call__(self, environ, start_response):
+        start, status = time.perf_counter(), []
+
+        def record_status(status_line, headers, exc_info=None):
+            status.append(int(status_line[:3]))
+            return start_response(status_line, headers, exc_info)
+
+        body = self.app(environ, record_status)
+        return self._measured(environ, body, start, status)
+
+    def _measured(self, environ, body, start, status):
+        size = 0
+        try:
+            for chunk in body:
+                size += len(chunk)
+                yield chunk
+        finally:
+            if hasattr(body, "close"):
+                body.close()
+            self.metrics.observe_request(environ.get("santonian.route", "unmatched"), environ['REQUEST_METHOD'],
+                                         status[0] if status else 500, time.perf_counter() - start, size)
+
+
+def asgi_metrics(app, metrics: Metrics):
+    """
+    Same as MetricsMiddleware for an asgi app, the route template comes from scope['santonian.route']
+    """
+    async def measured(scope, receive, send):
+        if scope['type'] != "http":
+            return await app(scope, receive, send)
+        start, state = time.perf_counter(), {'status': 500, 'size': 0}
+
+        async def counting_send(message):
+            if message['type'] == "http.response.start":
+                state['status'] = message['status']
+            elif message['type'] == "http.response.body":
+                state['size'] += len(message.get('body', b""))
+            await send(message)
+        try:
+            await app(scope, receive, counting_send)
+        finally:
+            metrics.observe_request(scope.get("santonian.route", "unmatched"), scope['method'], state['status'],
+                                    time.perf_counter() - start, state['size'])
+    return measured
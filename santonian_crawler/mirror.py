@@ -0,0 +1,553 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Copyright 2021 by BurnoutDV, <development@burnoutdv.com>
+#
+# This file is part of SantonianCrawler.
+#
+# SantonianCrawler is free software: you can redistribute
+# it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, either
+# version 3 of the License, or (at your option) any later version.
+#
+# SantonianCrawler is distributed in the hope that it will
+# be useful, but WITHOUT ANY WARRANTY; without even the implied warranty
+# of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# @license GPL-3.0-only <https://www.gnu.org/licenses/gpl-3.0.en.html>
+
+
+import gzip
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import weakref
+import re
+from collections import namedtuple
+from datetime import datetime
+from functools import lru_cache
+from types import MappingProxyType
+from config import mirror_compress_min, mirror_per_page, mirror_per_page_max
+from database_util import SantonianDB
+
+try:
+    import brotli
+except ImportError:
+    brotli = None  # * optional, gzip alone does fine
+
+logger = logging.getLogger(__name__)
+
+# * what the mirror keeps of a response, the body exactly as sent, its strong etag and the compressed forms of the
+# * body by content coding, eg. {'gzip': b'...'}, empty for bodies that are too small to bother
+Rendered = namedtuple("Rendered", ("body", "etag", "encoded"))
+
+# * content codings the mirror can send, preferred first
+ENCODINGS = ("br", "gzip") if brotli else ("gzip", )
+
+
+def render_json(payload) -> bytes:
+    """
+    Byte for byte what flask.jsonify sends outside of debug mode (compact, sorted keys, ascii only, trailing
+    newline), rendering it ourselves makes the body cacheable
+    """
+    return (json.dumps(payload, separators=(",", ":"), sort_keys=True) + "\n").encode("utf-8")
+
+
+def compress_body(body: bytes) -> dict:
+    """
+    Every available compressed form of a body, only the ones that actually turned out smaller. Done once per
+    rendered body with the highest levels, the result is served many times
+
+    :param bytes body: the rendered json
+    :return: compressed bodies by content coding
+    :rtype: dict
+    """
+    if len(body) < mirror_compress_min:
+        return {}
+    encoded = {'gzip': gzip.compress(body, compresslevel=9, mtime=0)}  # * mtime=0 keeps the bytes reproducible
+    if brotli:
+        encoded['br'] = brotli.compress(body, quality=11)
+    return {coding: data for coding, data in encoded.items() if len(data) < len(body)}
+
+
+def pick_encoding(accept_encoding: str, available) -> str or None:
+    """
+    Negotiates the content coding from an Accept-Encoding header, highest q-value first, our own preference
+    (ENCODINGS order) between equal ones, a q of 0 rules a coding out even if '*' is also given
+
+    :param str accept_encoding: value of the request header, may be empty
+    :param available: the codings there are bodies for, see Rendered.encoded
+    :return: the coding to send or None for the uncompressed body
+    :rtype: str or None
+    """
+    weights = {}
+    for part in accept_encoding.split(","):
+        coding, _, params = part.strip().partition(";")
+        coding, params = coding.strip().lower(), params.strip().replace(" ", "")
+        if not coding:
+            continue
+        q = 1.0
+        if params.startswith("q="):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        weights[coding] = q
+    best, best_q = None, 0.0
+    for coding in ENCODINGS:
+        if coding not in available:
+            continue
+        q = weights.get(coding, weights.get("*", 0.0))
+        if q > best_q:
+            best, best_q = coding, q
+    return best
+
+
+def select_variant(rendered: Rendered, accept_encoding: str) -> tuple:
+    """
+    :param Rendered rendered: the cached response
+    :param str accept_encoding: value of the request header, may be empty
+    :return: body, etag and content coding (None for none) to send, every coding has its own strong etag
+    :rtype: tuple
+    """
+    if coding := pick_encoding(accept_encoding, rendered.encoded):
+        return rendered.encoded[coding], f"{rendered.etag}-{coding}", coding
+    return rendered.body, rendered.etag, None
+
+
+def db_generation(db_file: str) -> tuple:
+    """
+    A token that changes with every committed write to the database, without asking sqlite at all. In rollback
+    journal mode every commit increments the file change counter in the header (4 bytes at offset 24), in WAL
+    mode that counter stays put but the -wal file grows or gets rewritten instead
+
+    :param str db_file: path to the sqlite file
+    :return: tuple that can be compared with an older one
+    :rtype: tuple
+    """
+    try:
+        with open(db_file, "rb") as db:
+            db.seek(24)
+            counter = db.read(4)
+    except OSError:
+        counter = b""
+    try:
+        wal = os.stat(f"{db_file}-wal")
+        wal_state = (wal.st_size, wal.st_mtime_ns)
+    except OSError:
+        wal_state = None
+    return counter, wal_state
+
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    """
+    If-None-Match evaluation for the asgi app (flask has werkzeug for that), a list of quoted tags, weak ones
+    included, or a '*'
+
+    :param str if_none_match: value of the request header, may be empty
+    :param str etag: the current etag without quotes
+    :return: True if the client already has that version
+    :rtype: bool
+    """
+    for tag in if_none_match.split(","):
+        tag = tag.strip()
+        if tag.startswith("W/"):
+            tag = tag[2:]
+        if tag == "*" or tag.strip('"') == etag:
+            return True
+    return False
+
+
+class RenderCache:
+    """
+    Rendered response bodies by route and argument, all of them are dropped together as soon as the source
+    changes. With a LiveSource a hit costs one small read of the database header and a dict lookup, with a
+    SnapshotSource only the lookup, sqlite is never involved
+    """
+    def __init__(self, generation, max_entries=4096):
+        """
+        :param generation: callable that returns a token that changes with the data, see LiveSource.generation
+        :param int max_entries: bodies beyond that are rendered for every request
+        """
+        self.generation = generation
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries = {}
+        self._encoded = {}  # * by etag, survives new generations, an unchanged log is not compressed again
+        self._generation = None
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def peek(self, key) -> Rendered or None:
+        """
+        The cached body if there is one, never renders. For the asgi app that renders in a worker thread but
+        answers hits right away
+        """
+        self._check_generation()
+        if (rendered := self._entries.get(key)) is not None:
+            self.hits += 1
+        return rendered
+
+    def _check_generation(self):
+        generation = self.generation()
+        if generation != self._generation:
+            with self._lock:
+                if generation != self._generation:
+                    self._entries = {}  # * a new dict instead of clear(), readers of the old one are not disturbed
+                    self._generation = generation
+
+    def get(self, key, producer) -> Rendered:
+        """
+        :param key: anything hashable, eg. ('readFile', 'FTR-044-V')
+        :param producer: callable that returns the payload if there is no rendered body yet
+        :return: the cached or newly rendered body
+        :rtype: Rendered
+        """
+        self._check_generation()
+        entries = self._entries
+        if (rendered := entries.get(key)) is not None:
+            self.hits += 1
+            return rendered
+        self.misses += 1
+        body = render_json(producer())
+        etag = hashlib.sha256(body).hexdigest()[:32]
+        if (encoded := self._encoded.get(etag)) is None:
+            encoded = MappingProxyType(compress_body(body))
+            if len(self._encoded) >= self.max_entries:
+                self._encoded = {}  # ! crude, but the entries of the current generation get back in quickly
+            self._encoded[etag] = encoded
+        rendered = Rendered(body, etag, encoded)
+        if len(entries) < self.max_entries:
+            entries[key] = rendered
+        return rendered
+
+
+class LiveSource:
+    """
+    Answers the questions of the mirror routes straight from the database. Every worker thread keeps its own
+    connection as sqlite objects must not wander between threads, that way the query cache survives from one
+    request to the next and gets dropped by data_version once a crawl wrote something
+    """
+    def __init__(self, db_file: str, cache_size=0, trace=None):
+        """
+        :param str db_file: path to the sqlite file
+        :param int cache_size: size of the query cache of every connection
+        :param trace: optional callable that gets every statement of every connection, eg. Metrics.count_query
+        """
+        self.db_file = db_file
+        self.cache_size = cache_size
+        self.trace = trace
+        self._local = threading.local()
+        # * only for cache_info, weak so the connection of a finished thread still goes away with its thread-local
+        self._backends = weakref.WeakSet()
+
+    def backend(self) -> SantonianDB:
+        if getattr(self._local, "backend", None) is None:
+            self._local.backend = SantonianDB(self.db_file, cache_size=self.cache_size)
+            if self.trace:
+                self._local.backend.db.set_trace_callback(self.trace)
+            self._backends.add(self._local.backend)
+        return self._local.backend
+
+    def cache_info(self) -> tuple:
+        """
+        :return: hits, misses and entries of the query caches of all connections together
+        :rtype: tuple
+        """
+        infos = [x.cache.info() for x in list(self._backends) if x.cache]
+        return tuple(sum(x[key] for x in infos) for key in ('hits', 'misses', 'size'))
+
+    def generation(self) -> tuple:
+        return db_generation(self.db_file)
+
+    def folders(self) -> list:
+        return [x['name'] for x in self.backend().get_all_folders()]
+
+    def folder_id(self, disk: str) -> int or None:
+        return self.backend().get_folder_santa_id(disk)
+
+    def listing(self, disk_id: int, start=0, limit=-1) -> list or None:
+        backend = self.backend()
+        if not (folder_name := backend.get_folder_by_santa_id(disk_id)):
+            return None
+        return [row.name for row in backend.iter_logs(("name", ), folder_name, start=start, limit=limit)]
+
+    def listing_size(self, disk_id: int) -> int or None:
+        backend = self.backend()
+        if not (folder_name := backend.get_folder_by_santa_id(disk_id)):
+            return None
+        return backend.count_logs_of_folder(folder_name)
+
+    def iter_listing(self, disk_id: int):
+        """
+        The full listing one name after another, with its own connection that may be advanced by different threads
+        (one at a time) and is closed once the generator is done or closed
+        """
+        backend = SantonianDB(self.db_file, check_same_thread=False)
+        if self.trace:
+            backend.db.set_trace_callback(self.trace)
+        try:
+            if folder_name := backend.get_folder_by_santa_id(disk_id):
+                for row in backend.iter_logs(("name", ), folder_name):
+                    yield row.name
+        finally:
+            backend.close()
+
+    def log_body(self, file_name: str) -> str or None:
+        backend = self.backend()
+        handle = backend.get_log(backend.get_log_name_extension_blind(file_name))
+        # crawler has revisions, give only newest one, the others are never loaded
+        return handle.newest['content'] if handle else None
+
+
+# * everything the mirror routes need, loaded in one go, the mappings are read only views, folder_ids are
+# * (name, file_id) pairs in the order of the folders table
+Snapshot = namedtuple("Snapshot", ("generation", "folders", "folder_ids", "listings", "logs"))
+
+
+@lru_cache(maxsize=256)
+def sql_like(pattern: str):
+    """
+    sqlite's LIKE as a regular expression, '%' is any text, '_' any single character and only ascii letters are
+    case insensitive, so the snapshot finds the same folders get_folder_santa_id finds
+
+    :param str pattern: the right hand side of a LIKE
+    :return: compiled expression to use with fullmatch
+    """
+    parts = [".*" if char == "%" else "." if char == "_" else re.escape(char) for char in pattern]
+    return re.compile("".join(parts), re.IGNORECASE | re.ASCII | re.DOTALL)
+
+
+def load_snapshot(db_file: str) -> Snapshot:
+    """
+    Reads everything the mirror serves inside one read transaction, so the snapshot is consistent even if a crawl
+    writes at the same time. Listings are in insertion order with one entry per revision like list_logs_of_folder,
+    bodies are the newest revision of the newest log per extension-less name like the readFile route finds them
+
+    :param str db_file: path to the sqlite file
+    :return: the immutable snapshot
+    :rtype: Snapshot
+    """
+    generation = db_generation(db_file)  # * before reading, a write during the load triggers the next one
+    backend = SantonianDB(db_file)
+    try:
+        backend.cur.execute("BEGIN;")
+        folders = backend.get_all_folders(limit=-1)
+        folder_ids = tuple((x['name'], int(x['file_id'])) for x in folders)
+        listings = {int(x['file_id']): [] for x in folders}
+        by_folder = {x['name']: listings[int(x['file_id'])] for x in folders}
+        newest, stems = {}, {}
+        for row in backend.iter_logs(("uid", "name", "folder", "revision", "content")):
+            by_folder[row.folder].append(row.name)
+            if row.name not in newest or row.revision >= newest[row.name][0]:
+                newest[row.name] = (row.revision, row.content)
+            stem = row.name.partition(".")[0].lower()
+            if stem not in stems or row.revision >= stems[stem][0]:
+                stems[stem] = (row.revision, row.name)
+        backend.cur.execute("COMMIT;")
+    finally:
+        backend.close()
+    return Snapshot(generation,
+                    tuple(x['name'] for x in folders[:25]),  # * the first page of get_all_folders, like the live source
+                    folder_ids,
+                    MappingProxyType({key: tuple(value) for key, value in listings.items()}),
+                    MappingProxyType({stem: newest[name][1] for stem, (_revision, name) in stems.items()}))
+
+
+class SnapshotSource:
+    """
+    Serving mode for a mirror whose data only changes when a crawl runs: everything is loaded into a Snapshot at
+    start and every answer is a dict lookup. A watcher thread looks at the database header every few seconds and
+    loads a new snapshot once something changed, replacing the reference is atomic so a request sees either the
+    old or the new one but never a mix
+    """
+    def __init__(self, db_file: str, interval=5.0):
+        """
+        :param str db_file: path to the sqlite file
+        :param float interval: seconds between two looks at the database, 0 or less starts no watcher
+        """
+        self.db_file = db_file
+        self.interval = interval
+        self.snapshot = load_snapshot(db_file)
+        self._stop = threading.Event()
+        self._watcher = None
+        if interval > 0:
+            self._watcher = threading.Thread(target=self._watch, name="snapshot-watcher", daemon=True)
+            self._watcher.start()
+
+    def _watch(self):
+        while not self._stop.wait(self.interval):
+            self.refresh()
+
+    def refresh(self) -> bool:
+        """
+        :return: True if a new snapshot was loaded
+        :rtype: bool
+        """
+        if db_generation(self.db_file) == self.snapshot.generation:
+            return False
+        try:
+            self.snapshot = load_snapshot(self.db_file)
+        except sqlite3.Error as err:  # * the old snapshot stays, next round tries again
+            logger.warning(f"Mirror>refresh: cannot load snapshot: {err}")
+            return False
+        return True
+
+    def stop(self):
+        self._stop.set()
+        if self._watcher:
+            self._watcher.join()
+
+    def generation(self) -> tuple:
+        return self.snapshot.generation
+
+    def folders(self) -> list:
+        return list(self.snapshot.folders)
+
+    def folder_id(self, disk: str) -> int or None:
+        like = sql_like(disk)  # * the first match, like the live source that asks sqlite with LIKE
+        return next((file_id for name, file_id in self.snapshot.folder_ids if like.fullmatch(name)), None)
+
+    def listing(self, disk_id: int, start=0, limit=-1) -> list or None:
+        if (names := self.snapshot.listings.get(disk_id)) is None:
+            return None
+        return list(names[start:start + limit if limit >= 0 else None])
+
+    def listing_size(self, disk_id: int) -> int or None:
+        names = self.snapshot.listings.get(disk_id)
+        return None if names is None else len(names)
+
+    def iter_listing(self, disk_id: int):
+        return iter(self.snapshot.listings.get(disk_id, ()))
+
+    def cache_info(self) -> tuple:
+        return 0, 0, 0  # * no query cache, the snapshot is all there is
+
+    def log_body(self, file_name: str) -> str or None:
+        return self.snapshot.logs.get(file_name.lower())
+
+
+def parse_since(value: str) -> str:
+    """
+    :param str value: an iso date or date and time from a request, eg. '2049-05-01' or '2049-05-01T12:00'
+    :return: the same point in time in the format the database stores its timestamps
+    :rtype: str
+    :raises ValueError: for everything that is not an iso date
+    """
+    return str(datetime.fromisoformat(value.strip()))
+
+
+def export_ndjson(db_file: str, since=None, chunk_size=64 * 1024, check_same_thread=True, trace=None):
+    """
+    The whole archive as newline delimited json, one record of SantonianDB.iter_export per line, handed out in
+    chunks of roughly chunk_size bytes. Uses its own connection and a single read transaction so a crawl that
+    writes in the meantime cannot tear the export apart, memory stays at one chunk no matter the size of the
+    database. Closing the generator early (client went away) ends the transaction
+
+    :param str db_file: path to the sqlite file
+    :param str since: optional timestamp, see parse_since and iter_export
+    :param int chunk_size: bytes collected before a chunk is handed out
+    :param bool check_same_thread: False if the generator is advanced by more than one thread (one at a time)
+    :param trace: optional trace callback for the connection, see LiveSource
+    :return: generator of bytes
+    """
+    backend = SantonianDB(db_file, check_same_thread=check_same_thread)
+    if trace:
+        backend.db.set_trace_callback(trace)
+    try:
+        backend.cur.execute("BEGIN;")
+        chunk, size = [], 0
+        for record in backend.iter_export(since):
+            line = (json.dumps(record, separators=(",", ":")) + "\n").encode("utf-8")
+            chunk.append(line)
+            size += len(line)
+            if size >= chunk_size:
+                yield b"".join(chunk)
+                chunk, size = [], 0
+        if chunk:
+            yield b"".join(chunk)
+        backend.cur.execute("COMMIT;")
+    finally:
+        backend.close()
+
+
+# ? the payloads of the routes, the same for every source and for the flask and the asgi app
+
+def payload_hdd(source) -> list:
+    return source.folders()
+
+
+def payload_hdd_details(source, disk: str) -> dict:
+    if raw := source.folder_id(disk):
+        return {'type': "OK", 'message': [raw]}
+    else:
+        return {'type': "ERR", 'message': "[[b;#b0e6fd;]{disk}] is not a valid folder.".format(disk=disk)}
+
+
+def payload_file(source, disk_id: int, page=None, per_page=None) -> list or str:
+    if page is None:
+        files = source.listing(disk_id)
+    else:
+        files = source.listing(disk_id, start=page * per_page, limit=per_page)
+    return "" if files is None else files  # emptiest of all jsons
+
+
+def page_params(page, per_page) -> tuple or None:
+    """
+    :param str page: value of the 'page' request parameter (counted from 0) or None
+    :param str per_page: value of the 'per_page' request parameter or None
+    :return: None if the client wants the full listing, otherwise page and per_page, garbage turns into defaults
+             and pages beyond what sqlite can count to into the last one it can
+    :rtype: tuple or None
+    """
+    if page is None and per_page is None:
+        return None
+    try:
+        page = max(int(page or 0), 0)
+    except ValueError:
+        page = 0
+    try:
+        per_page = min(max(int(per_page or mirror_per_page), 1), mirror_per_page_max)
+    except ValueError:
+        per_page = mirror_per_page
+    page = min(page, (2 ** 63 - 1) // per_page - 1)  # ! the offset has to fit into a sqlite integer
+    return page, per_page
+
+
+def stream_json_array(items, chunk_size=64 * 1024):
+    """
+    render_json of a list, but piece by piece while the items come in, the bytes are exactly the same
+
+    :param items: iterable of json serializable values, eg. LiveSource.iter_listing
+    :param int chunk_size: bytes collected before a chunk is handed out
+    :return: generator of bytes
+    """
+    chunk, size = [b"["], 1
+    try:
+        for i, item in enumerate(items):
+            piece = (("," if i else "") + json.dumps(item, separators=(",", ":"), sort_keys=True)).encode("utf-8")
+            chunk.append(piece)
+            size += len(piece)
+            if size >= chunk_size:
+                yield b"".join(chunk)
+                chunk, size = [], 0
+        chunk.append(b"]\n")
+        yield b"".join(chunk)
+    finally:
+        if hasattr(items, "close"):  # * a generator with its own connection gives it back right away
+            items.close()
+
+
+def payload_read_file(source, file_name: str) -> str:
+    body = source.log_body(file_name)
+    return "NO ITEM WITH THAT NAME" if body is None else body
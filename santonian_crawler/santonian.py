@@ -25,8 +25,10 @@ from datetime import datetime, date
 import requests
 import logging
 import json
+import hashlib
 import html
 import os
+import tempfile
 from time import sleep
 from typing import Union
 from pathlib import Path
@@ -104,6 +106,88 @@ def _generic_get_simplifier(url: str):
     return True, data
 
 
+def blob_path(blob_dir: Union[str, Path], digest: str, suffix=".mp3") -> str:
+    """
+    Location of a file in the content addressed blob store, the first two characters of the hash are a sub folder
+    so no single folder ends up with thousands of files
+    """
+    return os.path.join(blob_dir, digest[:2], f"{digest}{suffix}")
+
+
+def _stream_download(url: str, folder: Union[str, Path], chunk_size: int):
+    """
+    Streams a file into a temporary .part file in folder and calculates its sha256 on the way. Whatever goes wrong,
+    a broken download (connection, full disk, ctrl+c) never leaves the .part file behind
+
+    :return: (True, (part file name, sha256, size)) or (False, error dictionary)
+    :rtype: tuple
+    """
+    digest = hashlib.sha256()
+    size = 0
+    part = None
+    complete = False
+    try:
+        with requests.get(url, stream=True, timeout=30) as payload:
+            if payload.status_code != 200:
+                return False, {'code': payload.status_code, 'type': "code"}
+            with tempfile.NamedTemporaryFile(dir=folder, suffix=".part", delete=False) as part:
+                for chunk in payload.iter_content(chunk_size):
+                    digest.update(chunk)
+                    part.write(chunk)
+                    size += len(chunk)
+        complete = True
+    except requests.RequestException as err:
+        return False, {'code': 0, 'type': "connection", 'content': str(err)}
+    finally:
+        if part and not complete:
+            os.remove(part.name)
+    return True, (part.name, digest.hexdigest(), size)
+
+
+def download_file(url: str, path: Union[str, Path], chunk_size=64*1024):
+    """
+    Streams a file to path, the file only appears there once the download is complete
+
+    :param str url: direct link to the file
+    :param path: where the file should end up, an existing one is replaced
+    :param int chunk_size: bytes per read
+    :return: (True, {'hash': str, 'size': int, 'path': str}) or (False, error dictionary)
+    :rtype: tuple
+    """
+    status, result = _stream_download(url, os.path.dirname(os.path.abspath(path)), chunk_size)
+    if not status:
+        return False, result
+    part_name, digest, size = result
+    os.replace(part_name, path)
+    return True, {'hash': digest, 'size': size, 'path': str(path)}
+
+
+def download_audio(url: str, blob_dir: Union[str, Path], chunk_size=64*1024):
+    """
+    Streams an audio file into the blob store, the sha256 is calculated chunk by chunk while downloading so the file
+    is never in memory as a whole. The download goes into a temporary file first and is only moved to its final,
+    hash derived name once complete, a file that is already stored is not stored a second time
+
+    :param str url: direct link to the file
+    :param blob_dir: root folder of the blob store
+    :param int chunk_size: bytes per read
+    :return: (True, {'hash': str, 'size': int, 'path': str}) or (False, error dictionary)
+    :rtype: tuple
+    """
+    os.makedirs(blob_dir, exist_ok=True)
+    status, result = _stream_download(url, blob_dir, chunk_size)
+    if not status:
+        return False, result
+    part_name, digest, size = result
+    target = blob_path(blob_dir, digest)
+    if os.path.exists(target):
+        os.remove(part_name)
+    else:
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        os.replace(part_name, target)
+    return True, {'hash': digest, 'size': size, 'path': target}
+
+
 class SantonianLog:
     def __init__(self, name="", content="", audio_path=None):
         self._hash = ""
@@ -20,17 +20,15 @@
 # @license GPL-3.0-only <https://www.gnu.org/licenses/gpl-3.0.en.html>
 
 from cmd import Cmd
+import csv
 import re
 import logging
-from datetime import datetime, timedelta
 # * this package
-import requests
-
 import santonian_crawler.database_util as database_util
-from santonian_crawler.util import simple_console_view, str_refinement, check_for_mp3_link, audio_sparklines, \
+from santonian_crawler.util import simple_console_view, str_refinement, check_for_mp3_link, \
     storage_sparkline_to_sparkline
-from santonian_crawler.santonian import list_folders, read_log
-from santonian_crawler.config import api_calls
+from santonian_crawler.santonian import list_folders, read_log, download_file, blob_path
+from santonian_crawler.config import api_calls, db_cache_size
 
 __ver__ = 0.24
 
@@ -44,10 +42,15 @@ class SantonianShell(Cmd):
 
     def __init__(self, db_path="santonian.db"):
         super().__init__()
-        self.backend = database_util.SantonianDB(db_path)
+        self.backend = database_util.SantonianDB(db_path, cache_size=db_cache_size)
         # this has a simple mode for just names, the get all logs would give us superflous info we dont want
         self.log_names = self.backend.list_logs_of_folder(folder="%", per_page=500)  # ? for autocomplete
 
+    def precmd(self, line):
+        # * cmd only knows commands made of identchars, so 'similar-audio' becomes 'similar_audio'
+        command, separator, rest = line.partition(" ")
+        return command.replace("-", "_") + separator + rest
+
     def do_list(self, args):
         """usage: list <folder/*>
             [filter: 'text']
@@ -81,6 +84,15 @@ class SantonianShell(Cmd):
             if fine_args['page'] < 1:
                 fine_args['page'] = 1
             start = (fine_args['page']-1)*fine_args['limit']
+            if fine_args['view'] != "complex" and fine_args['order'][0] != "tag_date":
+                # * names only, no need to drag content and tags along
+                for line in self.backend.iter_logs(("name", "sparkline"),
+                                                   start=start,
+                                                   limit=fine_args['limit'],
+                                                   order=fine_args['order'][1],
+                                                   order_field=fine_args['order'][0]):
+                    SantonianShell._print_name_sparkline(line)
+                return False
             raw_data = self.backend.get_all_logs(start,
                                                  fine_args['limit'],
                                                  fine_args['order'][1],
@@ -90,11 +102,20 @@ class SantonianShell(Cmd):
                 for line in raw_data:
                     print(line['name'])
             else:
+                for line in raw_data:  # * the link of an audio log says little, its sparkline a lot more
+                    if line['sparkline']:
+                        line['content'] = storage_sparkline_to_sparkline(line['sparkline'])
                 simple_console_view([x for x in catalyst.keys()], str_refinement(raw_data, catalyst))
         else:
-            files = self.backend.list_logs_of_folder(arguments[0])
-            for line in files:
-                print(line)
+            for line in self.backend.iter_logs(("name", "sparkline"), folder=arguments[0], limit=20):
+                SantonianShell._print_name_sparkline(line)
+
+    @staticmethod
+    def _print_name_sparkline(line):
+        if line.sparkline:
+            print(f"{line.name:<20} {storage_sparkline_to_sparkline(line.sparkline)}")
+        else:
+            print(line.name)
 
     def complete_list(self, line, text, start, end):
         sub_para = ["filter:", "order:", "limit:", "page:", "view:", "tags:"]
@@ -149,6 +170,33 @@ it will default back to name"""
         else:
             print("This functions needs exactly two parameters, tag_name and tag_type")
 
+    def do_dictionary(self, args):
+        """usage: dictionary
+               dictionary add <tag_name> <type:name or entity> [term with spaces]
+               dictionary import <file.csv>
+
+        maintains the terms 'proc entity_tag' looks for, every term points to a tag, without a term the tag name
+        itself is the term. The csv file has one 'term,tag_name,type' per line, type may be omitted"""
+        arguments = args.split(" ")
+        if arguments[0] == "add" and len(arguments) >= 3:
+            term = " ".join(arguments[3:]) or arguments[1]
+            created = self.backend.add_dictionary_terms([(term, arguments[1], arguments[2])])
+            print(f"Added term '{term}' for tag '{arguments[1]}'" if created else f"Term '{term}' already known")
+        elif arguments[0] == "import" and len(arguments) == 2:
+            try:
+                with open(arguments[1], "r", newline="") as csv_file:
+                    entries = [(row[0], row[1], row[2] if len(row) > 2 else "name")
+                               for row in csv.reader(csv_file) if len(row) >= 2]
+            except FileNotFoundError:
+                print(f"Cannot find file '{arguments[1]}'")
+                return False
+            created = self.backend.add_dictionary_terms(entries)
+            print(f"Imported {created} new terms out of {len(entries)} lines")
+        elif str(args).strip() == "":
+            print(f"The dictionary knows {self.backend.count_dictionary_terms()} terms, run 'proc entity_tag'")
+        else:
+            print("Unknown parameters used, see help for correct ones")
+
     def do_read(self, args):
         """usage: read <log_name> [revision: <int>]
 
@@ -157,23 +205,21 @@ it will default back to name"""
         """
         arguments = args.split(" ")
         if len(arguments) > 0:
-            raw_data = self.backend.get_log_content(arguments[0])
-            if raw_data and isinstance(raw_data, dict):
-                print(f"Revision: {raw_data['revision']}, Last Check: {raw_data['last_check']}")
-                print(raw_data['content'])
+            handle = self.backend.get_log(arguments[0])
+            if handle and handle.revision_count <= 1:
+                print(f"Revision: {handle.newest['revision']}, Last Check: {handle.newest['last_check']}")
+                print(handle.newest['content'])
+                self._print_audio(handle.newest)
+                self._print_related(handle.name)
                 return False
-            elif raw_data and isinstance(raw_data, list):
+            elif handle:
                 para_desc = {'revision': "int"}
                 fine_args = SantonianShell._extract_argument_parameter(args, para_desc)
-                rev = -1
+                choosen_log = None
                 if 'revision' in fine_args:
-                    rev = fine_args['revision']
-                for each in raw_data:
-                    if each['revision'] == rev:
-                        choosen_log = each
-                        break
-                else:
-                    choosen_log = raw_data[0]
+                    choosen_log = handle.revision(fine_args['revision'])  # * only this one gets loaded
+                if not choosen_log:
+                    choosen_log = handle.newest
                 top_line = f"Revision: {choosen_log['revision']}, Last Check: {choosen_log['last_check']}"
                 print(top_line)
                 if choosen_log['tags'].strip() != "":
@@ -181,6 +227,8 @@ it will default back to name"""
                 print(Cmd.ruler*len(top_line))    # ====
                 print(choosen_log['content'])     # content
                 print(Cmd.ruler * len(top_line))  # ====
+                self._print_audio(choosen_log)
+                self._print_related(handle.name)
                 return False
             elif len(arguments[0]) > 0:
                 possibilities = [name for name in self.log_names if name.startswith(arguments[0])]
@@ -195,20 +243,186 @@ it will default back to name"""
     def complete_read(self, text, line, start, end):
         return self._complete_log_names(text, line, start, end, "read")
 
-    def do_proc(self, args):
-        """usage: proc <pro_name>
+    def _print_audio(self, log: dict):
+        if log['aud_hash']:
+            print(f"Audio: {blob_path(self.backend.blob_dir, log['aud_hash'])}")
+        if log['sparkline']:
+            print(f"[{storage_sparkline_to_sparkline(log['sparkline'])}]")
+
+    def _print_related(self, log_name: str):
+        if related := self.backend.related_logs(log_name):
+            print(f"Related: {', '.join(x['name'] for x in related)}")
+
+    def do_grep(self, args):
+        """usage: grep [-i] [-F] <pattern>
+
+        searches the newest revision of all logs for a regular expression, -i ignores case, -F looks for the text
+        as it is. Everything after the options is the pattern, spaces included. Uses the trigram index, logs from
+        before it existed are only indexed by 'proc trigram'"""
+        arguments = args.split(" ")
+        options = set()
+        while arguments and arguments[0] in ("-i", "-F"):
+            options.add(arguments.pop(0))
+        pattern = " ".join(arguments)
+        if pattern.strip() == "":
+            print("This function needs a pattern to look for")
+            return False
+        found = self.backend.grep(pattern, regex="-F" not in options, ignore_case="-i" in options)
+        if found is None:
+            print(f"'{pattern}' is not a valid regular expression, use -F for plain text")
+            return False
+        for line in found:
+            print(f"{line['name']}:{line['line']}: {line['text']}")
+        print(f"{len(found)} matching lines in {len({x['name'] for x in found})} logs")
+
+    def do_duplicates(self, args):
+        """usage: duplicates [<log_name>]
+
+        lists the near copies of a log with their estimated similarity, without a name all groups of near copies
+        are shown, needs 'proc minhash' to be run first"""
+        arguments = args.split(" ")
+        if arguments[0].strip() == "":
+            clusters = self.backend.near_duplicate_clusters()
+            for cluster in clusters:
+                print(", ".join(cluster))
+            print(f"{len(clusters)} groups of near copies")
+            return False
+        duplicates = self.backend.near_duplicates(arguments[0])
+        if not duplicates:
+            print(f"No near copies of '{arguments[0]}' known")
+        for line in duplicates:
+            print(f"{line['similarity']:>6.1%}  {line['name']}")
+
+    def complete_duplicates(self, text, line, start, end):
+        return self._complete_log_names(text, line, start, end, "duplicates")
+
+    def do_similar_audio(self, args):
+        """usage: similar-audio <log_name> [<number>]
+
+        lists the audio logs whose sparkline has the most similar shape, smaller distance is closer, needs
+        'proc sparklines' to be run first"""
+        arguments = args.split(" ")
+        if arguments[0].strip() == "":
+            print("This function needs the name of an audio log")
+            return False
+        limit = int(arguments[1]) if len(arguments) > 1 and arguments[1].isdigit() else 5
+        similar = self.backend.similar_audio(arguments[0], limit)
+        if not similar:
+            print(f"No fingerprint for '{arguments[0]}', is it an audio log and was 'proc sparklines' run?")
+        for line in similar:
+            print(f"{line['distance']:>6.3f}  {line['name']}")
+
+    def complete_similar_audio(self, text, line, start, end):
+        return self._complete_log_names(text, line, start, end, "similar_audio")
+
+    def do_timeline(self, args):
+        """usage: timeline [year/month]
+               timeline <start: YYYY-MM-DD> <end: YYYY-MM-DD>
+
+        without a range it shows how many logs fall in every in-universe year (or month), with a range it lists
+        all logs in between chronologically, dates come from 'proc date_tag'"""
+        arguments = args.split(" ")
+        if len(arguments) == 2:
+            logs = self.backend.logs_between(arguments[0], arguments[1])
+            for line in logs:
+                print(f"{line['day']}  {line['name']}")
+            print(f"{len(logs)} logs between {arguments[0]} and {arguments[1]}")
+            return False
+        histogram = self.backend.date_histogram(arguments[0] if arguments[0] else "year")
+        if not histogram:
+            print("No dated logs yet, try 'proc date_tag'")
+            return False
+        highest = max(histogram.values())
+        for period, num in histogram.items():
+            print(f"{period:<8} {num:>5} {'█' * max(1, int(num / highest * 50))}")
+
+    def do_cooccurring(self, args):
+        """usage: cooccurring <tag_name> [<other_tag_name>]
 
-        executes set procedures over the data, mostly maintenance things
+        lists the tags that appear together with the given tag most often, with a second tag all logs carrying
+        both of them are listed instead"""
+        arguments = args.split(" ")
+        if arguments[0].strip() == "":
+            print("This function needs at least one parameter, tag_name")
+            return False
+        if len(arguments) > 1:
+            logs = self.backend.logs_with_tags(arguments[0], arguments[1])
+            for name in logs:
+                print(name)
+            print(f"{len(logs)} logs tagged with both '{arguments[0]}' and '{arguments[1]}'")
+            return False
+        tags = self.backend.top_cooccurring(arguments[0], limit=20)
+        if not tags:
+            print(f"No tag appears together with '{arguments[0]}'")
+        for line in tags:
+            print(f"{line['weight']:>5}  {line['name']} ({line['type']})")
+
+    def do_tagpath(self, args):
+        """usage: tagpath <tag_name> <other_tag_name>
 
-        * date_tag - puts a date tag on each log that does not posess a date tag yet, uses first date it finds"""
+        shortest chain of tags that connects two tags, every hop shows some of the logs both tags appear in"""
         arguments = args.split(" ")
-        if len(arguments) != 1 or str(args).strip() == "":
+        if len(arguments) != 2:
+            print("This functions needs exactly two parameters, two tag names")
             return False
-        if arguments[0] == "date_tag":
-            time_zero = datetime.now()
-            dates = self.backend.procedure_tag_date()
-            time_one = datetime.now()
-            print(f"Created {len(dates)} date tags based on regex match on all entries without a date tag")
+        path = self.backend.tag_path(arguments[0], arguments[1])
+        if not path:
+            print(f"There is no connection between '{arguments[0]}' and '{arguments[1]}'")
+        for hop in path:
+            print(f"{hop['from']} -> {hop['to']}  [{', '.join(hop['logs'])}]")
+
+    def do_proc(self, args):
+        """usage: proc [<pro_name> [full]]
+
+        executes set procedures over the data, mostly maintenance things, without a name it lists all of them
+        with their last run. Most procedures only look at logs added since their last run, 'full' starts over
+
+        * date_tag - puts a date tag on each log that does not posess a date tag yet, uses first date it finds
+        * minhash - signatures for finding near copies of logs, see 'duplicates'
+        * entity_tag - tags logs with the name/entity tags of every dictionary term they mention, see 'dictionary'
+        * tfidf - matrix of word weights behind the 'Related:' line of read, always over all logs
+        * sparklines - sparkline of every downloaded audio file without one, decoding mp3 needs ffmpeg
+        * trigram - index of all log bodies behind 'grep', new logs are indexed on insert already
+        * cooccurrence - counts which tags appear together from scratch, tagging keeps it current on its own
+        * maintain - ANALYZE, incremental vacuum and page/mmap size tuning, prints size and query timings"""
+        arguments = args.split(" ")
+        if str(args).strip() == "":
+            for status in self.backend.procedure_status():
+                print(f"{status['name']:<12} {status['description']}")
+                print(f"{'':<12} last run: {status['last_run'] or 'never'}, took {status['duration'] or '-'}s, "
+                      f"up to log #{status['watermark']}")
+            print(f"{'tfidf':<12} matrix of word weights behind the 'Related:' line of read")
+            print(f"{'sparklines':<12} sparklines of the downloaded audio files, shown by list and read")
+            print(f"{'cooccurrence':<12} counts which tags appear together, see 'cooccurring' and 'tagpath'")
+            print(f"{'maintain':<12} ANALYZE, incremental vacuum and page/mmap size tuning")
+            return False
+        if arguments[0] == "maintain":
+            report = self.backend.procedure_maintain()
+            print(f"File size: {report['size_before']} -> {report['size_after']} bytes")
+            for label, before in report['timing_before'].items():
+                after = report['timing_after'][label]
+                print(f"{label:<20} {before*1000:>9.3f} ms -> {after*1000:>9.3f} ms")
+        elif arguments[0] == "tfidf":
+            report = self.backend.procedure_tfidf(full=len(arguments) > 1 and arguments[1] == "full")
+            if report['logs'] <= 0:
+                print("No new logs since the last build, use 'proc tfidf full' to force it")
+            else:
+                print(f"TF-IDF over {report['logs']} logs and {report['terms']} terms in {report['duration']:.2f}s")
+        elif arguments[0] == "sparklines":
+            report = self.backend.procedure_sparklines(full=len(arguments) > 1 and arguments[1] == "full")
+            print(f"{report['processed']} sparklines computed in {report['duration']:.2f}s")
+            if report['failed']:
+                print(f"{report['failed']} audio files could not be read, mp3 needs ffmpeg to be installed")
+        elif arguments[0] == "cooccurrence":
+            report = self.backend.procedure_cooccurrence()
+            print(f"{report['pairs']} tag pairs counted in {report['duration']:.2f}s")
+        elif arguments[0] in self.backend.procedures:
+            full = len(arguments) > 1 and arguments[1] == "full"
+            report = self.backend.run_procedure(arguments[0], full=full)
+            print(f"{arguments[0]}: {report['processed']} logs processed in {report['duration']:.2f}s, "
+                  f"{len(report['changes'])} changes")
+        else:
+            print(f"Unknown procedure '{arguments[0]}', see 'proc' for a list")
 
     def do_remote(self, args):
         """usage remote <folders/files [folders]/log [file_id]>
@@ -246,16 +460,14 @@ it will default back to name"""
                 if check_for_mp3_link(content):
                     remote_info = "Audiofile detected, downloading..."
                     print(remote_info, end="\r")
-                    response = requests.get(content)
-                    with open(f"{name}.mp3", "wb") as local_file:
-                        for chunk in response.iter_content(100000):
-                            local_file.write(chunk)
+                    # * only a look at the remote side, the blob store is for files the database knows about
+                    status, blob = download_file(content, f"{name}.mp3")
                     print(" " * len(remote_info), end="\r")
-                    print(f"Downloaded {len(response.content)} bytes of audio file.")
-                    # ! this wont work on your local device because there is no function to actually convert the mp3
-                    storage = audio_sparklines(f"{name}.wav", chars=64, high_res=True)
-                    print(storage)
-                    print(storage_sparkline_to_sparkline(storage))
+                    if not status:
+                        print(f"Download of the audio file failed, error: {blob}")
+                        return False
+                    print(f"Downloaded {blob['size']} bytes of audio file, sha256: {blob['hash']}")
+                    print(f"Stored as {blob['path']}")
                     return False
                 print(content)
                 return False
@@ -28,9 +28,13 @@ import wave
 import numpy
 from math import floor
 from statistics import mean, median, pvariance
-from collections import defaultdict
+from collections import defaultdict, deque
 import hashlib
 import re
+import shutil
+import subprocess
+import tempfile
+import zlib
 from typing import Union
 from pathlib import Path
 from datetime import date, datetime
@@ -263,6 +267,276 @@ def find_date(text_block: str) -> date or None:
     return None
 
 
+class AhoCorasick:
+    """
+    Multi pattern string matcher after Aho & Corasick, finds every occurrence of every term in a single pass over
+    the text, no matter if there are ten or ten thousand terms. Matching is exact, lower everything beforehand if
+    case should not matter
+
+    Usage: matcher = AhoCorasick({'schaeffer': "Schaeffer"}); list(matcher.finditer("dr. schaeffer"))
+    """
+    def __init__(self, terms=None):
+        """
+        :param dict terms: optional {term: value} to start with, value is handed back for every match of term
+        """
+        self._goto = [{}]  # * node -> {char: node}, node 0 is the root
+        self._fail = [0]
+        self._out = [[]]  # * node -> [(length, value)] of every term that ends here
+        self._built = True
+        for term, value in (terms or {}).items():
+            self.add(term, value)
+
+    def add(self, term: str, value=None):
+        """
+        :param str term: the text to search for, empty terms are ignored
+        :param value: handed back with every match, defaults to the term itself
+        """
+        if not term:
+            return
+        node = 0
+        for char in term:
+            if (child := self._goto[node].get(char)) is None:
+                child = len(self._goto)
+                self._goto.append({})
+                self._fail.append(0)
+                self._out.append([])
+                self._goto[node][char] = child
+            node = child
+        self._out[node].append((len(term), term if value is None else value))
+        self._built = False
+
+    def build(self):
+        """
+        Computes the failure links, called automatically by finditer after terms were added
+        """
+        queue = deque(self._goto[0].values())
+        for node in queue:
+            self._fail[node] = 0
+        while queue:
+            node = queue.popleft()
+            for char, child in self._goto[node].items():
+                queue.append(child)
+                fail = self._fail[node]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[child] = self._goto[fail].get(char, 0)
+                # * breadth first, the outputs of the shorter suffix are already complete
+                self._out[child] = self._out[child] + self._out[self._fail[child]]
+        self._built = True
+
+    def finditer(self, text: str):
+        """
+        :param str text: arbitrary text
+        :return: generator of (start, end, value) for every match, overlapping ones included
+        """
+        if not self._built:
+            self.build()
+        goto, fail, out = self._goto, self._fail, self._out
+        node = 0
+        for i, char in enumerate(text):
+            while node and char not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(char, 0)
+            for length, value in out[node]:
+                yield i - length + 1, i + 1, value
+
+
+_MINHASH_PRIME = 4294967311  # * smallest prime above 2**32
+LSH_THRESHOLD = 0.7  # * about (1/16) ** (1/8), from there on 16 bands of 8 rows (lsh_buckets) find most pairs
+_minhash_params = {}
+
+
+def _minhash_permutations(num_perm: int) -> tuple:
+    """
+    The same num_perm hash functions (a*x + b) mod prime for every call, otherwise signatures are not comparable
+    """
+    if num_perm not in _minhash_params:
+        rng = numpy.random.RandomState(53)  # * fixed seed, changing it invalidates every stored signature
+        _minhash_params[num_perm] = (rng.randint(1, 2**32 - 1, size=num_perm, dtype=numpy.uint64),
+                                     rng.randint(0, 2**32 - 1, size=num_perm, dtype=numpy.uint64))
+    return _minhash_params[num_perm]
+
+
+def minhash_signature(text: str, num_perm=128, shingle_size=5) -> numpy.ndarray or None:
+    """
+    MinHash signature over the character shingles of a text, two signatures agree in roughly as many positions as
+    the jaccard similarity of the shingle sets, see estimated_similarity. Case and whitespace are normalized first
+
+    :param str text: arbitrary text
+    :param int num_perm: length of the signature, more is more precise and more expensive
+    :param int shingle_size: characters per shingle
+    :return: uint32 array of num_perm values or None for an empty text
+    :rtype: numpy.ndarray or None
+    """
+    text = " ".join(text.lower().split()) if text else ""
+    if not text:
+        return None
+    shingle_hashes = numpy.fromiter({zlib.crc32(text[i:i+shingle_size].encode('utf-8'))
+                                     for i in range(max(1, len(text) - shingle_size + 1))}, dtype=numpy.uint64)
+    a, b = _minhash_permutations(num_perm)
+    # * (num_perm x shingles) matrix, a, b and the hashes all stay below 2**32 so nothing overflows 64 bit
+    hashed = (numpy.outer(a, shingle_hashes) + b[:, None]) % _MINHASH_PRIME
+    return hashed.min(axis=1).astype(numpy.uint32)
+
+
+def lsh_buckets(signature: numpy.ndarray, bands=16) -> list:
+    """
+    Locality sensitive hashing, cuts the signature into bands and hashes every band on its own, two logs that share
+    at least one bucket are candidates for near duplicates. 16 bands of 8 rows find pairs from roughly 0.7 jaccard
+    similarity upwards
+
+    :param numpy.ndarray signature: result of minhash_signature
+    :param int bands: number of bands, has to divide the signature length
+    :return: list of (band, bucket) tuples, bucket is a signed 64 bit int so sqlite can store it
+    :rtype: list
+    """
+    return [(i, int.from_bytes(hashlib.blake2b(part.tobytes(), digest_size=8).digest(), "little", signed=True))
+            for i, part in enumerate(numpy.split(signature, bands))]
+
+
+def estimated_similarity(signature: numpy.ndarray, others: numpy.ndarray) -> numpy.ndarray:
+    """
+    :param numpy.ndarray signature: a single signature
+    :param numpy.ndarray others: one signature per row
+    :return: estimated jaccard similarity between 0 and 1 for every row of others
+    """
+    return (numpy.atleast_2d(others) == signature).mean(axis=1)
+
+
+def tfidf_matrix(documents) -> dict:
+    """
+    Sparse, row normalized TF-IDF matrix in CSR form (sublinear tf, smoothed idf) built with plain numpy, every row
+    is one document, the dot product of two rows is their cosine similarity
+
+    :param documents: iterable of texts
+    :return: {'indptr': int64, 'indices': int32, 'data': float32, 'vocabulary': str array}, column j of the
+             matrix belongs to vocabulary[j]
+    :rtype: dict
+    """
+    vocabulary = {}
+    indptr, indices, counts = [0], [], []
+    for text in documents:
+        ids = numpy.fromiter((vocabulary.setdefault(token, len(vocabulary))
+                              for token in re.findall(r"[a-z0-9]{2,}", (text or "").lower())), dtype=numpy.int32)
+        uniq, count = numpy.unique(ids, return_counts=True)
+        indices.append(uniq)
+        counts.append(count)
+        indptr.append(indptr[-1] + len(uniq))
+    indptr = numpy.array(indptr, dtype=numpy.int64)
+    indices = numpy.concatenate(indices) if indices else numpy.zeros(0, dtype=numpy.int32)
+    tf = 1 + numpy.log(numpy.concatenate(counts)) if counts else numpy.zeros(0)
+    num_docs = len(indptr) - 1
+    doc_freq = numpy.bincount(indices, minlength=len(vocabulary))
+    idf = numpy.log((1 + num_docs) / (1 + doc_freq)) + 1
+    data = tf * idf[indices]
+    running = numpy.concatenate(([0.0], numpy.cumsum(data ** 2)))  # * row sums without reduceat and its empty rows
+    norms = numpy.sqrt(running[indptr[1:]] - running[indptr[:-1]])
+    norms[norms == 0] = 1
+    data /= numpy.repeat(norms, numpy.diff(indptr))
+    return {'indptr': indptr,
+            'indices': indices.astype(numpy.int32),
+            'data': data.astype(numpy.float32),
+            'vocabulary': numpy.array(sorted(vocabulary, key=vocabulary.get), dtype=str)}
+
+
+def cosine_top_k(matrix: dict, row: int, k=5) -> list:
+    """
+    The k rows of a normalized CSR matrix (see tfidf_matrix) that are most similar to the given row, one pass over
+    all non-zero values without a single python loop per row
+
+    :param dict matrix: 'indptr', 'indices' and 'data' of a CSR matrix with normalized rows
+    :param int row: index of the row to compare against
+    :param int k: number of results
+    :return: list of (row_index, similarity) tuples, most similar first, the row itself and zero scores excluded
+    :rtype: list
+    """
+    indptr, indices, data = matrix['indptr'], matrix['indices'], matrix['data']
+    query = numpy.zeros(int(indices.max()) + 1 if len(indices) else 1, dtype=numpy.float32)
+    query[indices[indptr[row]:indptr[row+1]]] = data[indptr[row]:indptr[row+1]]
+    running = numpy.concatenate(([0.0], numpy.cumsum(data * query[indices], dtype=numpy.float64)))
+    scores = running[indptr[1:]] - running[indptr[:-1]]
+    scores[row] = 0
+    k = min(k, len(scores))
+    best = numpy.argpartition(-scores, k - 1)[:k] if k > 0 else []
+    return [(int(i), float(scores[i])) for i in sorted(best, key=lambda i: -scores[i]) if scores[i] > 1e-6]
+
+
+def trigrams(text: str) -> set:
+    """
+    All distinct three character substrings of a lower cased text, the unit of the trigram index
+
+    :param str text: arbitrary text
+    :return: set of strings of length three, empty for texts shorter than that
+    :rtype: set
+    """
+    text = text.lower() if text else ""
+    return {text[i:i+3] for i in range(len(text) - 2)}
+
+
+def regex_literals(pattern: str) -> list:
+    """
+    Pieces of plain text every match of a regular expression has to contain, used to narrow a search down with the
+    trigram index. This is deliberately conservative, it only ever drops literals it is not sure about: anything
+    with an alternation yields nothing, the content of groups is ignored, classes and escapes like \\d or \\x41 end a
+    piece and a character followed by ?, * or {m,n} is dropped as it might not be there at all
+
+    :param str pattern: regular expression in python syntax
+    :return: list of literal strings that appear in every match, may be empty
+    :rtype: list
+    """
+    if "|" in pattern or re.compile(pattern).flags & re.VERBOSE:  # * in verbose mode whitespace means nothing
+        return []
+    pieces, current = [], []
+    depth = 0
+    i = 0
+    while i < len(pattern):
+        char = pattern[i]
+        if char in "()":
+            depth += 1 if char == "(" else -1
+            pieces.append("".join(current))
+            current = []
+        elif char in "?*{":
+            if current and (char != "?" or i == 0 or pattern[i-1] not in "*+?}"):
+                current.pop()  # * the quantified character is optional
+            if char == "{":
+                end = pattern.find("}", i)
+                i = len(pattern) if end < 0 else end
+            pieces.append("".join(current))
+            current = []
+        elif char == "\\" and i + 1 < len(pattern):
+            i += 1
+            if pattern[i].isalnum():  # * \d, \w, \b, backreferences and so on
+                pieces.append("".join(current))
+                current = []
+                # * the operand of the escape is no literal either: \x41, \u0041, \U00000041, \N{...}, \101, \12
+                if pattern[i] in "xuU":
+                    i += {'x': 2, 'u': 4, 'U': 8}[pattern[i]]
+                elif pattern[i] == "N" and pattern[i+1:i+2] == "{":
+                    end = pattern.find("}", i)
+                    i = len(pattern) if end < 0 else end
+                elif pattern[i].isdigit():  # * up to three digits, octal or a group number
+                    start = i
+                    while i + 1 < len(pattern) and pattern[i+1].isdigit() and i - start < 2:
+                        i += 1
+            elif depth == 0:
+                current.append(pattern[i])
+        elif char == "[":
+            end = i + 2 if pattern[i+1:i+2] == "]" else i + 1  # * a leading ] belongs to the class
+            while end < len(pattern) and pattern[end] != "]":
+                end += 2 if pattern[end] == "\\" else 1
+            i = end
+            pieces.append("".join(current))
+            current = []
+        elif char in "^$.+":
+            pieces.append("".join(current))
+            current = []
+        elif depth == 0:
+            current.append(char)
+        i += 1
+    pieces.append("".join(current))
+    return [x for x in pieces if x]
+
+
 # copied from audio metadata shuttle project
 def calc_distribution(val_list: dict, method="median"):
     if method == "average" or method == "mean":
@@ -292,7 +566,7 @@ def audio_sparklines(audio_mono_file: str, chars=32, skip=1, high_res=False,
     Creates a simple representation of a given audio file by a 8 bit representation and 32 chars (by default)
     Inspired by this: https://melatonin.dev/blog/audio-sparklines/
 
-    :param str audio_mono_file: path to a wave file, mono NOT stereo
+    :param str audio_mono_file: path to a pcm wave file with 8, 16, 24 or 32 bit, more channels are down mixed
     :param int chars: number of characters representing the line
     :param int skip: number of frames that get skipped to speed up processing
     :param bool high_res: if true will output a high resolution string for storage
@@ -319,48 +593,107 @@ def audio_sparklines(audio_mono_file: str, chars=32, skip=1, high_res=False,
         high_pass = None
 
     # input of file using wave library - TODO: use something more universal
-    ifile = wave.open(audio_mono_file)
-    sample_rate = ifile.getframerate()
-    audio = ifile.readframes(ifile.getnframes())
-    audio_int16 = numpy.frombuffer(audio, dtype=numpy.int16)
-    audio_float32 = audio_int16.astype(numpy.float32)
-
-    # fancy math i cannot fully comprehend, per https://stackoverflow.com/a/62298670
-    max_int16 = 2**15
-    audio_norm = audio_float32 / max_int16
-    # parting the big array in equal sized parts
-
-    n = len(audio_norm)
-    magnis = {}
-    parts = int(n/chars)
-    for i in range(chars-1):
-        start = i * parts
-        stop = (i+1) * parts
-        if stop > n:
-            stop = n-1
-        # using a fast fourier transformation of the signal, university math class is far in the past, don't crucify me
-        magnis[i] = numpy.abs(numpy.fft.rfft(audio_norm[start:stop:skip], n=sample_rate))
-
-    # apply high & low pass if they are actually set, not sure why exactly this works with this numpy array
-    if low_pass and high_pass:
-        ranging = {i: numpy.mean(magnis[i][low_pass:high_pass]) for i in range(chars-1)}
-    else:
-        ranging = {i: numpy.mean(magnis[i]) for i in range(chars-1)}
+    with wave.open(audio_mono_file) as ifile:
+        sample_rate = ifile.getframerate()
+        # parting the file in equal sized parts, one row per character, the remainder at the end is ignored
+        parts = ifile.getnframes() // chars
+        # * only the first second of every part is transformed, so only that is read, memory stays at one second
+        # * per character no matter how long the recording is
+        span = min(parts, sample_rate * skip)
+        windows = numpy.zeros((chars-1, len(range(0, span, skip))), dtype=numpy.float32)
+        for i in range(chars-1):
+            ifile.setpos(i * parts)
+            frames = pcm_to_mono(ifile.readframes(span), ifile.getsampwidth(), ifile.getnchannels())[::skip]
+            windows[i, :len(frames)] = frames
+    ranging = _window_spectrum_means(windows, sample_rate, low_pass, high_pass)
+
     # dumping down the signal to an equal scale from 0 to 7, might be wise to use a logarithmic scale?
-    maxi = max(ranging.values())
-    spark_line = ""
+    maxi = ranging.max()
+    if maxi <= 0:  # * silence, or not enough samples for a single window
+        return chr(31) * (chars-1) if high_res else sparkslrr[0] * (chars-1)
     if high_res:
         steps = maxi/223  # 32 from 256 to ignore control chars
-        line = [int(x/steps) for x in ranging.values()]
-        for c in line:
-            spark_line += chr(c+31)
+        return "".join(chr(int(x)+31) for x in ranging/steps)
+    steps = maxi/8
+    return "".join(sparkslrr[int(x)] for x in ranging/steps)
+
+
+def pcm_to_mono(raw: bytes, sample_width: int, channels=1) -> numpy.ndarray:
+    """
+    Converts raw pcm frames as wave.readframes returns them to float32 between -1 and 1, all channels averaged
+
+    :param bytes raw: interleaved little endian frames
+    :param int sample_width: bytes per sample, 8 bit is unsigned, 16, 24 and 32 bit are signed
+    :param int channels: number of interleaved channels
+    :return: one value per frame
+    :rtype: numpy.ndarray
+    """
+    if sample_width == 1:
+        samples = (numpy.frombuffer(raw, dtype=numpy.uint8).astype(numpy.float32) - 128) / 2**7
+    elif sample_width == 3:  # * no numpy type for that, the three bytes go into the upper part of an int32
+        padded = numpy.zeros((len(raw) // 3, 4), dtype=numpy.uint8)
+        padded[:, 1:] = numpy.frombuffer(raw, dtype=numpy.uint8).reshape(-1, 3)
+        samples = padded.view("<i4")[:, 0].astype(numpy.float32) / 2**31
+    elif sample_width in (2, 4):
+        samples = numpy.frombuffer(raw, dtype=f"<i{sample_width}").astype(numpy.float32) / 2**(8*sample_width-1)
     else:
-        steps = maxi/8
-        line = [int(x/steps) for x in ranging.values()]
-        # creating the actual str line
-        for c in line:
-            spark_line += sparkslrr[c]
-    return spark_line
+        raise ValueError(f"unsupported sample width of {sample_width} bytes")
+    if channels > 1:
+        samples = samples.reshape(-1, channels).mean(axis=1)
+    return samples
+
+
+def _window_spectrum_means(windows: numpy.ndarray, sample_rate: int, low_pass=None, high_pass=None) -> numpy.ndarray:
+    """
+    Mean magnitude of the spectrum of every row, all rows in one batched rfft. Like the old per window loop only
+    the first second of a row is looked at, but rows shorter than that are padded to the next power of two instead
+    of a full second. That samples the same spectrum on a coarser grid, compared to the old loop the result stays
+    within one step of the 8 sparkline characters and within 5 of the 223 high_res steps
+
+    :param numpy.ndarray windows: 2-D float array, one row per character
+    :param int sample_rate: frames per second, bins are converted to Hz with it
+    :param int low_pass: lower limit for frequency in Hz
+    :param int high_pass: higher limit for frequency in Hz
+    :return: one mean per row
+    :rtype: numpy.ndarray
+    """
+    frames = windows[:, :sample_rate]
+    if frames.shape[1] == 0:
+        return numpy.zeros(frames.shape[0], dtype=numpy.float64)
+    n_fft = sample_rate if frames.shape[1] == sample_rate else 1 << (frames.shape[1] - 1).bit_length()
+    magnitude = numpy.abs(numpy.fft.rfft(frames, n=n_fft, axis=1))
+    if low_pass and high_pass:
+        magnitude = magnitude[:, round(low_pass * n_fft / sample_rate):round(high_pass * n_fft / sample_rate)]
+    return magnitude.mean(axis=1)
+
+
+def audio_file_sparkline(path: str, chars=64) -> str or None:
+    """
+    High resolution sparkline of any audio file, wave files are read directly, everything else (the mp3s of the
+    blob store) is decoded to a temporary mono wave by ffmpeg first. Top level function so a process pool can
+    call it
+
+    :param str path: audio file
+    :param int chars: see audio_sparklines
+    :return: storage form of the sparkline, None if the file cannot be read or there is no ffmpeg to decode it
+    :rtype: str or None
+    """
+    try:
+        with open(path, "rb") as audio:
+            is_wave = audio.read(4) == b"RIFF"
+        if is_wave:
+            return audio_sparklines(path, chars=chars, high_res=True)
+        if not (ffmpeg := shutil.which("ffmpeg")):
+            logger.warning(f"Util>audio_file_sparkline: no ffmpeg found to decode '{path}'")
+            return None
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            decoded = os.path.join(tmp_dir, "decoded.wav")
+            subprocess.run([ffmpeg, "-v", "error", "-i", path, "-ac", "1", "-f", "wav", decoded],
+                           check=True, timeout=300)
+            return audio_sparklines(decoded, chars=chars, high_res=True)
+    except (OSError, EOFError, ValueError, wave.Error, subprocess.SubprocessError) as err:
+        logger.warning(f"Util>audio_file_sparkline: cannot read '{path}': {err}")
+        return None
 
 
 def storage_sparkline_to_sparkline(in_str: str) -> str:
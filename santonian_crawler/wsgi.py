@@ -20,13 +20,54 @@
 #
 # @license GPL-3.0-only <https://www.gnu.org/licenses/gpl-3.0.en.html>
 
-from flask import Flask, jsonify
-from database_util import SantonianDB
+from flask import Flask, Response, request
+from config import db_cache_size, mirror_max_age, mirror_mode, mirror_snapshot_interval, mirror_listing_cache_max
+from mirror import RenderCache, LiveSource, SnapshotSource, select_variant, render_json, parse_since, \
+    export_ndjson, page_params, stream_json_array, payload_hdd, payload_hdd_details, payload_file, \
+    payload_read_file
+from metrics import Metrics, MetricsMiddleware
 from pathlib import PurePath
 
 db_name = "santonian.db"
 #backend = SantonianDB('santonian.db', check_same_thread=False)
 app = Flask(__name__)
+metrics = Metrics()
+app.wsgi_app = MetricsMiddleware(app.wsgi_app, metrics)
+if mirror_mode == "snapshot":
+    source = SnapshotSource(db_name, mirror_snapshot_interval)
+else:
+    source = LiveSource(db_name, cache_size=db_cache_size, trace=metrics.count_query)
+_renders = RenderCache(lambda: source.generation())
+
+
+def _route() -> str:
+    """
+    route template of the current request, the same for both variants of the double routes
+    """
+    return request.url_rule.rule.rstrip("/") if request.url_rule else "unmatched"
+
+
+@app.before_request
+def _label_request():
+    request.environ['santonian.route'] = _route()  # * for the MetricsMiddleware
+
+
+def _respond(key: tuple, producer, rendered=None) -> Response:
+    """
+    Sends the rendered body of a route, rendered and compressed only once until the data changes. Clients get a
+    strong etag and can ask again with If-None-Match, as long as nothing changed they get an empty 304
+    """
+    rendered = rendered or _renders.get(key, metrics.timed(_route(), producer))
+    body, etag, coding = select_variant(rendered, request.headers.get("Accept-Encoding", ""))
+    response = Response(body, mimetype="application/json")
+    if coding:
+        response.content_encoding = coding
+    if rendered.encoded:
+        response.vary.add("Accept-Encoding")
+    response.set_etag(etag)
+    response.cache_control.public = True
+    response.cache_control.max_age = mirror_max_age
+    return response.make_conditional(request)
 
 
 # ? the double routes are only there because the is the exact behaviour the real website gives us
@@ -34,22 +75,13 @@ app = Flask(__name__)
 @app.route("/backend/hdd/", methods=['GET', 'POST'])
 @app.route("/backend/hdd", methods=['GET', 'POST'])
 def all_folders():
-    backend = SantonianDB(db_name)
-    raw = backend.get_all_folders()
-    backend.close()
-    return jsonify([x['name'] for x in raw])
+    return _respond(("hdd", ), lambda: payload_hdd(source))
 
 
 @app.route("/backend/hdd_details/<disk>/", methods=['GET', 'POST'])
 @app.route("/backend/hdd_details/<disk>", methods=['GET', 'POST'])
 def id_folder(disk: str):
-    backend = SantonianDB(db_name)
-    raw = backend.get_folder_santa_id(disk)
-    backend.close()
-    if raw:
-        return jsonify({'type': "OK", 'message': [raw]})
-    else:
-        return jsonify({'type': "ERR", 'message': "[[b;#b0e6fd;]{disk}] is not a valid folder.".format(disk=disk)})
+    return _respond(("hdd_details", disk), lambda: payload_hdd_details(source, disk))
 
 
 @app.route("/backend/file/<int:disk_id>/", methods=['GET', 'POST'])
@@ -59,17 +91,19 @@ def dir_folder(disk_id: int):
     this function is the most nonsensical of them all, internally the real santonian website only accepts the folder
     request by internal id which the crawler id mimics but we could easily just accept the names as they are defined as
     unique in the sqlite3. To mimic properly we unfortunately need to go a roundabout way i really don't like
-    :param disk:
+
+    Gives the complete listing, folders too big to keep their rendered listing around are streamed straight from
+    the cursor. '?page=0&per_page=200' (both optional) gives only one page of it instead
+    :param disk_id:
     :return:
     """
-    backend = SantonianDB(db_name)
-    folder_name = backend.get_folder_by_santa_id(disk_id)
-    if not folder_name:
-        backend.close()
-        return jsonify("")  # emptiest of all jsons
-    files = backend.list_logs_of_folder(folder_name, per_page=200)  # magic nummer that makes assumptions
-    backend.close()
-    return jsonify(files)
+    if paging := page_params(request.values.get("page"), request.values.get("per_page")):
+        return _respond(("file", disk_id, *paging), lambda: payload_file(source, disk_id, *paging))
+    rendered = _renders.peek(("file", disk_id))
+    if rendered is None and (source.listing_size(disk_id) or 0) > mirror_listing_cache_max:
+        chunks = metrics.timed_iter(_route(), stream_json_array(source.iter_listing(disk_id)))
+        return Response(chunks, mimetype="application/json")
+    return _respond(("file", disk_id), lambda: payload_file(source, disk_id), rendered)
 
 
 @app.route("/backend/readFile/<file_name>/", methods=['GET', 'POST'])
@@ -82,16 +116,37 @@ def read_file(file_name: str):
     :param file_name: name of the log file without extension
     :return:
     """
-    backend = SantonianDB(db_name)
-    real_name = backend.get_log_name_extension_blind(file_name)
-    full_file = backend.get_log_content(real_name)
-    backend.close()
-    if full_file:
-        # crawler has revisions, give only newest one if some exist:
-        if isinstance(full_file, list):
-            full_file = full_file[0]
-        return jsonify(full_file['content'])
-    else:
-        return jsonify("NO ITEM WITH THAT NAME")
+    return _respond(("readFile", file_name), lambda: payload_read_file(source, file_name))
 
 # raw = backend.list_logs_of_folder(disk)
+
+
+# ? not part of the original api, everything in one streamed response instead of one request per folder and log
+
+@app.route("/backend/export/", methods=['GET', 'POST'])
+@app.route("/backend/export", methods=['GET', 'POST'])
+def export():
+    """
+    Streams every folder, log revision, tag and tag link as newline delimited json, see SantonianDB.iter_export,
+    '?since=2049-05-01' limits it to what was checked or changed since then
+
+    :return: application/x-ndjson, one json object per line
+    """
+    since = request.values.get("since")
+    if since:
+        try:
+            since = parse_since(since)
+        except ValueError:
+            body = render_json({'type': "ERR", 'message': f"{since} is not an iso date."})
+            return Response(body, status=400, mimetype="application/json")
+    chunks = metrics.timed_iter(_route(), export_ndjson(source.db_file, since, trace=metrics.count_query))
+    return Response(chunks, mimetype="application/x-ndjson")
+
+
+@app.route("/metrics")
+def metrics_endpoint():
+    """
+    Request counts, latency and size histograms, database time and cache hit rates in the prometheus text format
+    """
+    caches = (("render", _renders.hits, _renders.misses, len(_renders)), ("query", *source.cache_info()))
+    return Response(metrics.render(caches), content_type="text/plain; version=0.0.4; charset=utf-8")
@@ -0,0 +1,288 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Copyright 2021 by BurnoutDV, <development@burnoutdv.com>
+#
+# This file is part of SantonianCrawler.
+#
+# SantonianCrawler is free software: you can redistribute
+# it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, either
+# version 3 of the License, or (at your option) any later version.
+#
+# SantonianCrawler is distributed in the hope that it will
+# be useful, but WITHOUT ANY WARRANTY; without even the implied warranty
+# of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# @license GPL-3.0-only <https://www.gnu.org/licenses/gpl-3.0.en.html>
+
+import io
+import os
+import tempfile
+import unittest
+import wave
+from unittest import mock
+
+import numpy
+
+from santonian_crawler.database_util import SantonianDB
+from santonian_crawler.santonian import download_audio
+
+
+class TestSantonianDB(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.db = SantonianDB(os.path.join(self.tmp_dir.name, "santonian.db"))
+        self.db.insert_folder("ARCHIVE001", 8)
+        self.db.insert_folder("ARCHIVE002", 9)
+        logs = [("FTR-044-V.LOG", "Report from May 2049", 8),
+                ("KDS-223-P.LOG", "Nothing to see here", 8),
+                ("WKRP-817-CIN.LOG", "Biocom 531008 092419", 9)]
+        for name, content, folder in logs:
+            self.db.insert_text_log(content, name, folder)
+
+    def tearDown(self):
+        self.db.close()
+        self.tmp_dir.cleanup()
+
+    def test_procedure_maintain(self):
+        report = self.db.procedure_maintain()
+        self.assertEqual(report['timing_before'].keys(), report['timing_after'].keys())
+        self.assertIn("ANALYZE;", report['steps'])
+        self.assertEqual(self.db.cur.execute("PRAGMA auto_vacuum;").fetchone()[0], 2)
+        self.assertEqual(self.db.count_logs(), 3)
+        cached = SantonianDB(self.db.db_file, cache_size=16)
+        cached.procedure_maintain()
+        self.assertEqual(cached.cache_info()['hits'], 0)  # * timed the queries, not the cache
+        self.assertIsNotNone(cached.cache)
+        cached.close()
+
+    def test_tag_files_bulk_without_duplicates(self):
+        self.db.create_modify_tag("Schaeffer", "name")
+        pairs = [("ftr-044-v.log", "Schaeffer"),
+                 ("FTR-044-V.LOG", "Schaeffer"),
+                 ("KDS-223-P.LOG", "Schaeffer"),
+                 ("UNKNOWN.LOG", "Schaeffer"),
+                 ("KDS-223-P.LOG", "no_such_tag")]
+        self.assertEqual(self.db.tag_files(pairs), 2)
+        self.assertEqual(self.db.tag_files(pairs), 0)
+        self.assertTrue(self.db.tag_file("FTR-044-V.LOG", "Schaeffer"))
+        num = self.db.cur.execute("SELECT COUNT(*) FROM tag_link;").fetchone()[0]
+        self.assertEqual(num, 2)
+
+    def test_query_cache_invalidation(self):
+        cached = SantonianDB(self.db.db_file, cache_size=16)
+        self.assertEqual(cached.get_folder_santa_id("ARCHIVE001"), 8)
+        self.assertEqual(cached.get_folder_santa_id("ARCHIVE001"), 8)
+        self.assertEqual(cached.cache_info()['hits'], 1)
+        # * a write through another connection changes data_version
+        self.db.cur.execute("UPDATE folders SET file_id = 18 WHERE name = 'ARCHIVE001';")
+        self.db.db.commit()
+        self.assertEqual(cached.get_folder_santa_id("ARCHIVE001"), 18)
+        # * a local write changes total_changes
+        cached.insert_folder("ARCHIVE003", 10)
+        self.assertEqual(cached.get_folder_by_santa_id(10), "ARCHIVE003")
+        self.assertEqual(cached.cache_info()['misses'], 3)
+        # * handles out of the cache do not share their dictionaries
+        cached.get_log("FTR-044-V.LOG").newest['content'] = "mutated"
+        self.assertEqual(cached.get_log("FTR-044-V.LOG").newest['content'], "Report from May 2049")
+        cached.close()
+
+    def test_iter_logs_projection(self):
+        rows = list(self.db.iter_logs(("name", "folder"), folder="ARCHIVE001", order="DESC"))
+        self.assertEqual([row.name for row in rows], ["KDS-223-P.LOG", "FTR-044-V.LOG"])
+        self.assertEqual(rows[0]._fields, ("name", "folder"))
+        self.assertEqual(rows[0].folder, "ARCHIVE001")
+        self.assertEqual(len(list(self.db.iter_logs(("name", "no_column"), limit=2))), 2)
+        self.assertEqual(self.db.list_logs_of_folder("%", per_page=2, page=1), ["WKRP-817-CIN.LOG"])
+
+    def test_log_handle_lazy_revisions(self):
+        query = """INSERT INTO log (name, folder, content, hash, revision, last_check, first_entry)
+                   VALUES ('FTR-044-V.LOG', 1, 'Report from June 2049', 'newhash', 1, '2049', '2049');"""
+        self.db.cur.execute(query)
+        self.db.db.commit()
+        handle = self.db.get_log("ftr-044-v.log")
+        self.assertEqual(handle.revision_count, 2)
+        self.assertEqual(handle.revisions, [1, 0])
+        self.assertEqual(handle.newest['content'], "Report from June 2049")
+        self.assertEqual(handle.revision(0)['content'], "Report from May 2049")
+        self.assertIsNone(handle.revision(7))
+        self.assertIsNone(self.db.get_log("NOTHING.LOG"))
+
+    def test_extension_blind_lookup(self):
+        self.assertEqual(self.db.get_log_name_extension_blind("ftr-044-v"), "FTR-044-V.LOG")
+        self.assertEqual(self.db.get_log_name_extension_blind("FTR-044"), "")
+        self.db.insert_text_log("Report from May 2049", "FTR-044-V.LOG", 8)  # * unchanged log only gets touched
+        self.assertEqual(self.db.count_logs(), 3)
+
+    def test_in_universe_dates(self):
+        self.db.procedure_tag_date()
+        self.assertEqual(self.db.logs_between("2049-01-01", "2049-12-31"),
+                         [{'name': "FTR-044-V.LOG", 'day': "2049-05-01"}])
+        self.assertEqual(self.db.date_histogram(), {'2049': 1, '2053': 1})
+        self.assertEqual(self.db.date_histogram("month"), {'2049-05': 1, '2053-10': 1})
+
+    def test_run_procedure_watermark(self):
+        first = self.db.run_procedure("date_tag", batch_size=2)
+        self.assertEqual(first['processed'], 3)
+        self.assertEqual(first['changes'], {'FTR-044-V.LOG': "2049-05-01", 'WKRP-817-CIN.LOG': "2053-10-08"})
+        self.assertEqual(self.db.run_procedure("date_tag")['processed'], 0)
+        self.db.insert_text_log("Found on July 3rd, 2047", "PLD-101-K.LOG", 9)
+        second = self.db.run_procedure("date_tag")
+        self.assertEqual((second['processed'], second['changes']), (1, {'PLD-101-K.LOG': "2047-07-03"}))
+        self.assertEqual(self.db.run_procedure("date_tag", full=True)['changes'], {})
+        self.assertIsNone(self.db.run_procedure("no_such_procedure"))
+
+    def test_entity_tags_incremental(self):
+        self.db.add_dictionary_terms([("Report", "Report", "entity")])
+        self.assertEqual(self.db.procedure_tag_entities(), {'FTR-044-V.LOG': ["Report"]})
+        # * a new term has to reach the old logs, a new log has to see the whole dictionary
+        self.db.add_dictionary_terms([("nothing", "Nothing", "entity"), ("Biocom", "Biocom", "entity")])
+        self.db.insert_text_log("A report by Biocom", "PLD-101-K.LOG", 9)
+        self.assertEqual(self.db.procedure_tag_entities(), {'KDS-223-P.LOG': ["Nothing"],
+                                                            'WKRP-817-CIN.LOG': ["Biocom"],
+                                                            'PLD-101-K.LOG': ["Biocom", "Report"]})
+        self.assertEqual(self.db.procedure_tag_entities(), {})
+
+    def test_near_duplicates(self):
+        self.db.insert_text_log("Report from May 2049!", "FTR-045-V.LOG", 8)
+        self.db.run_procedure("minhash")
+        duplicates = self.db.near_duplicates("ftr-044-v.log")
+        self.assertEqual([x['name'] for x in duplicates], ["FTR-045-V.LOG"])
+        self.assertGreater(duplicates[0]['similarity'], 0.5)
+        self.assertEqual(self.db.near_duplicates("KDS-223-P.LOG"), [])
+        self.assertEqual(self.db.near_duplicate_clusters(), [["FTR-044-V.LOG", "FTR-045-V.LOG"]])
+
+    def test_related_logs(self):
+        self.assertEqual(self.db.related_logs("FTR-044-V.LOG"), [])
+        self.db.insert_text_log("Another report, written in June", "PLD-101-K.LOG", 9)
+        self.assertEqual(self.db.procedure_tfidf()['logs'], 4)
+        self.assertEqual(self.db.procedure_tfidf()['logs'], 0)
+        related = self.db.related_logs("ftr-044-v.log")
+        self.assertEqual([x['name'] for x in related], ["PLD-101-K.LOG"])
+
+    def test_tag_cooccurrence(self):
+        for name in ("Schaeffer", "Biocom", "May", "Harrow"):
+            self.db.create_modify_tag(name, "entity")
+        self.db.tag_files([("FTR-044-V.LOG", "Schaeffer"), ("FTR-044-V.LOG", "May")])
+        self.db.tag_files([("FTR-044-V.LOG", "Biocom"), ("WKRP-817-CIN.LOG", "Biocom"),
+                           ("WKRP-817-CIN.LOG", "Harrow"), ("KDS-223-P.LOG", "May")])
+        self.assertEqual([(x['name'], x['weight']) for x in self.db.top_cooccurring("Biocom")],
+                         [("Harrow", 1), ("May", 1), ("Schaeffer", 1)])
+        incremental = self.db.cur.execute("SELECT * FROM tag_cooccurrence ORDER BY tag_a, tag_b;").fetchall()
+        self.assertEqual(self.db.procedure_cooccurrence()['pairs'], 8)
+        rebuilt = self.db.cur.execute("SELECT * FROM tag_cooccurrence ORDER BY tag_a, tag_b;").fetchall()
+        self.assertEqual([tuple(x) for x in incremental], [tuple(x) for x in rebuilt])
+        path = self.db.tag_path("Schaeffer", "Harrow")
+        self.assertEqual([(x['from'], x['to'], x['logs']) for x in path],
+                         [("Schaeffer", "Biocom", ["FTR-044-V.LOG"]), ("Biocom", "Harrow", ["WKRP-817-CIN.LOG"])])
+        self.assertEqual(self.db.tag_path("Schaeffer", "Nobody"), [])
+
+    def test_grep_trigram_index(self):
+        self.assertEqual(self.db.grep("report", ignore_case=True),
+                         [{'name': "FTR-044-V.LOG", 'line': 1, 'text': "Report from May 2049"}])
+        self.assertEqual([x['name'] for x in self.db.grep(r"[A-Z]{3,4}-\d{3}-?\w*")], [])
+        self.db.insert_text_log("Filed under\nFTR-044-V and KDS-223", "PLD-101-K.LOG", 9)
+        self.assertEqual(self.db.grep(r"[A-Z]{3}-\d{3}"),
+                         [{'name': "PLD-101-K.LOG", 'line': 2, 'text': "FTR-044-V and KDS-223"}])
+        # * a log that is missing from the index is still found, the procedure fills the gap
+        self.db.cur.execute("DELETE FROM log_trigram;")
+        self.assertEqual(len(self.db.grep("May 20", regex=False)), 1)
+        self.db.run_procedure("trigram")
+        self.assertEqual(self.db.grep("no such text", regex=False), [])
+        self.assertEqual(len(self.db.grep("Biocom 5", regex=False)), 1)
+        self.assertIsNone(self.db.grep("([A-Z"))
+        self.assertEqual(len(self.db.grep(r"\x52eport from")), 1)  # * escapes are no literals for the index
+        self.assertEqual(len(self.db.grep(r"\122eport from")), 1)
+        # * only the newest revision counts, this one is above the watermark and not indexed
+        self.db.cur.execute("""INSERT INTO log (name, folder, content, hash, revision, last_check, first_entry)
+                               VALUES ('FTR-044-V.LOG', 1, 'Report from June 2049', 'x', 1, '2049', '2049');""")
+        self.assertEqual(self.db.grep("May 2049", regex=False), [])
+        self.assertEqual(len(self.db.grep("June 2049", regex=False)), 1)
+
+    @staticmethod
+    def _download(audio: bytes):
+        response = mock.MagicMock(status_code=200)
+        response.__enter__.return_value = response
+        response.iter_content.side_effect = lambda size: (audio[i:i+size] for i in range(0, len(audio), size))
+        return mock.patch("santonian_crawler.santonian.requests.get", return_value=response)
+
+    def test_audio_blob_store(self):
+        audio = bytes(range(256)) * 1000
+        url = "https://example.com/PLD-101-K.mp3"
+        with self._download(audio) as get:
+            digest = self.db.insert_audio_log(url, "PLD-101-K.AUD", 9)
+            self.assertEqual(self.db.insert_audio_log(url, "PLD-101-K.AUD", 9), digest)  # * known link, no download
+            self.assertEqual(self.db.insert_audio_log(url, "PLD-102-K.AUD", 9), digest)
+        self.assertEqual(get.call_count, 2)
+        audio_file = self.db.get_audio("pld-101-k.aud")
+        self.assertEqual(audio_file['size'], len(audio))
+        with open(audio_file['path'], "rb") as stored:
+            self.assertEqual(stored.read(), audio)
+        self.assertEqual(os.listdir(os.path.dirname(audio_file['path'])), [f"{digest}.mp3"])
+        self.assertEqual(self.db.get_log("PLD-101-K.AUD").newest['aud_hash'], digest)
+        self.assertIsNone(self.db.get_audio("FTR-044-V.LOG"))
+        # * a changed link is a new revision that grep knows about, the old one keeps its link
+        with self._download(audio[::-1]):
+            changed = self.db.insert_audio_log("https://example.com/PLD-101-K-v2.mp3", "PLD-101-K.AUD", 9)
+        self.assertNotEqual(changed, digest)
+        handle = self.db.get_log("PLD-101-K.AUD")
+        self.assertEqual(handle.revisions, [1, 0])
+        self.assertEqual(handle.revision(0)['content'], url)
+        self.assertEqual([x['name'] for x in self.db.grep("K-v2.mp3", regex=False)], ["PLD-101-K.AUD"])
+        self.assertEqual([x['name'] for x in self.db.grep("PLD-101-K.mp3", regex=False)], ["PLD-102-K.AUD"])
+
+    def test_audio_download_cleanup(self):
+        def broken(size):
+            yield b"x" * size
+            raise OSError("No space left on device")
+        with self._download(b"") as get:
+            get.return_value.iter_content.side_effect = broken
+            with self.assertRaises(OSError):
+                download_audio("https://example.com/PLD-101-K.mp3", self.db.blob_dir)
+        self.assertEqual(os.listdir(self.db.blob_dir), [])  # * no .part file left behind
+
+    def test_audio_sparklines(self):
+        buffer = io.BytesIO()
+        with wave.open(buffer, "wb") as out:
+            out.setnchannels(1)
+            out.setsampwidth(2)
+            out.setframerate(8000)
+            t = numpy.arange(4 * 8000) / 8000
+            out.writeframes((numpy.sin(2 * numpy.pi * 440 * t) * t * 8000).astype(numpy.int16).tobytes())
+        with self._download(buffer.getvalue()):
+            self.db.insert_audio_log("https://example.com/PLD-101-K.mp3", "PLD-101-K.AUD", 9)
+        self.db.cur.execute("INSERT INTO audio_blob (hash, size, first_entry) VALUES ('gone', 1, '2049');")
+        first = self.db.procedure_sparklines(workers=2)
+        self.assertEqual((first['processed'], first['failed']), (1, 1))
+        self.assertEqual(self.db.procedure_sparklines()['processed'], 0)
+        line = self.db.get_audio("PLD-101-K.AUD")['sparkline']
+        self.assertEqual(len(line), 63)
+        self.assertLess(ord(line[0]), ord(line[-1]))  # * the tone gets louder over time
+        self.assertEqual(self.db.get_log("PLD-101-K.AUD").newest['sparkline'], line)
+        self.assertEqual([x.sparkline for x in self.db.iter_logs(("name", "sparkline"), folder="ARCHIVE002")],
+                         [None, line])
+
+    def test_similar_audio(self):
+        rising = "".join(chr(31 + i * 3) for i in range(63))
+        lines = {'a': rising, 'b': "".join(chr(ord(c) // 2 + 16) for c in rising),  # * same shape, quieter
+                 'c': rising[::-1], 'd': rising[:32] + rising[:31]}
+        for digest, line in lines.items():
+            self.db.cur.execute("INSERT INTO audio_blob (hash, size, first_entry) VALUES (?, 1, '2049');", [digest])
+            self.db.cur.execute("INSERT INTO audio_sparkline (hash, line, chars, changed) VALUES (?, ?, 64, '2049');",
+                                (digest, line))
+            query = """INSERT INTO log (name, folder, content, audio, aud_hash, hash, revision, last_check, first_entry)
+                       VALUES (?, 2, '', 1, ?, ?, 0, '2049', '2049');"""
+            self.db.cur.execute(query, (f"{digest.upper()}.AUD", digest, digest))
+        self.db.cur.execute(query, ("A2.AUD", "a", "a"))
+        self.assertEqual(self.db.procedure_fingerprints(), 4)
+        similar = self.db.similar_audio("a.aud", limit=3)
+        self.assertEqual([x['name'] for x in similar], ["A2.AUD", "B.AUD", "D.AUD"])
+        self.assertEqual(similar[0]['distance'], 0)
+        self.assertLess(similar[1]['distance'], 0.05)
+        self.assertEqual(self.db.similar_audio("FTR-044-V.LOG"), [])
@@ -20,10 +20,49 @@
 #
 # @license GPL-3.0-only <https://www.gnu.org/licenses/gpl-3.0.en.html>
 
+import os
+import tempfile
 import unittest
+import wave
 from datetime import date
 
-from santonian_crawler.util import find_date
+import numpy
+
+from santonian_crawler.util import find_date, AhoCorasick, regex_literals, audio_sparklines, pcm_to_mono
+
+
+def _loop_sparkline_levels(audio_mono_file: str, chars=32, high_res=False, low_pass=None, high_pass=None) -> list:
+    """
+    The levels of the original audio_sparklines, one rfft per window padded to a full second
+    """
+    ifile = wave.open(audio_mono_file)
+    sample_rate = ifile.getframerate()
+    audio = numpy.frombuffer(ifile.readframes(ifile.getnframes()), dtype=numpy.int16).astype(numpy.float32) / 2**15
+    parts = int(len(audio)/chars)
+    ranging = []
+    for i in range(chars-1):
+        magnitude = numpy.abs(numpy.fft.rfft(audio[i*parts:(i+1)*parts], n=sample_rate))
+        ranging.append(numpy.mean(magnitude[low_pass:high_pass] if low_pass and high_pass else magnitude))
+    steps = max(ranging) / (223 if high_res else 8)
+    return [int(x/steps) for x in ranging]
+
+
+def _write_wav(path: str, signal: numpy.ndarray, sample_rate: int, sample_width=2, channels=1):
+    """
+    Writes a float signal between -1 and 1 as pcm wave, every channel gets the same signal
+    """
+    scaled = numpy.repeat(signal, channels) * (2**(8*sample_width-1) - 1)
+    if sample_width == 1:
+        raw = (scaled + 128).astype(numpy.uint8).tobytes()
+    elif sample_width == 3:
+        raw = scaled.astype("<i4").view(numpy.uint8).reshape(-1, 4)[:, :3].tobytes()
+    else:
+        raw = scaled.astype(f"<i{sample_width}").tobytes()
+    with wave.open(path, "wb") as out:
+        out.setnchannels(channels)
+        out.setsampwidth(sample_width)
+        out.setframerate(sample_rate)
+        out.writeframes(raw)
 
 
 class TestSantonian(unittest.TestCase):
@@ -61,4 +100,67 @@ class TestSantonian(unittest.TestCase):
         ]
         for each in list_of_dates:
             with self.subTest(each[0]):
-                self.assertEqual(find_date(each[0]), each[1])
\ No newline at end of file
+                self.assertEqual(find_date(each[0]), each[1])
+
+    def test_aho_corasick(self):
+        matcher = AhoCorasick({'he': "he", 'she': "she", 'his': "his", 'hers': "hers"})
+        found = [(start, end, value) for start, end, value in matcher.finditer("ushers")]
+        self.assertEqual(found, [(1, 4, "she"), (2, 4, "he"), (2, 6, "hers")])
+        self.assertEqual(list(AhoCorasick().finditer("anything")), [])
+
+    def test_regex_literals(self):
+        tests = [
+            ("Biocom 53", ["Biocom 53"]),
+            (r"FTR-04\d", ["FTR-04"]),
+            ("abc?def", ["ab", "def"]),
+            (r"[A-Z]{3}-\d{3}", ["-"]),
+            ("(abc)?def", ["def"]),
+            ("report|file", []),
+            (r"\x41BC-123", ["BC-123"]),
+            (r"\101BCD", ["BCD"]),
+            (r"\0BCD", ["BCD"]),
+            (r"\u0041BCD", ["BCD"]),
+            (r"\U00000041BCD", ["BCD"]),
+            (r"\N{LATIN CAPITAL LETTER A}BCD", ["BCD"]),
+            (r"(a)\1BCD", ["BCD"]),
+        ]
+        for each in tests:
+            with self.subTest(each[0]):
+                self.assertEqual(regex_literals(each[0]), each[1])
+
+    def test_audio_sparklines_tolerance(self):
+        sample_rate = 8000
+        t = numpy.arange(12 * sample_rate) / sample_rate
+        envelope = 0.2 + 0.8 * numpy.abs(numpy.sin(t * 0.7))
+        noise = numpy.random.default_rng(7).standard_normal(len(t))
+        signal = numpy.clip(envelope * (0.5 * numpy.sin(2 * numpy.pi * 440 * t) + 0.1 * noise), -1, 1)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, "synthetic.wav")
+            _write_wav(path, signal, sample_rate)
+            for band in ({}, {'low_pass': 100, 'high_pass': 2000}):
+                with self.subTest(**band):
+                    line = audio_sparklines(path, **band)
+                    expected = _loop_sparkline_levels(path, **band)
+                    levels = [' ▁▂▃▄▅▆▇█'.index(c) for c in line]
+                    self.assertLessEqual(max(abs(a - b) for a, b in zip(levels, expected)), 1)
+                    stored = audio_sparklines(path, high_res=True, **band)
+                    expected = _loop_sparkline_levels(path, high_res=True, **band)
+                    self.assertEqual(len(stored), len(expected))
+                    self.assertLessEqual(max(abs(ord(a) - 31 - b) for a, b in zip(stored, expected)), 5)
+
+    def test_audio_sparklines_formats(self):
+        self.assertEqual(pcm_to_mono(b"\x00\x00\x80\xff\xff\x7f", 3).tolist(), [-1.0, 1.0 - 2**-23])
+        self.assertEqual(pcm_to_mono(b"\x00\x80\x00\x40", 2, channels=2).tolist(), [-0.25])
+        sample_rate = 8000
+        t = numpy.arange(6 * sample_rate) / sample_rate
+        signal = (0.2 + 0.7 * numpy.abs(numpy.sin(t * 0.9))) * numpy.sin(2 * numpy.pi * 330 * t)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            reference = os.path.join(tmp_dir, "mono16.wav")
+            _write_wav(reference, signal, sample_rate)
+            expected = [ord(c) for c in audio_sparklines(reference, high_res=True)]
+            for sample_width, channels in ((1, 1), (1, 2), (2, 2), (3, 1), (3, 2), (4, 2)):
+                with self.subTest(sample_width=sample_width, channels=channels):
+                    path = os.path.join(tmp_dir, f"{sample_width}_{channels}.wav")
+                    _write_wav(path, signal, sample_rate, sample_width, channels)
+                    line = [ord(c) for c in audio_sparklines(path, high_res=True)]
+                    self.assertLessEqual(max(abs(a - b) for a, b in zip(line, expected)), 2)
@@ -0,0 +1,286 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Copyright 2021 by BurnoutDV, <development@burnoutdv.com>
+#
+# This file is part of SantonianCrawler.
+#
+# SantonianCrawler is free software: you can redistribute
+# it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, either
+# version 3 of the License, or (at your option) any later version.
+#
+# SantonianCrawler is distributed in the hope that it will
+# be useful, but WITHOUT ANY WARRANTY; without even the implied warranty
+# of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# @license GPL-3.0-only <https://www.gnu.org/licenses/gpl-3.0.en.html>
+
+
+import asyncio
+import gc
+import gzip
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+from flask import jsonify
+
+import santonian_crawler
+from santonian_crawler.database_util import SantonianDB
+
+# * the mirror is started from within the package folder (python -m flask run), its imports expect that
+sys.path.insert(0, os.path.dirname(santonian_crawler.__file__))
+import wsgi
+import asgi
+from mirror import RenderCache, LiveSource, SnapshotSource, pick_encoding
+from metrics import Metrics
+
+
+class TestMirror(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.db_file = os.path.join(self.tmp_dir.name, "santonian.db")
+        self.db = SantonianDB(self.db_file)
+        self.db.insert_folder("ARCHIVE001", 8)
+        self.db.insert_text_log("Report from May 2049", "FTR-044-V.LOG", 8)
+        self.db.insert_text_log("Nothing to see here", "KDS-223-P.LOG", 8)
+        wsgi.source = LiveSource(self.db_file)
+        wsgi._renders = RenderCache(lambda: wsgi.source.generation())
+        asgi.source = wsgi.source
+        asgi._renders = RenderCache(lambda: asgi.source.generation())
+        self.client = wsgi.app.test_client()
+
+    def tearDown(self):
+        if isinstance(wsgi.source, LiveSource):
+            wsgi.source.backend().close()
+        self.db.close()
+        self.tmp_dir.cleanup()
+
+    def test_bodies_match_jsonify(self):
+        for source in (LiveSource(self.db_file), SnapshotSource(self.db_file, interval=0)):
+            wsgi.source = asgi.source = source
+            self._assert_bodies()
+
+    def test_folder_matching(self):
+        self.db.insert_folder("ARCHIVE002", 9)
+        live, snapshot = LiveSource(self.db_file), SnapshotSource(self.db_file, interval=0)
+        for disk in ("archive001", "ARCHIVE00%", "ARCHIVE_02", "%2", "ARCHIVE", "ÄRCHIVE001", "archive001%x"):
+            with self.subTest(disk):
+                self.assertEqual(snapshot.folder_id(disk), live.folder_id(disk))
+        live.backend().close()
+
+    def _assert_bodies(self):
+        expected = {"/backend/hdd": ["ARCHIVE001"],
+                    "/backend/hdd_details/ARCHIVE001/": {'type': "OK", 'message': [8]},
+                    "/backend/hdd_details/NOPE": {'type': "ERR", 'message': "[[b;#b0e6fd;]NOPE] is not a valid folder."},
+                    "/backend/file/8": ["FTR-044-V.LOG", "KDS-223-P.LOG"],
+                    "/backend/file/99": "",
+                    "/backend/readFile/FTR-044-V": "Report from May 2049",
+                    "/backend/readFile/NOPE/": "NO ITEM WITH THAT NAME"}
+        for url, payload in expected.items():
+            with self.subTest(url, source=type(wsgi.source).__name__):
+                with wsgi.app.app_context():
+                    body = jsonify(payload).get_data()
+                self.assertEqual(self.client.get(url).get_data(), body)
+                status, headers, asgi_body = self._asgi(url, method="POST")
+                self.assertEqual((status, asgi_body), (200, body))
+                self.assertEqual(headers[b"content-type"], b"application/json")
+
+    def test_etag_and_invalidation(self):
+        first = self.client.get("/backend/readFile/FTR-044-V")
+        self.assertIn("max-age", first.headers['Cache-Control'])
+        etag = first.headers['ETag']
+        again = self.client.get("/backend/readFile/FTR-044-V", headers={'If-None-Match': etag})
+        self.assertEqual((again.status_code, again.get_data()), (304, b""))
+        self.assertEqual((wsgi._renders.hits, wsgi._renders.misses), (1, 1))
+        self.db.cur.execute("UPDATE log SET content = 'Report from June 2049' WHERE name = 'FTR-044-V.LOG';")
+        self.db.db.commit()
+        changed = self.client.get("/backend/readFile/FTR-044-V", headers={'If-None-Match': etag})
+        self.assertEqual(changed.status_code, 200)
+        self.assertEqual(changed.get_json(), "Report from June 2049")
+        self.assertNotEqual(changed.headers['ETag'], etag)
+
+    @staticmethod
+    def _asgi(path: str, method="GET", headers=(), query_string=b"", body=b""):
+        """
+        One request against the asgi app without a server, returns status, headers and the whole body
+        """
+        sent = []
+
+        async def receive():
+            return {'type': "http.request", 'body': body, 'more_body': False}
+
+        async def send(message):
+            sent.append(message)
+
+        scope = {'type': "http", 'method': method, 'path': path, 'headers': list(headers), 'query_string': query_string}
+        asyncio.run(asgi.app(scope, receive, send))
+        return sent[0]['status'], dict(sent[0]['headers']), b"".join(x.get('body', b"") for x in sent[1:])
+
+    def test_asgi(self):
+        status, headers, body = self._asgi("/backend/readFile/FTR-044-V")
+        self.assertEqual(status, 200)
+        self.assertEqual(headers[b"content-length"], str(len(body)).encode())
+        etag = headers[b"etag"]
+        status, _, body = self._asgi("/backend/readFile/FTR-044-V", headers=[(b"if-none-match", b"W/" + etag)])
+        self.assertEqual((status, body), (304, b""))
+        self.assertEqual((asgi._renders.hits, asgi._renders.misses), (1, 1))
+        posted = self._asgi("/backend/readFile/FTR-044-V", "POST", headers=[(b"if-none-match", etag)])
+        flask_posted = self.client.post("/backend/readFile/FTR-044-V", headers={'If-None-Match': etag.decode()})
+        self.assertEqual((posted[0], posted[2]), (flask_posted.status_code, flask_posted.get_data()))
+        self.assertEqual(posted[0], 200)
+        self.assertEqual(self._asgi("/backend/readFile/FTR-044-V", method="HEAD")[2], b"")
+        self.assertEqual(self._asgi("/backend/file/eight")[0], 404)
+        self.assertEqual(self._asgi("/backend/hdd", method="DELETE")[0], 405)
+
+    def test_compression(self):
+        self.assertEqual(pick_encoding("gzip, deflate", ("gzip", )), "gzip")
+        self.assertEqual(pick_encoding("gzip;q=0, *", ("gzip", )), None)
+        self.assertEqual(pick_encoding("*;q=0.5", ("gzip", )), "gzip")
+        self.assertEqual(pick_encoding("", ("gzip", )), None)
+        self.db.insert_text_log("Biocom 531008 092419 " * 200, "WKRP-817-CIN.LOG", 8)
+        url = "/backend/readFile/WKRP-817-CIN"
+        plain = self.client.get(url)
+        packed = self.client.get(url, headers={'Accept-Encoding': "gzip"})
+        self.assertEqual(packed.headers['Content-Encoding'], "gzip")
+        self.assertIn("Accept-Encoding", packed.headers['Vary'])
+        self.assertLess(len(packed.get_data()), len(plain.get_data()))
+        self.assertEqual(gzip.decompress(packed.get_data()), plain.get_data())
+        self.assertNotEqual(packed.headers['ETag'], plain.headers['ETag'])
+        again = self.client.get(url, headers={'Accept-Encoding': "gzip", 'If-None-Match': packed.headers['ETag']})
+        self.assertEqual(again.status_code, 304)
+        status, headers, body = self._asgi(url, headers=[(b"accept-encoding", b"gzip")])
+        self.assertEqual((status, headers[b"content-encoding"], body), (200, b"gzip", packed.get_data()))
+        self.assertNotIn("Content-Encoding", self.client.get("/backend/hdd", headers={'Accept-Encoding': "gzip"}).headers)
+        # * a new generation renders again, but the unchanged body is not compressed a second time
+        encoded = wsgi._renders.get(("readFile", "WKRP-817-CIN"), None).encoded
+        self.db.insert_text_log("Found on July 3rd, 2047", "PLD-101-K.LOG", 8)
+        self.client.get(url)
+        self.assertIs(wsgi._renders.get(("readFile", "WKRP-817-CIN"), None).encoded, encoded)
+
+    def test_export(self):
+        self.db.create_modify_tag("Biocom", "entity")
+        self.db.tag_files([("FTR-044-V.LOG", "Biocom")])
+        self.db.cur.execute("""INSERT INTO log (name, folder, content, hash, revision, last_check, first_entry)
+                               SELECT name, folder, 'Report from June 2049', 'x', 1, last_check, first_entry
+                               FROM log WHERE name = 'FTR-044-V.LOG';""")  # * insert_text_log has no revisions yet
+        self.db.db.commit()
+        response = self.client.get("/backend/export")
+        self.assertEqual(response.mimetype, "application/x-ndjson")
+        records = [json.loads(line) for line in response.get_data().splitlines()]
+        kinds = [x['kind'] for x in records]
+        self.assertEqual(kinds, ["folder"] + ["log"] * 3 + ["tag", "tag_link"])
+        self.assertEqual([x['revision'] for x in records if x.get('name') == "FTR-044-V.LOG"], [0, 1])
+        self.assertEqual(records[-1], {'kind': "tag_link", 'log': "FTR-044-V.LOG", 'tag': "Biocom",
+                                       'changed': records[-1]['changed']})
+        self.assertEqual(self._asgi("/backend/export/")[2], response.get_data())
+        self.assertEqual(self.client.get("/backend/export?since=2999-01-01").get_data(), b"")
+        self.assertEqual(len(self.client.get("/backend/export?since=2000-01-01").get_data().splitlines()), 6)
+        self.assertEqual(self.client.get("/backend/export?since=yesterday").status_code, 400)
+        self.assertEqual(self._asgi("/backend/export", query_string=b"since=2999-01-01")[:3:2], (200, b""))
+        self.assertEqual(self._asgi("/backend/export", query_string=b"since=yesterday")[0], 400)
+
+    def test_full_listing(self):
+        self.db.cur.executemany("""INSERT INTO log (name, folder, content, hash, revision, last_check, first_entry)
+                                   SELECT ?, uid, 'x', 'x', 0, '2049-05-01', '2049-05-01'
+                                   FROM folders WHERE name = 'ARCHIVE001';""",
+                                [(f"FILL-{i:03}.LOG", ) for i in range(250)])
+        self.db.db.commit()
+        names = ["FTR-044-V.LOG", "KDS-223-P.LOG"] + [f"FILL-{i:03}.LOG" for i in range(250)]
+        with wsgi.app.app_context():
+            body = jsonify(names).get_data()
+        for source in (LiveSource(self.db_file), SnapshotSource(self.db_file, interval=0)):
+            for streamed in (False, True):
+                wsgi.source = asgi.source = source
+                wsgi._renders = RenderCache(lambda: wsgi.source.generation())
+                asgi._renders = RenderCache(lambda: asgi.source.generation())
+                limit = 10 if streamed else 5000
+                with self.subTest(source=type(source).__name__, streamed=streamed), \
+                        mock.patch.object(wsgi, "mirror_listing_cache_max", limit), \
+                        mock.patch.object(asgi, "mirror_listing_cache_max", limit):
+                    response = self.client.get("/backend/file/8")
+                    self.assertEqual(response.get_data(), body)
+                    self.assertEqual("ETag" not in response.headers, streamed)  # * streamed ones are not cached
+                    self.assertEqual(self._asgi("/backend/file/8")[2], body)
+                    page = self.client.get("/backend/file/8?page=1&per_page=100").get_json()
+                    self.assertEqual(page, names[100:200])
+                    self.assertEqual(json.loads(self._asgi("/backend/file/8", query_string=b"page=1")[2]), names[200:])
+                    self.assertEqual(self.client.get("/backend/file/99?page=0").get_json(), "")
+                    huge = "/backend/file/8?page=99999999999999999999"
+                    self.assertEqual(self.client.get(huge).get_json(), [])
+                    self.assertEqual(self._asgi("/backend/file/8", query_string=huge.split("?")[1].encode())[:3:2],
+                                     (200, b"[]\n"))
+                    form = self.client.post("/backend/file/8", data={'page': "0", 'per_page': "1"}).get_data()
+                    self.assertEqual(form, b'["FTR-044-V.LOG"]\n')
+                    headers = [(b"content-type", b"application/x-www-form-urlencoded")]
+                    self.assertEqual(self._asgi("/backend/file/8", "POST", headers, body=b"page=0&per_page=1")[2], form)
+
+    def test_metrics(self):
+        wsgi.metrics = wsgi.app.wsgi_app.metrics = Metrics()
+        wsgi.source = LiveSource(self.db_file, cache_size=16, trace=wsgi.metrics.count_query)
+        for url in ("/backend/readFile/FTR-044-V", "/backend/readFile/FTR-044-V/", "/backend/hdd", "/backend/nothing"):
+            self.client.get(url).close()  # * measured once the server closed the body, like real ones always do
+        text = self.client.get("/metrics").get_data(as_text=True)
+        lines = dict(line.rsplit(" ", 1) for line in text.splitlines() if not line.startswith("#"))
+        route = "/backend/readFile/<file_name>"
+        self.assertEqual(lines[f'santonian_mirror_requests_total{{route="{route}",method="GET",status="200"}}'], "2")
+        self.assertEqual(lines['santonian_mirror_requests_total{route="unmatched",method="GET",status="404"}'], "1")
+        self.assertEqual(lines[f'santonian_mirror_request_seconds_count{{route="{route}"}}'], "2")
+        self.assertEqual(lines[f'santonian_mirror_request_seconds_bucket{{route="{route}",le="+Inf"}}'], "2")
+        self.assertEqual(float(lines[f'santonian_mirror_response_bytes_sum{{route="{route}"}}']), 46)
+        self.assertGreater(int(lines[f'santonian_mirror_db_queries_total{{route="{route}"}}']), 0)
+        self.assertEqual(lines['santonian_mirror_cache_hits_total{cache="render"}'], "1")
+        self.assertEqual(lines['santonian_mirror_cache_misses_total{cache="render"}'], "2")
+        # * every thread counts on its own, nothing gets lost when they are added up
+        metrics = Metrics()
+        workers = [threading.Thread(target=lambda: [metrics.observe_request("/x", "GET", 200, 0.002, 10)
+                                                    for _ in range(1000)]) for _ in range(4)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        self.assertIn('santonian_mirror_requests_total{route="/x",method="GET",status="200"} 4000', metrics.render())
+        # * connections of finished threads are not kept alive for the cache report
+        source = LiveSource(self.db_file, cache_size=16)
+        for _ in range(5):
+            worker = threading.Thread(target=source.folders)
+            worker.start()
+            worker.join()
+        gc.collect()
+        self.assertEqual(len(source._backends), 0)
+        self._asgi("/backend/hdd")
+        self.assertIn('santonian_mirror_requests_total{route="/backend/hdd",method="GET",status="200"}',
+                      self._asgi("/metrics")[2].decode())
+
+    def test_snapshot_swap(self):
+        snapshot = SnapshotSource(self.db_file, interval=0)
+        wsgi.source = snapshot
+        self.assertFalse(snapshot.refresh())
+        before = snapshot.snapshot
+        self.db.insert_text_log("Biocom 531008 092419", "WKRP-817-CIN.LOG", 8)
+        self.assertEqual(self.client.get("/backend/readFile/wkrp-817-cin").get_json(), "NO ITEM WITH THAT NAME")
+        self.assertTrue(snapshot.refresh())
+        self.assertIsNot(snapshot.snapshot, before)
+        self.assertEqual(self.client.get("/backend/readFile/wkrp-817-cin").get_json(), "Biocom 531008 092419")
+        self.assertEqual(self.client.get("/backend/file/8").get_json()[-1], "WKRP-817-CIN.LOG")
+        with self.assertRaises(TypeError):
+            snapshot.snapshot.logs['x'] = "read only"
+        watched = SnapshotSource(self.db_file, interval=0.01)
+        self.db.insert_text_log("Found on July 3rd, 2047", "PLD-101-K.LOG", 8)
+        for _ in range(200):  # * the watcher thread swaps it in on its own
+            if watched.log_body("PLD-101-K"):
+                break
+            time.sleep(0.01)
+        watched.stop()
+        self.assertEqual(watched.log_body("PLD-101-K"), "Found on July 3rd, 2047")